@@ -0,0 +1,398 @@
+"""Benchmark
+reproducible ingest and query benchmark on synthetic audio
+
+Generates a catalog of tone/noise songs (no audio files or network needed),
+ingests it into a fresh database and queries it with noisy, time-shifted and
+truncated excerpts. Every stage of the pipeline is timed separately and recall
+is measured per kind of query; the index's lookups are checked against a plain
+rebuild of its postings (see `check_lookups`). The results are written as JSON
+so runs on different commits can be compared.
+
+Usage: python benchmark.py [--songs 20] [--song-seconds 30] [--queries 50]
+                           [--clip-seconds 5] [--snr-db 10] [--seed 0]
+                           [--params default|legacy] [--compress] [--json results.json]
+       python benchmark.py --stft [--song-seconds 30] [--clip-seconds 5] [--seed 0]
+                           compares stft.power_spectrogram with mlab.specgram
+"""
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+import conversion as c
+import find_peaks as fp
+import fingerprint_index as fi
+import frontend as fe
+import index_storage as storage
+import interface_functions as intFunc
+import manageFingerprints as mf
+import song_metadata as sm
+import stft
+
+SONG_RATE = 44100
+QUERY_KINDS = ("clean", "noisy", "shifted", "truncated")
+
+
+def make_song(rng, seconds, rate=SONG_RATE):
+    """Generates a song-like signal: a melody of harmonic notes over a noise floor
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+    seconds : float, length of the song
+    rate : int, sampling rate, Hz
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N,), float32 in [-1, 1]
+    """
+    song = np.zeros(int(seconds * rate))
+    position = 0
+    while position < song.size:
+        length = int(rate * rng.uniform(0.1, 0.4))
+        t = np.arange(length) / rate
+        envelope = np.minimum(1, np.minimum(t / 0.01, (t[-1] - t) / 0.02 + 1e-3))
+        note = np.zeros(length)
+        for _ in range(2):
+            f0 = rng.uniform(80, 1000)
+            for harmonic in range(1, 4):
+                note += envelope * np.sin(2 * np.pi * f0 * harmonic * t) / harmonic
+        if rng.random() < 0.3:  # percussive noise burst
+            note += 0.5 * rng.standard_normal(length) * np.exp(-t / 0.03)
+        stop = min(position + length, song.size)
+        song[position:stop] += note[:stop - position]
+        position = stop
+    song += 0.001 * rng.standard_normal(song.size)
+    return (song / np.abs(song).max() * 0.9).astype(np.float32)
+
+
+def make_corpus(directory, num_songs, seconds, seed=0):
+    """Writes num_songs synthetic songs into directory as .wav files
+
+    Returns
+    -------
+    list of Path
+    """
+    rng = np.random.default_rng(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for song_id in range(num_songs):
+        path = directory / f"song{song_id:05d}.wav"
+        sf.write(path, make_song(rng, seconds), SONG_RATE)
+        paths.append(path)
+    return paths
+
+
+def make_query(samples, rate, kind, rng, clip_seconds=5, snr_db=10, frame_hop=512):
+    """Cuts one query clip out of a song
+
+    Parameters
+    ----------
+    samples : numpy.ndarray, the song
+    rate : int, sampling rate of samples, Hz
+    kind : str, one of QUERY_KINDS
+        "clean" - an excerpt starting at a random whole frame
+        "noisy" - the same with white noise at snr_db
+        "shifted" - an excerpt starting at a random sample, i.e. not aligned
+                    to the song's analysis frames, with noise at snr_db
+        "truncated" - a noisy excerpt of only a fifth of clip_seconds
+    rng : numpy.random.Generator
+    clip_seconds : float, length of the excerpt
+    snr_db : float, signal-to-noise ratio of the added noise, dB
+    frame_hop : int, samples between analysis frames (nfft - noverlap)
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if kind not in QUERY_KINDS:
+        raise ValueError(f"kind must be one of {QUERY_KINDS}, not {kind!r}")
+    if kind == "truncated":
+        clip_seconds /= 5
+    length = min(int(clip_seconds * rate), samples.size)
+    start = int(rng.integers(samples.size - length + 1))
+    if kind in ("clean", "noisy"):
+        start -= start % frame_hop
+    clip = samples[start:start + length]
+    if kind != "clean":
+        noise_power = np.mean(clip ** 2) / 10 ** (snr_db / 10)
+        clip = clip + rng.normal(0, np.sqrt(noise_power), clip.size).astype(np.float32)
+    return clip
+
+
+class StageTimer:
+    """Accumulates wall-clock time per named stage"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def time(self, stage, function, *args, **kwargs):
+        """Calls function(*args, **kwargs), adding its run time to stage"""
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds[stage] += time.perf_counter() - start
+        self.calls[stage] += 1
+        return result
+
+    def summary(self):
+        return {stage: {"seconds": self.seconds[stage], "calls": self.calls[stage],
+                        "ms_per_call": 1000 * self.seconds[stage] / self.calls[stage]}
+                for stage in self.seconds}
+
+
+def fingerprint(samples, rate, params, timer):
+    """Runs the front end of `frontend.fingerprint_samples` one timed stage at a time"""
+    spectrogram = timer.time("spectrogram", fe.spectrogram, samples, rate, params)
+    neighborhood = fp.binary_structure(2, 1)
+    peaks = timer.time("local_peak_array", fp.local_peak_array, spectrogram, neighborhood,
+                       fe.peak_threshold(spectrogram, params))
+    peaks = timer.time("apply_peak_budget", fe.apply_peak_budget, peaks,
+                       spectrogram[peaks[:, 0], peaks[:, 1]], params)
+    return timer.time("fanout_pairs", fp.fanout_pairs, peaks, params.fanout_value, len(peaks))
+
+
+def run(num_songs=20, song_seconds=30, num_queries=50, clip_seconds=5, snr_db=10, seed=0,
+        params=fe.DEFAULT_PARAMS, workdir=None, compression=None):
+    """Builds a synthetic catalog, ingests it and queries it
+
+    Parameters
+    ----------
+    num_songs : int, size of the catalog
+    song_seconds : float, length of every song
+    num_queries : int, queries of each kind in QUERY_KINDS
+    clip_seconds, snr_db : see `make_query`
+    seed : int, seeds the catalog and the queries
+    params : frontend.AnalysisParams, analysis settings of the database
+    workdir : str or Path, optional; where the catalog and database are
+              written, a temporary directory by default
+    compression : str, optional; index compression, see index_storage.create_database
+
+    Returns
+    -------
+    dict
+        the configuration, per-stage timings, index size, and per query kind the
+        recall, the share of queries whose song is among match_song's ranked
+        candidates and the mean confidence of the best candidate
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(workdir or tmp)
+        database_path = workdir / "database"
+        timer = StageTimer()
+
+        paths = make_corpus(workdir / "songs", num_songs, song_seconds, seed)
+        storage.create_database(database_path, params, compression=compression)
+        metadata, database = intFunc.meta_load(database_path)
+
+        songs = []
+        total_fingerprints = 0
+        for song_id, path in enumerate(paths):
+            samples, rate = timer.time("load_samples", c.load_samples, path, params.sampling_rate)
+            songs.append(samples)
+            fingerprints = fingerprint(samples, rate, params, timer)
+            total_fingerprints += len(fingerprints)
+            database = timer.time("add_fingerprints", mf.add_fingerprints, fingerprints, song_id, database)
+            metadata[song_id] = sm.make_metadata(len(fingerprints), title=path.stem)
+        timer.time("meta_save", intFunc.meta_save, metadata, database, database_path)
+        timer.time("compact_database", storage.compact_database, database_path)
+        metadata, database = timer.time("meta_load", intFunc.meta_load, database_path)
+
+        lookups_match = check_lookups(database, np.random.default_rng(seed + 2))
+        rng = np.random.default_rng(seed + 1)
+        recall, top_k_recall, confidence = {}, {}, {}
+        for kind in QUERY_KINDS:
+            correct = ranked = 0
+            confidences = []
+            for _ in range(num_queries):
+                song_id = int(rng.integers(num_songs))
+                clip = make_query(songs[song_id], params.sampling_rate, kind, rng, clip_seconds, snr_db,
+                                  params.nfft - params.noverlap)
+                fingerprints = fingerprint(clip, params.sampling_rate, params, timer)
+                hashes, times = fi.pack_fingerprints(fingerprints)
+                matches = timer.time("match_song", mf.match_song, hashes, times, database)
+                # a match counts as find_song would report it
+                correct += bool(matches) and matches[0].song_id == song_id \
+                    and matches[0].confidence >= intFunc.MIN_CONFIDENCE
+                ranked += any(match.song_id == song_id for match in matches)
+                confidences.append(matches[0].confidence if matches else 0.0)
+            recall[kind] = correct / num_queries
+            top_k_recall[kind] = ranked / num_queries
+            confidence[kind] = float(np.mean(confidences))
+
+        return {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "config": {"songs": num_songs, "song_seconds": song_seconds, "queries_per_kind": num_queries,
+                       "clip_seconds": clip_seconds, "snr_db": snr_db, "seed": seed,
+                       "params": params._asdict(), "compression": compression},
+            "stages": timer.summary(),
+            "fingerprints": total_fingerprints,
+            "index_postings": database.num_postings,
+            "index_bytes": sum(path.stat().st_size for path in database_path.glob("seg-*/*.npy")),
+            "recall": recall,
+            "top_k_recall": top_k_recall,
+            "mean_confidence": confidence,
+            "lookups_match": lookups_match,
+        }
+
+
+def check_lookups(database, rng, num_queries=1000):
+    """Checks the lookups of every segment against a plain index rebuilt from its postings
+
+    The queries mix keys of the segment with random hashes, and include a
+    batch lying entirely below the segment's first key and one entirely above
+    its last, which a bit-packed segment must answer without finding any block.
+
+    Parameters
+    ----------
+    database : fingerprint_index.SegmentedIndex
+    rng : numpy.random.Generator
+    num_queries : int, keys and random hashes looked up per segment
+
+    Returns
+    -------
+    bool, True if every segment returned the same postings as its reference
+    """
+    for segment in database.all_segments():
+        hashes, song_ids, times = segment.postings()
+        reference = fi.FingerprintIndex.from_postings(hashes, song_ids, times)
+        keys = reference.hashes
+        if keys.size == 0:
+            continue
+        below = np.arange(min(int(keys[0]), 8), dtype=fi.HASH_DTYPE)
+        above = keys[-1] + np.arange(1, 9, dtype=fi.HASH_DTYPE)
+        mixed = np.concatenate([rng.choice(keys, num_queries),
+                                rng.integers(0, 1 << 48, num_queries).astype(fi.HASH_DTYPE)])
+        for queries in (below, above, mixed):
+            for got, expected in zip(segment.lookup(queries), reference.lookup(queries)):
+                if not np.array_equal(got, expected):
+                    return False
+            if not np.array_equal(segment.posting_counts(queries), reference.posting_counts(queries)):
+                return False
+    return True
+
+
+def compare_stft(song_seconds=30, clip_seconds=5, num_clips=64, seed=0, params=fe.DEFAULT_PARAMS, repeats=5):
+    """Times stft against mlab.specgram on a synthetic song and a batch of clips
+
+    Parameters
+    ----------
+    song_seconds : float, length of the song
+    clip_seconds : float, length of every clip
+    num_clips : int, clips in the batch
+    seed : int
+    params : frontend.AnalysisParams, supplies the rate and frame layout
+    repeats : int, the best of this many runs is reported
+
+    Returns
+    -------
+    dict
+        best seconds of each implementation, the speedups and the largest
+        relative error of stft's powers (over bins above 1e-6 of the peak)
+    """
+    import matplotlib.mlab as mlab
+
+    rng = np.random.default_rng(seed)
+    rate, nfft, noverlap = params.sampling_rate, params.nfft, params.noverlap
+    song = make_song(rng, song_seconds, rate)
+    clips = [make_query(song, rate, "shifted", rng, clip_seconds) for _ in range(num_clips)]
+
+    def reference(samples):
+        return mlab.specgram(samples, NFFT=nfft, Fs=rate, window=mlab.window_hanning, noverlap=noverlap)[0]
+
+    def best(function, *args):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    expected, actual = reference(song), stft.power_spectrogram(song, rate, nfft, noverlap)
+    significant = expected > 1e-6 * expected.max()
+    error = np.abs(actual[significant] - expected[significant]) / expected[significant]
+
+    song_mlab = best(reference, song)
+    song_stft = best(stft.power_spectrogram, song, rate, nfft, noverlap)
+    clips_mlab = best(lambda: [reference(clip) for clip in clips])
+    clips_loop = best(lambda: [stft.power_spectrogram(clip, rate, nfft, noverlap) for clip in clips])
+    clips_batch = best(stft.power_spectrograms, clips, rate, nfft, noverlap)
+    return {
+        "song_seconds": song_seconds, "clips": num_clips, "clip_seconds": clip_seconds,
+        "workers": stft.DEFAULT_WORKERS,
+        "seconds": {"song_mlab": song_mlab, "song_stft": song_stft, "clips_mlab": clips_mlab,
+                    "clips_stft": clips_loop, "clips_stft_batch": clips_batch},
+        "speedup": {"song": song_mlab / song_stft, "clips": clips_mlab / clips_loop,
+                    "clips_batch": clips_mlab / clips_batch},
+        "max_relative_error": float(error.max()),
+        "median_relative_error": float(np.median(error)),
+    }
+
+
+def print_stft_results(results):
+    seconds, speedup = results["seconds"], results["speedup"]
+    print(f"{results['song_seconds']:g} s song:      mlab {1000 * seconds['song_mlab']:8.1f} ms, "
+          f"stft {1000 * seconds['song_stft']:8.1f} ms ({speedup['song']:.1f}x)")
+    print(f"{results['clips']} x {results['clip_seconds']:g} s clips: mlab {1000 * seconds['clips_mlab']:8.1f} ms, "
+          f"stft {1000 * seconds['clips_stft']:8.1f} ms ({speedup['clips']:.1f}x), "
+          f"batched {1000 * seconds['clips_stft_batch']:8.1f} ms ({speedup['clips_batch']:.1f}x)")
+    print(f"relative error: max {results['max_relative_error']:.1e}, median {results['median_relative_error']:.1e} "
+          f"({results['workers']} FFT worker(s))")
+
+
+def _git_commit():
+    """Returns the current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'stage':<20} {'calls':>6} {'seconds':>9} {'ms/call':>9}")
+    for stage, timing in results["stages"].items():
+        print(f"{stage:<20} {timing['calls']:>6} {timing['seconds']:>9.3f} {timing['ms_per_call']:>9.2f}")
+    print(f"\n{results['fingerprints']} fingerprints, {results['index_postings']} postings, "
+          f"{results['index_bytes'] / 2 ** 20:.2f} MB index")
+    for kind, value in results["recall"].items():
+        print(f"recall ({kind}): {value:.2%}, in the top-K: {results['top_k_recall'][kind]:.2%}, "
+              f"mean confidence {results['mean_confidence'][kind]:.2f}")
+    if not results["lookups_match"]:
+        print("WARNING: index lookups differ from a plain rebuild of the postings")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest and query benchmark on synthetic audio")
+    parser.add_argument("--songs", type=int, default=20)
+    parser.add_argument("--song-seconds", type=float, default=30)
+    parser.add_argument("--queries", type=int, default=50, help="queries of each kind")
+    parser.add_argument("--clip-seconds", type=float, default=5)
+    parser.add_argument("--snr-db", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--params", choices=["default", "legacy"], default="default")
+    parser.add_argument("--compress", action="store_true", help="store the index bit-packed")
+    parser.add_argument("--stft", action="store_true", help="only compare stft with mlab.specgram")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    params = fe.LEGACY_PARAMS if args.params == "legacy" else fe.DEFAULT_PARAMS
+    if args.stft:
+        results = compare_stft(args.song_seconds, args.clip_seconds, seed=args.seed, params=params)
+        print_stft_results(results)
+    else:
+        results = run(args.songs, args.song_seconds, args.queries, args.clip_seconds, args.snr_db,
+                      args.seed, params, compression="bitpack" if args.compress else None)
+        print_results(results)
+    if args.json:
+        with open(args.json, mode="w") as opened_file:
+            json.dump(results, opened_file, indent=2)
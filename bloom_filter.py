@@ -0,0 +1,153 @@
+"""Bloom Filter
+blocked Bloom filters that reject fingerprint hashes absent from an index segment
+
+Most fingerprints of a noisy clip are in no song, and every segment a query
+searches pays a binary search (or, for a compressed segment, a block decode)
+to find that out. Each segment is written with a filter of its keys, and
+lookups first drop the query hashes the filter rules out.
+
+The filter is a split-block Bloom filter (as in Parquet): an array of 256-bit
+blocks, each made of eight 32-bit words. A key is mixed with the MurmurHash3
+finalizer; the high half of the mix picks one block and the low half sets or
+tests one bit in each of its eight words, chosen by multiplying it with eight
+odd constants. A test therefore touches a single cache line and vectorizes
+as one gather of whole blocks and a few shifts and masks.
+
+blocks   uint32, shape-(B, 8)
+
+With bits_per_key bits per key (B = ceil(K * bits_per_key / 256)) the false-
+positive rate is about 3.3% at 8, 1.3% at 10, 0.54% at 12 and 0.13% at 16
+bits per key;
+`expected_false_positive_rate` computes it and `measured_false_positive_rate`
+probes it. False negatives never happen.
+"""
+import math
+
+import numpy as np
+
+from fingerprint_index import HASH_DTYPE
+
+DEFAULT_BITS_PER_KEY = 10
+WORDS = 8
+_SALT = np.array([0x47B6137B, 0x44974D91, 0x8824AD5B, 0xA2B7289D,
+                  0x705495C7, 0x2DF1424B, 0x9EFC4947, 0x5C6BFB31], dtype=np.uint32)
+
+
+def mix(hashes):
+    """Returns the MurmurHash3 64-bit finalizer of every hash, spreading packed keys over all bits"""
+    mixed = np.asarray(hashes, dtype=HASH_DTYPE).copy()
+    mixed ^= mixed >> np.uint64(33)
+    mixed *= np.uint64(0xFF51AFD7ED558CCD)
+    mixed ^= mixed >> np.uint64(33)
+    mixed *= np.uint64(0xC4CEB9FE1A85EC53)
+    mixed ^= mixed >> np.uint64(33)
+    return mixed
+
+
+def _is_sorted_unique(hashes):
+    return bool(np.all(hashes[1:] > hashes[:-1]))
+
+
+class BlockedBloomFilter:
+    """Split-block Bloom filter over packed fingerprint hashes, see the module docstring
+
+    Build one with `from_hashes`. blocks may be memory-mapped.
+
+    Parameters
+    ----------
+    blocks : numpy.ndarray, uint32, shape-(B, 8)
+    num_keys : int, number of distinct keys added; only used for statistics
+    """
+
+    def __init__(self, blocks, num_keys=0):
+        self.blocks = np.asarray(blocks)
+        self.num_keys = int(num_keys)
+
+    @classmethod
+    def from_hashes(cls, hashes, bits_per_key=DEFAULT_BITS_PER_KEY):
+        """Builds the filter of a set of keys
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray, packed fingerprint hashes, e.g. the sorted keys
+                 of a segment (duplicates are fine)
+        bits_per_key : float, filter bits per distinct key
+
+        Returns
+        -------
+        BlockedBloomFilter
+        """
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        num_keys = hashes.size if _is_sorted_unique(hashes) else np.unique(hashes).size
+        num_blocks = max(1, math.ceil(num_keys * bits_per_key / (32 * WORDS)))
+        words = np.zeros((num_blocks, WORDS), dtype=np.uint32)
+        blocks, keys = cls._locate(hashes, num_blocks)
+        for word in range(WORDS):
+            # set one bit per key in this word of every block, through a bitmap of
+            # the word column, then pack it back into little-endian uint32 words
+            bitmap = np.zeros(num_blocks * 32, dtype=bool)
+            bitmap[blocks * 32 + ((keys * _SALT[word]) >> np.uint32(27))] = True
+            words[:, word] = np.packbits(bitmap, bitorder="little").view("<u4")
+        return cls(words, num_keys)
+
+    @staticmethod
+    def _locate(hashes, num_blocks):
+        """Returns the block of every hash and the 32 bits of the mix that pick its bit in each word"""
+        mixed = mix(hashes)
+        blocks = ((mixed >> np.uint64(32)) * np.uint64(num_blocks)) >> np.uint64(32)
+        return blocks.astype(np.int64), (mixed & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+    @property
+    def num_blocks(self):
+        return self.blocks.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes
+
+    @property
+    def bits_per_key(self):
+        return 8 * self.nbytes / max(self.num_keys, 1)
+
+    def contains(self, query_hashes):
+        """Tests every query hash; False means the hash is certainly not a key
+
+        Returns
+        -------
+        numpy.ndarray of bool, shape-(Q,)
+        """
+        query_hashes = np.asarray(query_hashes, dtype=HASH_DTYPE)
+        blocks, keys = self._locate(query_hashes, self.num_blocks)
+        # shape-(8, Q) so the arithmetic runs along contiguous rows
+        masks = np.uint32(1) << ((_SALT[:, None] * keys) >> np.uint32(27))
+        missing = ~np.take(self.blocks, blocks, axis=0).T & masks
+        return np.bitwise_or.reduce(missing, axis=0) == 0
+
+    def expected_false_positive_rate(self):
+        """Returns the probability that a hash which is not a key passes, given the load of the filter
+
+        Keys land in blocks as Poisson(num_keys / num_blocks); a block holding
+        n keys passes a foreign hash with probability (1 - (31/32) ** n) ** 8.
+        """
+        if self.num_keys == 0:
+            return 0.0
+        load = self.num_keys / self.num_blocks
+        return sum(math.exp(n * math.log(load) - load - math.lgamma(n + 1)) * (1 - (1 - 1 / 32) ** n) ** WORDS
+                   for n in range(1, int(load + 10 * math.sqrt(load) + 10)))
+
+    def measured_false_positive_rate(self, num_probes=100000, seed=0):
+        """Returns the fraction of random 64-bit hashes that pass
+
+        Random hashes are almost never keys (the keys use 48 of the 64 bits
+        and are a tiny fraction of that space), so this estimates the false-
+        positive rate directly.
+        """
+        rng = np.random.default_rng(seed)
+        probes = rng.integers(0, np.iinfo(np.int64).max, num_probes, dtype=np.int64).astype(HASH_DTYPE)
+        return float(np.count_nonzero(self.contains(probes))) / num_probes
+
+    def statistics(self):
+        """Returns the keys, memory, bits per key and expected/measured false-positive rates as a dict"""
+        return {"keys": self.num_keys, "bytes": self.nbytes, "bits_per_key": self.bits_per_key,
+                "expected_false_positive_rate": self.expected_false_positive_rate(),
+                "measured_false_positive_rate": self.measured_false_positive_rate()}
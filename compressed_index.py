@@ -0,0 +1,393 @@
+"""Compressed Index
+bit-packed fingerprint index segments that are decoded on demand at query time
+
+A CompressedIndex holds the same keys and postings as a FingerprintIndex, in
+blocks of up to BLOCK_KEYS consecutive keys. Every block stores four bit-packed
+streams, each with one bit width for the whole block (the width of its
+largest value):
+
+    hash deltas      hash - previous hash in the block (0 for the first key)
+    list lengths     number of postings of each key
+    song deltas      song_id - previous song_id in the same posting list
+                     (the first posting of a list stores the song_id itself)
+    times            t_anchor - smallest t_anchor in the block
+
+Posting lists are sorted by (song_id, t_anchor), so song deltas are small for
+long lists. Per block the index keeps only the first hash, where its bits
+start, where its keys and postings start in the uncompressed order, the four
+widths and the time base:
+
+block_hashes    uint64, shape-(B,)
+block_bits      int64, shape-(B + 1,), first bit of each block in data
+block_keys      int64, shape-(B + 1,), first key of each block
+block_postings  int64, shape-(B + 1,), first posting of each block
+widths          uint8, shape-(B, 4), bits per value of the four streams
+time_base       int32, shape-(B,)
+data            uint64, the streams of every block, back to back, padded
+                with one spare word so any value can be read with two
+                aligned word loads
+
+A lookup binary-searches block_hashes, decodes the hashes and list lengths
+of the blocks the query hits, and then decodes only the postings of the
+matching keys. All decoding is vectorized over the whole query.
+"""
+import numpy as np
+
+from fingerprint_index import FingerprintIndex, HASH_DTYPE, SONG_DTYPE, TIME_DTYPE, filter_candidates
+
+BLOCK_KEYS = 32
+ARRAYS = ("block_hashes", "block_bits", "block_keys", "block_postings", "widths", "time_base", "data")
+
+# largest number of bits packed per chunk of blocks while encoding
+_CHUNK_BITS = 1 << 26
+
+
+def bit_widths(values):
+    """Returns the number of bits needed to store each non-negative value (0 for 0)"""
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.zeros(values.shape, dtype=np.uint8)
+    nonzero = values > 0
+    # float64 rounding can be off by one for values near powers of two above 2**53
+    widths[nonzero] = np.floor(np.log2(values[nonzero].astype(np.float64))).astype(np.uint8) + 1
+    too_small = nonzero & ((values >> widths.astype(np.uint64)) > 0)
+    widths[too_small] += 1
+    return widths
+
+
+def read_bits(data, positions, widths):
+    """Reads one value of widths[i] bits starting at bit positions[i] of data
+
+    Parameters
+    ----------
+    data : numpy.ndarray of uint64, bit stream in little-endian bit order,
+           with a spare word at the end
+    positions : numpy.ndarray of int64
+    widths : numpy.ndarray of ints, less than 64
+
+    Returns
+    -------
+    numpy.ndarray of uint64
+    """
+    words = positions >> 6
+    shifts = (positions & 63).astype(np.uint64)
+    # shifting a uint64 by 64 gives 0 in NumPy, which is what an aligned value needs
+    values = (data[words] >> shifts) | (data[words + 1] << (np.uint64(64) - shifts))
+    return values & ((np.uint64(1) << np.asarray(widths, dtype=np.uint64)) - np.uint64(1))
+
+
+def write_bits(values, positions, widths, num_bits):
+    """Packs values into a little-endian bit stream of num_bits bits
+
+    Parameters
+    ----------
+    values : numpy.ndarray of uint64
+    positions : numpy.ndarray of int64, first bit of each value
+    widths : numpy.ndarray of ints, bits of each value
+    num_bits : int, length of the stream, a multiple of 8
+
+    Returns
+    -------
+    numpy.ndarray of uint8, num_bits // 8 bytes
+    """
+    bits = np.zeros(num_bits, dtype=np.uint8)
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.asarray(widths)
+    for bit in range(int(widths.max(initial=0))):
+        has_bit = widths > bit
+        bits[positions[has_bit] + bit] = (values[has_bit] >> np.uint64(bit)) & np.uint64(1)
+    return np.packbits(bits, bitorder="little")
+
+
+def _segment_starts(lengths):
+    """Returns the start of each run of the given lengths in their concatenation"""
+    return np.cumsum(lengths) - lengths
+
+
+class CompressedIndex:
+    """Read-only bit-packed equivalent of a FingerprintIndex, see the module docstring
+
+    Build one with `from_index`. The arrays are the ones listed in ARRAYS and
+    may be memory-mapped. Like FingerprintIndex, it may carry a key_filter,
+    which spares lookups the block decoding of hashes the filter rules out.
+    """
+
+    def __init__(self, block_hashes, block_bits, block_keys, block_postings, widths, time_base, data,
+                 num_songs=0):
+        # plain ndarray views of memory-mapped arrays index several times faster
+        self.block_hashes = np.asarray(block_hashes)
+        self.block_bits = np.asarray(block_bits)
+        self.block_keys = np.asarray(block_keys)
+        self.block_postings = np.asarray(block_postings)
+        self.widths = np.asarray(widths)
+        self.time_base = np.asarray(time_base)
+        self.data = np.asarray(data)
+        self.num_songs = int(num_songs)
+        self.key_filter = None
+
+    @classmethod
+    def from_index(cls, index, block_keys=BLOCK_KEYS):
+        """Compresses a FingerprintIndex
+
+        Parameters
+        ----------
+        index : fingerprint_index.FingerprintIndex
+        block_keys : int, keys per block; smaller blocks decode less per
+                     lookup but add about 37 bytes of block data each
+
+        Returns
+        -------
+        CompressedIndex
+        """
+        num_keys = len(index)
+        starts = np.arange(0, num_keys, block_keys)
+        key_bounds = np.append(starts, num_keys).astype(np.int64)
+        offsets = np.asarray(index.offsets, dtype=np.int64)
+        posting_bounds = offsets[key_bounds]
+        num_blocks = starts.size
+
+        hashes = np.asarray(index.hashes, dtype=HASH_DTYPE)
+        song_ids = np.asarray(index.song_ids, dtype=np.int64)
+        times = np.asarray(index.times, dtype=np.int64)
+        lengths = np.diff(offsets)
+
+        # block of every key and of every posting
+        key_block = np.repeat(np.arange(num_blocks), np.diff(key_bounds))
+        posting_block = np.repeat(np.arange(num_blocks), np.diff(posting_bounds))
+
+        hash_deltas = np.zeros(num_keys, dtype=np.uint64)
+        hash_deltas[1:] = hashes[1:] - hashes[:-1]
+        hash_deltas[starts] = 0
+
+        song_deltas = np.zeros(song_ids.size, dtype=np.int64)
+        song_deltas[1:] = song_ids[1:] - song_ids[:-1]
+        list_starts = offsets[:-1][lengths > 0]
+        song_deltas[list_starts] = song_ids[list_starts]
+
+        time_base = np.zeros(num_blocks, dtype=np.int64)
+        if times.size:
+            nonempty = np.diff(posting_bounds) > 0
+            time_base[nonempty] = np.minimum.reduceat(times, posting_bounds[:-1][nonempty])
+        time_values = times - time_base[posting_block]
+
+        streams = [(hash_deltas, key_block), (lengths, key_block),
+                   (song_deltas, posting_block), (time_values, posting_block)]
+        widths = np.zeros((num_blocks, 4), dtype=np.uint8)
+        for column, (values, block) in enumerate(streams):
+            if values.size:
+                np.maximum.at(widths[:, column], block, bit_widths(values))
+
+        # bits of each stream in each block, with every block padded to a whole byte
+        counts = np.stack([np.diff(key_bounds), np.diff(key_bounds),
+                           np.diff(posting_bounds), np.diff(posting_bounds)], axis=1)
+        stream_bits = counts * widths
+        block_sizes = (stream_bits.sum(axis=1) + 7) // 8 * 8
+        block_bits = np.append(0, np.cumsum(block_sizes)).astype(np.int64)
+        stream_starts = block_bits[:-1, None] + np.cumsum(stream_bits, axis=1) - stream_bits
+
+        # pack whole blocks a chunk at a time to bound memory
+        chunks = []
+        first = 0
+        while first < num_blocks:
+            last = max(int(np.searchsorted(block_bits, block_bits[first] + _CHUNK_BITS, side="right")) - 1,
+                       first + 1)
+            chunk_values, chunk_positions, chunk_widths = [], [], []
+            for column, (values, block) in enumerate(streams):
+                bounds = key_bounds if column < 2 else posting_bounds
+                lo, hi = bounds[first], bounds[last]
+                rows = block[lo:hi]
+                rank = np.arange(lo, hi) - bounds[rows]
+                chunk_values.append(values[lo:hi].astype(np.uint64))
+                chunk_positions.append(stream_starts[rows, column] + rank * widths[rows, column]
+                                       - block_bits[first])
+                chunk_widths.append(widths[rows, column])
+            chunks.append(write_bits(np.concatenate(chunk_values), np.concatenate(chunk_positions),
+                                     np.concatenate(chunk_widths), int(block_bits[last] - block_bits[first])))
+            first = last
+
+        data = np.concatenate(chunks + [np.zeros(16, dtype=np.uint8)])
+        data = np.concatenate([data, np.zeros(-data.size % 8, dtype=np.uint8)]).view("<u8").astype(np.uint64)
+        return cls(hashes[starts], block_bits, key_bounds, posting_bounds, widths,
+                   time_base.astype(TIME_DTYPE), data, index.num_songs)
+
+    def __len__(self):
+        return int(self.block_keys[-1])
+
+    @property
+    def num_postings(self):
+        return int(self.block_postings[-1])
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def _stream_starts(self, blocks):
+        """Returns the first bit of each of the four streams of blocks, shape-(len(blocks), 4)"""
+        num_keys = np.diff(self.block_keys)[blocks]
+        num_postings = np.diff(self.block_postings)[blocks]
+        widths = self.widths[blocks].astype(np.int64)
+        stream_bits = np.stack([num_keys, num_keys, num_postings, num_postings], axis=1) * widths
+        return self.block_bits[blocks, None] + np.cumsum(stream_bits, axis=1) - stream_bits
+
+    def _find_keys(self, query_hashes):
+        """Locates query hashes in the index
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, ...]
+            query_pos (queries that were found), blocks (block of each found
+            key), lengths (its posting-list length), first (position of its
+            first posting within the block) and stream_starts (see
+            `_stream_starts`, one row per found key)
+        """
+        query_hashes = np.asarray(query_hashes, dtype=HASH_DTYPE)
+        empty = np.zeros(0, dtype=np.int64)
+        candidates = filter_candidates(self.key_filter, query_hashes)
+        if self.block_hashes.size == 0 or candidates.size == 0:
+            return empty, empty, empty, empty, np.zeros((0, 4), dtype=np.int64)
+        query_hashes = query_hashes[candidates]
+
+        # hashes below the first key of the index are in no block
+        query_blocks = np.searchsorted(self.block_hashes, query_hashes, side="right") - 1
+        inside = np.flatnonzero(query_blocks >= 0)
+        candidates, query_hashes = candidates[inside], query_hashes[inside]
+        blocks = np.unique(query_blocks[inside])
+        if blocks.size == 0:
+            return empty, empty, empty, empty, np.zeros((0, 4), dtype=np.int64)
+        num_keys = np.diff(self.block_keys)[blocks]
+        starts = self._stream_starts(blocks)
+        widths = self.widths[blocks]
+
+        # decode the hashes and lengths of every hit block into a (blocks, slots) table;
+        # rows hold disjoint increasing hash ranges, so the flattened table is sorted.
+        # Slots past the end of the last block read position 0 and are masked.
+        slots = int(num_keys.max())
+        valid = np.arange(slots) < num_keys[:, None]
+        positions = starts[:, :2, None] + np.arange(slots) * widths[:, :2, None].astype(np.int64)
+        positions[~np.broadcast_to(valid[:, None, :], positions.shape)] = 0
+        values = read_bits(self.data, positions, np.broadcast_to(widths[:, :2, None], positions.shape))
+        table = np.asarray(self.block_hashes, dtype=HASH_DTYPE)[blocks, None] + np.cumsum(values[:, 0], axis=1)
+        table[~valid] = np.iinfo(np.uint64).max
+        lengths = values[:, 1].astype(np.int64)
+        lengths[~valid] = 0
+
+        flat = table.ravel()
+        slot = np.minimum(np.searchsorted(flat, query_hashes), flat.size - 1)
+        query_pos = np.flatnonzero(flat[slot] == query_hashes)
+        row, col = np.divmod(slot[query_pos], slots)
+        first = (np.cumsum(lengths, axis=1) - lengths)[row, col]
+        return candidates[query_pos], blocks[row], lengths[row, col], first, starts[row]
+
+    def posting_counts(self, query_hashes):
+        """Returns the posting-list length of every query hash, 0 for hashes not in the index"""
+        counts = np.zeros(np.size(query_hashes), dtype=np.int64)
+        query_pos, blocks, lengths, first, starts = self._find_keys(query_hashes)
+        counts[query_pos] = lengths
+        return counts
+
+    def lookup(self, query_hashes):
+        """Finds and decodes the postings of every query hash
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            query_pos, song_ids, times; see `FingerprintIndex.lookup`
+        """
+        query_pos, blocks, lengths, first, starts = self._find_keys(query_hashes)
+        song_ids, times = self._decode_postings(blocks, lengths, first, starts)
+        return np.repeat(query_pos, lengths), song_ids, times
+
+    def _decode_postings(self, blocks, lengths, first, starts):
+        """Decodes the posting lists of keys found by `_find_keys`
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray]
+            song_ids and times of every posting, list after list
+        """
+        total = int(lengths.sum())
+        list_starts = _segment_starts(lengths)
+        # position of every requested posting within its block
+        rank = np.arange(total) - np.repeat(list_starts, lengths) + np.repeat(first, lengths)
+        posting_blocks = np.repeat(blocks, lengths)
+        widths = self.widths[posting_blocks].astype(np.int64)
+        song_deltas = read_bits(self.data, np.repeat(starts[:, 2], lengths) + rank * widths[:, 2], widths[:, 2])
+        time_values = read_bits(self.data, np.repeat(starts[:, 3], lengths) + rank * widths[:, 3], widths[:, 3])
+
+        # undo the song deltas within every posting list
+        song_ids = np.cumsum(song_deltas.astype(np.int64))
+        song_ids -= np.repeat(song_ids[list_starts] - song_deltas[list_starts].astype(np.int64), lengths)
+        times = time_values.astype(np.int64) + np.asarray(self.time_base, dtype=np.int64)[posting_blocks]
+        return song_ids.astype(SONG_DTYPE), times.astype(TIME_DTYPE)
+
+    def decompress(self):
+        """Decodes the whole index into a FingerprintIndex"""
+        hashes, lengths = self.keys()
+        offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+        num_keys = np.diff(self.block_keys)
+        blocks = np.repeat(np.arange(num_keys.size), num_keys)
+        first = offsets[:-1] - np.asarray(self.block_postings[:-1], dtype=np.int64)[blocks]
+        starts = self._stream_starts(np.arange(num_keys.size))[blocks]
+        song_ids, times = self._decode_postings(blocks, lengths, first, starts)
+        return FingerprintIndex(hashes, offsets, song_ids, times, self.num_songs)
+
+    def _key_streams(self, lengths=False):
+        """Decodes the key-delta stream, and optionally the length stream, of every block
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray or None]
+            every key and, if lengths is True, its posting-list length
+        """
+        num_keys = np.diff(self.block_keys)
+        blocks = np.repeat(np.arange(num_keys.size), num_keys)
+        key_starts = np.asarray(self.block_keys[:-1])
+        rank = np.arange(len(self)) - key_starts[blocks]
+        widths = self.widths[blocks]
+        deltas = read_bits(self.data, self.block_bits[:-1][blocks] + rank * widths[:, 0].astype(np.int64),
+                           widths[:, 0])
+        sums = np.cumsum(deltas)
+        sums -= np.repeat(sums[key_starts] - deltas[key_starts], num_keys)
+        hashes = np.asarray(self.block_hashes, dtype=HASH_DTYPE)[blocks] + sums
+        if not lengths:
+            return hashes, None
+        # the length stream follows the key-delta stream of its block
+        length_starts = self.block_bits[:-1][blocks] + num_keys[blocks] * widths[:, 0].astype(np.int64)
+        return hashes, read_bits(self.data, length_starts + rank * widths[:, 1].astype(np.int64),
+                                 widths[:, 1]).astype(np.int64)
+
+    def key_hashes(self):
+        """Decodes every key of the index"""
+        return self._key_streams()[0]
+
+    def keys(self):
+        """Decodes every key of the index and its posting-list length, see `FingerprintIndex.keys`"""
+        return self._key_streams(lengths=True)
+
+    def postings(self):
+        """Decodes every posting, see `FingerprintIndex.postings`"""
+        index = self.decompress()
+        return index.posting_hashes(), index.song_ids, index.times
+
+    # the rest of the FingerprintIndex interface used by SegmentedIndex and
+    # statistics; both decode every key of the segment
+
+    @property
+    def hashes(self):
+        return self.key_hashes()
+
+    def posting_lengths(self):
+        return self.keys()[1]
+
+    def boundary_hashes(self, num_shards):
+        """Returns num_shards - 1 block-aligned hashes that split the keys into even ranges"""
+        cuts = np.arange(1, num_shards) * self.block_hashes.size // num_shards
+        return np.asarray(self.block_hashes, dtype=HASH_DTYPE)[cuts]
+
+    def split(self, bounds):
+        """Returns len(bounds) + 1 references to this index
+
+        A compressed index is not sliced by hash range: SegmentedIndex only
+        sends each shard the query hashes in its range, so every shard can
+        search the whole index.
+        """
+        return [self] * (np.size(bounds) + 1)
@@ -1,8 +1,15 @@
-import matplotlib.pyplot as plt
-from microphone import record_audio
-import librosa as lib
-import matplotlib.mlab as mlab
+"""Conversion
+decoding audio files and recording from the microphone
+
+librosa, soundfile, soxr, pyaudio and the microphone package are imported
+by the functions that use them, so importing this module is cheap and works
+on machines without a sound device.
+"""
 import numpy as np
+import time
+
+import instrumentation as inst
+import stft
 from pathlib import Path
 
 
@@ -22,20 +29,148 @@ def file_to_samples(song, sampling_rate=44100):
 
     """
 
+    import librosa as lib
+
     # Collect samples & rate using librosa
     samples, rate = lib.load(song, sr=sampling_rate, mono=True)
 
-    # Generate spectrogram using matplotlib
-    spectrogram, freqs, times = mlab.specgram(
-        samples,
-        NFFT=4096,
-        Fs=rate,
-        window=mlab.window_hanning,
-        noverlap=int(4096 / 2)
-    )
+    # Generate spectrogram (float32, same values as matplotlib's mlab.specgram)
+    spectrogram = stft.power_spectrogram(samples, rate, 4096, int(4096 / 2))
 
     return spectrogram, rate
 
+def load_samples(song, sampling_rate=44100):
+    """Decodes a song file into mono samples
+
+    Parameters:
+    -----------
+    song: str; audio file path / accepts pathlib.Path or raw string path
+    sampling_rate: int; Sampling Rate to resample to, Hz
+
+    Returns:
+    --------
+    samples: 1D numpy array
+    rate: int; sampling rate
+
+    Notes:
+    ------
+    Formats libsndfile reads are decoded with soundfile and resampled with
+    soxr, which gives the same samples as librosa.load without importing
+    librosa; anything else (e.g. .m4a) falls back to librosa.
+    """
+
+    import soundfile as sf
+    import soxr
+
+    with inst.stage("decode"):
+        try:
+            samples, rate = sf.read(str(song), dtype="float32", always_2d=True)
+        except RuntimeError:  # soundfile.LibsndfileError; not a format libsndfile reads
+            import librosa as lib
+
+            return lib.load(song, sr=sampling_rate, mono=True)
+        samples = samples.mean(axis=1)
+        if rate != sampling_rate:
+            # librosa pads or trims the resampled signal to exactly this length
+            length = int(np.ceil(len(samples) * float(sampling_rate) / rate))
+            samples = soxr.resample(samples, rate, sampling_rate, quality="HQ")
+            samples = np.pad(samples[:length], (0, max(length - len(samples), 0)))
+        return samples, sampling_rate
+
+def record_samples(duration):
+    """Records mono samples from the microphone
+
+    Parameters:
+    -----------
+    duration: clip length, seconds
+
+    Returns:
+    --------
+    samples: 1D numpy array of int16 samples
+    rate: int; sampling rate
+    """
+
+    from microphone import record_audio
+
+    frames, rate = record_audio(duration)
+    return np.hstack([np.frombuffer(i, np.int16) for i in frames]), rate
+
+def stream_samples(song, sampling_rate=44100, block_seconds=10):
+    """Decodes a song file block by block instead of all at once
+
+    Parameters:
+    -----------
+    song: str; audio file path  / accepts pathlib.Path or raw string path
+    sampling_rate: int; Sampling Rate to resample to, Hz
+                        Defaults to 44100 Hz
+    block_seconds: float; length of audio decoded per block
+
+    Yields:
+    -------
+    samples: 1D numpy array; the next mono block of samples at sampling_rate
+
+    Notes:
+    ------
+    Resampling is done with a streaming soxr resampler that carries its state
+    across blocks, so memory use depends on block_seconds and not on the
+    length of the file.
+    """
+
+    import soundfile as sf
+    import soxr
+
+    with sf.SoundFile(str(song)) as audio:
+        resampler = None
+        if audio.samplerate != sampling_rate:
+            resampler = soxr.ResampleStream(audio.samplerate, sampling_rate, 1, dtype="float32")
+
+        block_size = int(block_seconds * audio.samplerate)
+        while True:
+            block = audio.read(block_size, dtype="float32", always_2d=True)
+            last = len(block) < block_size
+            samples = block.mean(axis=1)
+            if resampler is not None:
+                samples = resampler.resample_chunk(samples, last=last)
+            if len(samples):
+                yield samples
+            if last:
+                break
+
+def window_samples(song, sampling_rate=44100, window_seconds=10, hop_seconds=None):
+    """Cuts a long recording into (possibly overlapping) windows without decoding it all at once
+
+    Parameters:
+    -----------
+    song: str; audio file path  / accepts pathlib.Path or raw string path
+    sampling_rate: int; Sampling Rate to resample to, Hz
+    window_seconds: float; length of each window
+    hop_seconds: float; time between the starts of consecutive windows,
+                 defaults to window_seconds
+
+    Yields:
+    -------
+    start: float; start of the window in the recording, seconds
+    samples: 1D numpy array; the window's mono samples at sampling_rate
+             (the last window may be shorter)
+    """
+
+    window = int(window_seconds * sampling_rate)
+    hop = int((hop_seconds or window_seconds) * sampling_rate)
+    buffer = np.zeros(0, dtype=np.float32)
+    position = 0  # sample index of buffer[0] in the recording
+    skip = 0  # samples still to drop when hop is longer than window
+    for block in stream_samples(song, sampling_rate, block_seconds=max(window_seconds, 10)):
+        dropped = min(skip, len(block))
+        skip -= dropped
+        buffer = np.concatenate([buffer, block[dropped:]])
+        while len(buffer) >= window:
+            yield position / sampling_rate, buffer[:window]
+            skip = max(hop - len(buffer), 0)
+            buffer = buffer[hop:]
+            position += hop
+    if position == 0 or (skip == 0 and len(buffer) > window - hop):
+        yield position / sampling_rate, buffer
+
 def mic_to_samples(duration):
     """Records audio sample & converts to numpy array of Fourier coefficients
 
@@ -49,18 +184,81 @@ def mic_to_samples(duration):
     rate: int; sampling rate
     """
     
+    from microphone import record_audio
+
     # Record audio using Microphone
     frames, rate = record_audio(duration)
 
     # Generate samples using numpy
     samples = np.hstack([np.frombuffer(i, np.int16) for i in frames])
 
-    # Generate spectrogram using matplotlib
-    spectrogram, freqs, times = mlab.specgram(
-        samples,
-        NFFT=4096,
-        Fs=rate,
-        window=mlab.window_hanning,
-        noverlap=int(4096 / 2)
-    )    
-    return spectrogram, rate
\ No newline at end of file
+    # Generate spectrogram (float32, same values as matplotlib's mlab.specgram)
+    spectrogram = stft.power_spectrogram(samples, rate, 4096, int(4096 / 2))    
+    return spectrogram, rate
+
+class MicrophoneSource:
+    """Live microphone input, read in short chunks
+
+    One PyAudio input stream (the library the microphone package records
+    with) stays open while iterating and its callback queues every block as
+    it is captured, so no audio is lost while the caller processes the
+    previous chunk. Iterating yields (samples, rate) pairs, one per chunk,
+    until stopped by the caller, which closes the stream.
+
+    Parameters
+    ----------
+    chunk_seconds: float; length of each chunk
+    sampling_rate: int; Sampling Rate to record at, Hz
+    """
+
+    def __init__(self, chunk_seconds=0.5, sampling_rate=44100):
+        self.chunk_seconds = chunk_seconds
+        self.sampling_rate = sampling_rate
+
+    def __iter__(self):
+        import queue
+        import pyaudio
+
+        blocks = queue.Queue()
+
+        def callback(data, frame_count, time_info, status):
+            blocks.put(data)
+            return None, pyaudio.paContinue
+
+        audio = pyaudio.PyAudio()
+        try:
+            stream = audio.open(format=pyaudio.paInt16, channels=1, rate=self.sampling_rate, input=True,
+                                frames_per_buffer=max(1, int(self.chunk_seconds * self.sampling_rate)),
+                                stream_callback=callback)
+            try:
+                while True:
+                    yield np.frombuffer(blocks.get(), np.int16), self.sampling_rate
+            finally:
+                stream.stop_stream()
+                stream.close()
+        finally:
+            audio.terminate()
+
+
+class FileSource:
+    """Stand-in for MicrophoneSource that plays back an audio file in chunks
+
+    Parameters
+    ----------
+    song: str; audio file path / accepts pathlib.Path or raw string path
+    chunk_seconds: float; length of each chunk
+    sampling_rate: int; Sampling Rate of the chunks, Hz
+    realtime: bool; if True, wait chunk_seconds between chunks like a microphone would
+    """
+
+    def __init__(self, song, chunk_seconds=0.5, sampling_rate=44100, realtime=False):
+        self.song = song
+        self.chunk_seconds = chunk_seconds
+        self.sampling_rate = sampling_rate
+        self.realtime = realtime
+
+    def __iter__(self):
+        for samples in stream_samples(self.song, self.sampling_rate, self.chunk_seconds):
+            if self.realtime:
+                time.sleep(len(samples) / self.sampling_rate)
+            yield samples, self.sampling_rate
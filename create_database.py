@@ -1,5 +1,19 @@
-import pickle
+import argparse
 
-a = ({},{})
-with open("database.pickle", mode="wb") as opened_file:
-    pickle.dump(a, opened_file)
\ No newline at end of file
+import bloom_filter as bf
+import index_storage as storage
+
+parser = argparse.ArgumentParser(description="Create an empty song database")
+parser.add_argument("path", nargs="?", default="database")
+parser.add_argument("--shards", type=int, default=1,
+                    help="hash ranges each query is searched in parallel; about one per core")
+parser.add_argument("--max-postings", type=int,
+                    help="skip query fingerprints with more postings than this (see index_report.py)")
+parser.add_argument("--weighting", choices=["idf"], help="weight votes by how rare their fingerprint is")
+parser.add_argument("--compress", action="store_true",
+                    help="store the index bit-packed, about 4x smaller for somewhat slower lookups")
+parser.add_argument("--filter-bits", type=float, default=bf.DEFAULT_BITS_PER_KEY,
+                    help="bits per key of the Bloom filters in front of large and compressed segments; 0 for none")
+args = parser.parse_args()
+storage.create_database(args.path, shards=args.shards, max_postings=args.max_postings, weighting=args.weighting,
+                        compression="bitpack" if args.compress else None, filter_bits=args.filter_bits)
@@ -0,0 +1,141 @@
+"""Density Report
+index size vs. recall for different peak and fingerprint budgets
+
+Fingerprints every song in a folder with each combination of peaks_per_second
+and fanout_value, builds an in-memory index, and matches noisy excerpts of the
+songs against it. Prints one row per combination: fingerprints per hour of
+audio, index size, recall and query time.
+
+Usage: python density_report.py SONG_DIR [--budgets 10,20,30,50] [--fanouts 5,10,15]
+                                         [--queries 50] [--clip-seconds 5] [--snr-db 10]
+                                         [--json report.json]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import conversion as c
+import frontend as fe
+import manageFingerprints as mf
+from fingerprint_index import FingerprintIndex, SONG_DTYPE, pack_fingerprints
+from interface_functions import read_song_list
+
+
+def make_queries(songs, num_queries, clip_seconds, snr_db, rate, seed=0):
+    """Cuts random excerpts out of songs and adds white noise
+
+    Parameters
+    ----------
+    songs : list of numpy.ndarray, decoded songs
+    num_queries : int
+    clip_seconds : float, length of each excerpt
+    snr_db : float, signal-to-noise ratio of the added noise, dB
+    rate : int, sampling rate of songs, Hz
+
+    Returns
+    -------
+    list of (song_id, samples)
+    """
+    rng = np.random.default_rng(seed)
+    clip_length = int(clip_seconds * rate)
+    queries = []
+    for _ in range(num_queries):
+        song_id = int(rng.integers(len(songs)))
+        song = songs[song_id]
+        start = int(rng.integers(max(len(song) - clip_length, 1)))
+        clip = song[start:start + clip_length]
+        noise_power = np.mean(clip ** 2) / 10 ** (snr_db / 10)
+        queries.append((song_id, clip + rng.normal(0, np.sqrt(noise_power), len(clip))))
+    return queries
+
+
+def evaluate(params, songs, queries):
+    """Builds an index of songs with params and measures recall on queries
+
+    Returns
+    -------
+    dict
+    """
+    rate = params.sampling_rate
+    hashes, song_ids, times = [], [], []
+    for song_id, samples in enumerate(songs):
+        song_hashes, song_times = pack_fingerprints(fe.fingerprint_samples(samples, rate, params))
+        hashes.append(song_hashes)
+        song_ids.append(np.full(song_hashes.size, song_id, dtype=SONG_DTYPE))
+        times.append(song_times)
+    index = FingerprintIndex.from_postings(np.concatenate(hashes), np.concatenate(song_ids),
+                                           np.concatenate(times), len(songs))
+
+    correct = 0
+    start = time.perf_counter()
+    for song_id, samples in queries:
+        tallies = mf.tally_fingerprints(fe.fingerprint_samples(samples, rate, params), index)
+        correct += mf.find_song_id(tallies, 0, 1) == song_id
+    query_seconds = time.perf_counter() - start
+
+    audio_hours = sum(len(samples) for samples in songs) / rate / 3600
+    return {
+        "peaks_per_second": params.peaks_per_second,
+        "fanout_value": params.fanout_value,
+        "fingerprints": index.num_postings,
+        "fingerprints_per_hour": index.num_postings / audio_hours,
+        "index_bytes": sum(getattr(index, name).nbytes for name in ("hashes", "offsets", "song_ids", "times")),
+        "recall": correct / len(queries),
+        "ms_per_query": 1000 * query_seconds / len(queries),
+    }
+
+
+def report(song_dir, budgets, fanouts, num_queries=50, clip_seconds=5, snr_db=10,
+           base_params=fe.DEFAULT_PARAMS):
+    """Evaluates every (peaks_per_second, fanout_value) combination
+
+    Parameters
+    ----------
+    song_dir : str or Path, folder or manifest understood by `read_song_list`
+    budgets : list of int or None, peaks_per_second values; None keeps every peak
+    fanouts : list of int, fanout_value values
+    num_queries, clip_seconds, snr_db : see `make_queries`
+    base_params : frontend.AnalysisParams, settings for everything else
+
+    Returns
+    -------
+    list of dict, one per combination, see `evaluate`
+    """
+    rate = base_params.sampling_rate
+    songs = [c.load_samples(path, rate)[0] for path, info in read_song_list(song_dir)]
+    queries = make_queries(songs, num_queries, clip_seconds, snr_db, rate)
+
+    rows = []
+    print(f"{'peaks/s':>8} {'fanout':>6} {'fp/hour':>12} {'index MB':>9} {'recall':>7} {'ms/query':>9}")
+    for budget in budgets:
+        for fanout in fanouts:
+            params = base_params._replace(peaks_per_second=budget, fanout_value=fanout)
+            row = evaluate(params, songs, queries)
+            rows.append(row)
+            print(f"{str(budget):>8} {fanout:>6} {row['fingerprints_per_hour']:>12.0f} "
+                  f"{row['index_bytes'] / 2 ** 20:>9.2f} {row['recall']:>7.2%} {row['ms_per_query']:>9.1f}")
+    return rows
+
+
+def _int_list(text):
+    return [None if value == "none" else int(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index size vs. recall for peak and fingerprint budgets")
+    parser.add_argument("song_dir")
+    parser.add_argument("--budgets", type=_int_list, default=[10, 20, 30, 50, None],
+                        help="comma-separated peaks_per_second values; 'none' keeps every peak")
+    parser.add_argument("--fanouts", type=_int_list, default=[5, 10, 15])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--clip-seconds", type=float, default=5)
+    parser.add_argument("--snr-db", type=float, default=10)
+    parser.add_argument("--json", help="also write the rows to this file")
+    args = parser.parse_args()
+
+    rows = report(args.song_dir, args.budgets, args.fanouts, args.queries, args.clip_seconds, args.snr_db)
+    if args.json:
+        with open(args.json, mode="w") as opened_file:
+            json.dump(rows, opened_file, indent=2)
@@ -6,15 +6,53 @@
 # In[34]:
 
 
-from numba import njit
+import functools
+
 import numpy as np
-from scipy.ndimage.morphology import generate_binary_structure
-from scipy.spatial.distance import cdist
 
-@njit
+
+def binary_structure(rank, connectivity):
+    """
+    NumPy equivalent of `scipy.ndimage.generate_binary_structure`.
+
+    Importing scipy.ndimage takes longer than fingerprinting a short clip,
+    so the neighborhood masks are built here instead.
+    
+    Parameters
+    ----------
+    rank : int
+        Number of dimensions of the mask; the mask is 3 wide in each
+    
+    connectivity : int
+        Elements up to this many steps away from the center (counting one
+        step per dimension in which they differ) are in the neighborhood;
+        values below 1 count as 1
+    
+    Returns
+    -------
+    numpy.ndarray, shape-(3,) * rank, bool
+    """
+    return np.abs(np.indices([3] * rank) - 1).sum(axis=0) <= max(connectivity, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_peaks():
+    """
+    Returns `_peaks` compiled by Numba.
+
+    Numba is imported on first use only, and the machine code is cached next
+    to this file (cache=True), so later processes load it instead of
+    compiling again.
+    """
+    from numba import njit
+
+    return njit(cache=True)(_peaks)
+
+
 def _peaks(data_2d, rows, cols, amp_min):
     """
-    A Numba-optimized 2-D peak-finding algorithm.
+    A 2-D peak-finding algorithm, run compiled by Numba through
+    `_compiled_peaks`.
     
     Parameters
     ----------
@@ -103,7 +141,103 @@ def local_peak_locations(data_2d, neighborhood, amp_min):
     rows -= neighborhood.shape[0] // 2
     cols -= neighborhood.shape[1] // 2
     
-    return _peaks(data_2d, rows, cols, amp_min=amp_min)
+    return _compiled_peaks()(data_2d, rows, cols, amp_min=amp_min)
+
+
+def local_peak_array(data_2d, neighborhood, amp_min):
+    """
+    Vectorized equivalent of `local_peak_locations` that stays in NumPy.
+
+    Instead of visiting each cell, every neighbor offset of the mask is
+    compared against the whole spectrogram at once, using the same
+    mirror-over-the-boundary rule as `_peaks`, so the result is identical.
+    
+    Parameters
+    ----------
+    data_2d : numpy.ndarray, shape-(H, W)
+        The 2D array of data in which local peaks will be detected
+    
+    neighborhood : numpy.ndarray, shape-(h, w)
+        A boolean mask indicating the "neighborhood" in which each
+        datum will be assessed to determine whether or not it is
+        a local peak. h and w must be odd-valued numbers
+        
+    amp_min : float or numpy.ndarray
+        All amplitudes at and below this value are excluded from being local 
+        peaks. An array must broadcast against data_2d, e.g. one threshold
+        per row of shape-(H, 1).
+    
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 2)
+        (row, col) index pair for each local peak location, in column-major
+        order.
+    """
+    rows, cols = np.where(neighborhood)
+    assert neighborhood.shape[0] % 2 == 1
+    assert neighborhood.shape[1] % 2 == 1
+
+    # center neighborhood indices around center of neighborhood
+    rows -= neighborhood.shape[0] // 2
+    cols -= neighborhood.shape[1] // 2
+
+    data_2d = np.asarray(data_2d)
+    row_idx = np.arange(data_2d.shape[0])
+    col_idx = np.arange(data_2d.shape[1])
+
+    # written as negations so NaNs are handled exactly like `_peaks`
+    is_peak = ~(data_2d <= amp_min)
+    for dr, dc in zip(rows, cols):
+        # don't compare element (r, c) with itself
+        if dr == 0 and dc == 0:
+            continue
+
+        # mirror over array boundary
+        neighbor_rows = row_idx + dr
+        neighbor_rows = np.where((neighbor_rows >= 0) & (neighbor_rows < data_2d.shape[0]), neighbor_rows, row_idx - dr)
+        neighbor_cols = col_idx + dc
+        neighbor_cols = np.where((neighbor_cols >= 0) & (neighbor_cols < data_2d.shape[1]), neighbor_cols, col_idx - dc)
+
+        is_peak &= ~(data_2d < data_2d[np.ix_(neighbor_rows, neighbor_cols)])
+
+    # transposing makes np.nonzero walk the columns first
+    peak_cols, peak_rows = np.nonzero(is_peak.T)
+    return np.stack([peak_rows, peak_cols], axis=1).astype(np.int64)
+
+
+def strongest_peaks(peak_locations, amplitudes, window_cols, max_per_window):
+    """
+    Keeps only the max_per_window strongest peaks in each window of columns.
+
+    Caps how many peaks loud or dense passages can contribute, so the number
+    of fingerprints grows with the length of the audio rather than with how
+    busy it is.
+    
+    Parameters
+    ----------
+    peak_locations : numpy.ndarray, shape-(N, 2)
+        (row, col) peak locations in column-major order
+    amplitudes : numpy.ndarray, shape-(N,)
+        The spectrogram value at each peak
+    window_cols : int
+        Width of each window; window k covers columns [k * window_cols, (k + 1) * window_cols)
+    max_per_window : int
+        Number of peaks kept per window
+    
+    Returns
+    -------
+    numpy.ndarray, shape-(M, 2)
+        The kept peaks, still in column-major order. Ties are broken in favor
+        of the earlier peak.
+    """
+    peaks = np.asarray(peak_locations, dtype=np.int64).reshape(-1, 2)
+    window = peaks[:, 1] // window_cols
+    # strongest first within each window; lexsort is stable so ties keep their order
+    order = np.lexsort((-np.asarray(amplitudes), window))
+    sorted_window = window[order]
+    starts = np.flatnonzero(np.r_[True, sorted_window[1:] != sorted_window[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return peaks[np.sort(order[rank < max_per_window])]
 
 
 # ### Finding the fingerprints of the peaks
@@ -130,7 +264,8 @@ def create_fingerprints(peak_locations, fanout_value = 15):
     Returns
     -------
     list of fingerprints
-        In the format: [(f1, f2, delta t), ...]
+        In the format: [(f1, f2, delta t, t_anchor), ...] where (f1, f2, delta t)
+        is the database key and t_anchor is the time of the first peak
     """
     fingerprints = []
     assert len(peak_locations) > fanout_value
@@ -150,6 +285,68 @@ def create_fingerprints(peak_locations, fanout_value = 15):
     return fingerprints
 
 
+def create_fingerprint_array(peak_locations, fanout_value = 15):
+    """
+    Vectorized equivalent of `create_fingerprints` that stays in NumPy.
+
+    Each peak is paired with the next fanout_value peaks by comparing the
+    peak array against copies of itself shifted by 1..fanout_value, which
+    gives the same fingerprints in the same order as `create_fingerprints`.
+    
+    Parameters
+    ----------
+    peak_locations: numpy.ndarray, shape-(N, 2), or list
+        Locations of peaks in the format [(x1,y1), (x2, y2), ...]
+    fanout_value: integer
+        Number of following peaks each peak is paired with
+        
+    Returns
+    -------
+    numpy.ndarray, shape-(M, 4)
+        One (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    peaks = np.asarray(peak_locations, dtype=np.int64).reshape(-1, 2)
+    assert len(peaks) > fanout_value
+    return fanout_pairs(peaks, fanout_value, len(peaks))
+
+
+def fanout_pairs(peaks, fanout_value, num_anchors):
+    """
+    Pairs each of the first num_anchors peaks with up to fanout_value of the
+    peaks that follow it.
+
+    Used by `create_fingerprint_array` and by streaming fingerprinting, which
+    only pairs the anchors whose following peaks have all arrived.
+    
+    Parameters
+    ----------
+    peaks: numpy.ndarray, shape-(N, 2)
+        (row, col) peak locations in column-major order
+    fanout_value: integer
+        Number of following peaks each anchor is paired with
+    num_anchors: integer
+        Number of leading peaks to use as anchors
+        
+    Returns
+    -------
+    numpy.ndarray, shape-(M, 4)
+        One (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    anchor = np.arange(num_anchors)[:, np.newaxis]
+    partner = anchor + np.arange(1, fanout_value + 1)[np.newaxis, :]
+    valid = partner < len(peaks)
+    # boolean indexing flattens row by row, keeping the anchor-major order
+    anchor = np.broadcast_to(anchor, partner.shape)[valid]
+    partner = partner[valid]
+
+    return np.stack([
+        peaks[anchor, 0],
+        peaks[partner, 0],
+        peaks[partner, 1] - peaks[anchor, 1],
+        peaks[anchor, 1],
+    ], axis=1).reshape(-1, 4)
+
+
 # ### Testing functions
 
 # In[48]:
@@ -0,0 +1,79 @@
+"""Fingerprint Cache
+content hashes of audio files and an on-disk cache of their fingerprints
+
+Each audio file is identified by the SHA-256 of its bytes, so a renamed or
+copied file is still recognized as the same song. Its packed fingerprints are
+cached under that hash and a key of the analysis settings:
+
+cache/
+    <settings key>/
+        <content hash[:2]>/
+            <content hash>.npz     hashes (uint64) and times (int32)
+
+Rebuilding a database with the same analysis settings (e.g. after a storage
+format change) then reads fingerprints from the cache instead of decoding
+and analysing every file again. Entries are written atomically and never
+modified, so several ingest processes can share one cache.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+import fingerprint_index as fi
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("SONG_MATCHING_CACHE", Path.home() / ".cache" / "song-matching"))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns the hex SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, mode="rb") as opened_file:
+        for chunk in iter(lambda: opened_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_key(params, stream=False):
+    """Returns a short key identifying the analysis settings fingerprints were made with
+
+    Parameters
+    ----------
+    params : frontend.AnalysisParams
+    stream : bool, whether the file was fingerprinted block by block, which
+             thresholds differently (see interface_functions.fingerprint_file)
+    """
+    settings = json.dumps({"params": params._asdict(), "stream": stream}, sort_keys=True)
+    return hashlib.sha256(settings.encode()).hexdigest()[:16]
+
+
+def cache_path(cache_dir, content_hash, params, stream=False):
+    """Returns the cache file of one (file, settings) pair"""
+    return Path(cache_dir) / settings_key(params, stream) / content_hash[:2] / f"{content_hash}.npz"
+
+
+def load(cache_dir, content_hash, params, stream=False):
+    """Reads cached fingerprints
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray] or None
+        (hashes, times) as from fingerprint_index.pack_fingerprints, or None
+        if the file has not been fingerprinted with these settings
+    """
+    try:
+        with np.load(cache_path(cache_dir, content_hash, params, stream)) as cached:
+            return cached["hashes"].astype(fi.HASH_DTYPE), cached["times"].astype(fi.TIME_DTYPE)
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        return None
+
+
+def store(cache_dir, content_hash, params, hashes, times, stream=False):
+    """Writes fingerprints to the cache, replacing any previous entry atomically"""
+    path = cache_path(cache_dir, content_hash, params, stream)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, hashes=hashes, times=times)
+    os.replace(tmp_path, path)
@@ -0,0 +1,585 @@
+"""Fingerprint Index
+packing fingerprints into integer hashes and storing them in a columnar inverted index
+
+A fingerprint (f1, f2, delta t, t_anchor) is split into its key (f1, f2, delta t),
+which is packed into a single uint64 hash, and its anchor time. The index keeps
+every posting (song_id, t_anchor) in flat NumPy arrays sorted by hash, CSR-style:
+
+hashes   = sorted unique fingerprint hashes, shape-(K,)
+offsets  = start of each hash's posting list, shape-(K + 1,)
+song_ids = dense int32 song id of every posting, shape-(P,)
+times    = int32 anchor time of every posting, shape-(P,)
+
+so the postings of hashes[k] are song_ids[offsets[k]:offsets[k + 1]].
+"""
+import numpy as np
+
+import instrumentation as inst
+
+FREQ_BITS = 16
+DT_BITS = 16
+HASH_DTYPE = np.uint64
+SONG_DTYPE = np.int32
+TIME_DTYPE = np.int32
+
+
+def fingerprint_columns(fingerprints):
+    """Returns the f1, f2, delta t and t_anchor columns of a set of fingerprints
+
+    Parameters
+    ----------
+    fingerprints : list of (f1, f2, delta t, t_anchor) tuples or a shape-(N, 4)
+                   integer array
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, ...]
+        f1, f2, dt, t_anchor; each an int64 array of shape-(N,)
+    """
+    columns = np.asarray(fingerprints, dtype=np.int64).reshape(-1, 4)
+    return columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3]
+
+
+def pack_hashes(f1, f2, dt):
+    """Packs (f1, f2, delta t) into one uint64 hash per fingerprint
+
+    The hash is laid out as f1 | f2 | delta t from the high bits down, with
+    FREQ_BITS for each frequency and DT_BITS for the time difference.
+
+    Parameters
+    ----------
+    f1, f2, dt : array-like of non-negative ints, shape-(N,)
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N,), uint64
+    """
+    f1 = np.asarray(f1, dtype=np.int64)
+    f2 = np.asarray(f2, dtype=np.int64)
+    dt = np.asarray(dt, dtype=np.int64)
+    for name, values, bits in (("f1", f1, FREQ_BITS), ("f2", f2, FREQ_BITS), ("dt", dt, DT_BITS)):
+        if values.size and (values.min() < 0 or values.max() >= 1 << bits):
+            raise ValueError(f"{name} does not fit in {bits} bits")
+
+    hashes = f1.astype(HASH_DTYPE) << HASH_DTYPE(FREQ_BITS + DT_BITS)
+    hashes |= f2.astype(HASH_DTYPE) << HASH_DTYPE(DT_BITS)
+    hashes |= dt.astype(HASH_DTYPE)
+    return hashes
+
+
+def unpack_hashes(hashes):
+    """Inverse of `pack_hashes`
+
+    Parameters
+    ----------
+    hashes : numpy.ndarray of uint64
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        f1, f2, dt as int64 arrays
+    """
+    hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+    dt = hashes & HASH_DTYPE((1 << DT_BITS) - 1)
+    f2 = (hashes >> HASH_DTYPE(DT_BITS)) & HASH_DTYPE((1 << FREQ_BITS) - 1)
+    f1 = hashes >> HASH_DTYPE(FREQ_BITS + DT_BITS)
+    return f1.astype(np.int64), f2.astype(np.int64), dt.astype(np.int64)
+
+
+def pack_fingerprints(fingerprints):
+    """Splits fingerprints into packed key hashes and anchor times
+
+    Parameters
+    ----------
+    fingerprints : list of (f1, f2, delta t, t_anchor) tuples or a shape-(N, 4)
+                   integer array
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        hashes (uint64) and anchor times (int32), both shape-(N,)
+    """
+    f1, f2, dt, t_anchor = fingerprint_columns(fingerprints)
+    return pack_hashes(f1, f2, dt), t_anchor.astype(TIME_DTYPE)
+
+
+def unpack_fingerprints(hashes, times):
+    """Inverse of `pack_fingerprints`
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 4)
+        One (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    return np.stack([*unpack_hashes(hashes), np.asarray(times, dtype=np.int64)], axis=1)
+
+
+def filter_candidates(key_filter, query_hashes):
+    """Returns the positions of the query hashes that key_filter does not rule out
+
+    Parameters
+    ----------
+    key_filter : bloom_filter.BlockedBloomFilter or None; None keeps every hash
+    query_hashes : numpy.ndarray, shape-(Q,)
+
+    Returns
+    -------
+    numpy.ndarray of int64, increasing
+    """
+    if key_filter is None:
+        return np.arange(np.size(query_hashes))
+    candidates = np.flatnonzero(key_filter.contains(query_hashes))
+    inst.count("filter_rejected", np.size(query_hashes) - candidates.size)
+    return candidates
+
+
+class FingerprintIndex:
+    """Inverted index from packed fingerprint hashes to (song_id, t_anchor) postings
+
+    Parameters
+    ----------
+    hashes, offsets, song_ids, times : numpy.ndarray, optional
+        The CSR arrays described in the module docstring. An empty index is
+        created when they are omitted.
+    num_songs : int
+        Number of dense song ids handed out so far; the next song added gets
+        this value as its id.
+
+    Attributes
+    ----------
+    key_filter : bloom_filter.BlockedBloomFilter or None
+        Filter of the keys, set by index_storage for large stored segments;
+        lookups skip the binary search for query hashes it rules out
+    """
+
+    def __init__(self, hashes=None, offsets=None, song_ids=None, times=None, num_songs=0):
+        self.hashes = np.zeros(0, dtype=HASH_DTYPE) if hashes is None else hashes
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self.song_ids = np.zeros(0, dtype=SONG_DTYPE) if song_ids is None else song_ids
+        self.times = np.zeros(0, dtype=TIME_DTYPE) if times is None else times
+        self.num_songs = int(num_songs)
+        self.key_filter = None
+
+    @classmethod
+    def from_postings(cls, hashes, song_ids, times, num_songs=None):
+        """Builds an index from one row per posting, in any order
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray, shape-(P,), packed fingerprint hash of each posting
+        song_ids : numpy.ndarray, shape-(P,), dense song id of each posting
+        times : numpy.ndarray, shape-(P,), anchor time of each posting
+        num_songs : int, optional; defaults to one past the largest song id
+
+        Returns
+        -------
+        FingerprintIndex
+        """
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        song_ids = np.asarray(song_ids, dtype=SONG_DTYPE)
+        times = np.asarray(times, dtype=TIME_DTYPE)
+        if num_songs is None:
+            num_songs = int(song_ids.max()) + 1 if song_ids.size else 0
+
+        # posting lists are kept ordered by (song_id, t_anchor) within each hash
+        order = np.lexsort((times, song_ids, hashes))
+        hashes, song_ids, times = hashes[order], song_ids[order], times[order]
+
+        unique_hashes, starts = np.unique(hashes, return_index=True)
+        offsets = np.append(starts, hashes.size).astype(np.int64)
+        return cls(unique_hashes, offsets, song_ids, times, num_songs)
+
+    def __len__(self):
+        return self.hashes.size
+
+    @property
+    def num_postings(self):
+        return self.song_ids.size
+
+    def slice_keys(self, start, stop):
+        """Returns the keys start:stop as a FingerprintIndex for lookups
+
+        Nothing is copied: the slice's offsets keep pointing into this index's
+        whole song_ids and times arrays, so the slice is only meant for `lookup`.
+        It shares this index's key_filter, which holds a superset of its keys.
+        """
+        view = FingerprintIndex(self.hashes[start:stop], self.offsets[start:stop + 1],
+                                self.song_ids, self.times, self.num_songs)
+        view.key_filter = self.key_filter
+        return view
+
+    def boundary_hashes(self, num_shards):
+        """Returns num_shards - 1 hashes that split the keys into even ranges"""
+        cuts = np.arange(1, num_shards) * len(self) // num_shards
+        return np.asarray(self.hashes[cuts], dtype=HASH_DTYPE)
+
+    def split(self, bounds):
+        """Partitions the index by hash range
+
+        Parameters
+        ----------
+        bounds : numpy.ndarray, sorted uint64 hashes; shard k holds the hashes
+                 in [bounds[k - 1], bounds[k]), with open ends
+
+        Returns
+        -------
+        list of FingerprintIndex, len(bounds) + 1 lookup-only views, see `slice_keys`
+        """
+        cuts = np.concatenate([[0], np.searchsorted(self.hashes, bounds), [self.hashes.size]])
+        return [self.slice_keys(start, stop) for start, stop in zip(cuts[:-1], cuts[1:])]
+
+    def posting_lengths(self):
+        """Returns the posting-list length of every key"""
+        return np.diff(self.offsets)
+
+    def posting_counts(self, query_hashes):
+        """Returns the posting-list length of every query hash, 0 for hashes not in the index"""
+        query_hashes = np.asarray(query_hashes, dtype=HASH_DTYPE)
+        counts = np.zeros(query_hashes.size, dtype=np.int64)
+        if self.hashes.size == 0:
+            return counts
+        candidates = filter_candidates(self.key_filter, query_hashes)
+        keys = np.minimum(np.searchsorted(self.hashes, query_hashes[candidates]), self.hashes.size - 1)
+        found = self.hashes[keys] == query_hashes[candidates]
+        counts[candidates[found]] = self.offsets[keys[found] + 1] - self.offsets[keys[found]]
+        return counts
+
+    def posting_hashes(self):
+        """Returns the hash of every posting, i.e. the CSR index expanded back to rows"""
+        return np.repeat(self.hashes, np.diff(self.offsets))
+
+    def keys(self):
+        """Returns every key with its posting-list length
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray]
+            hashes (sorted, uint64) and posting-list lengths (int64)
+        """
+        return self.hashes, self.posting_lengths()
+
+    def postings(self):
+        """Returns every posting as rows, in key order
+
+        Compressed segments decode themselves once for all three arrays, so
+        callers that need more than one of them should use this.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            hashes, song_ids and times, one entry per posting
+        """
+        return self.posting_hashes(), self.song_ids, self.times
+
+    def add(self, fingerprints, song_id):
+        """Adds every fingerprint of one song to the index
+
+        Parameters
+        ----------
+        fingerprints : list of (f1, f2, delta t, t_anchor) tuples or a
+                       shape-(N, 4) integer array
+        song_id : int, dense id of the song
+
+        Returns
+        -------
+        FingerprintIndex
+            self, updated in place
+        """
+        hashes, times = pack_fingerprints(fingerprints)
+        return self.add_postings(hashes, np.full(hashes.size, song_id, dtype=SONG_DTYPE), times)
+
+    def add_postings(self, hashes, song_ids, times):
+        """Merges a batch of postings, possibly from many songs, into the index
+
+        The index is rebuilt once per call, so adding songs in batches is much
+        cheaper than adding them one at a time.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray, shape-(P,), packed fingerprint hash of each posting
+        song_ids : numpy.ndarray, shape-(P,), dense song id of each posting
+        times : numpy.ndarray, shape-(P,), anchor time of each posting
+
+        Returns
+        -------
+        FingerprintIndex
+            self, updated in place
+        """
+        song_ids = np.asarray(song_ids, dtype=SONG_DTYPE)
+        num_songs = max(self.num_songs, int(song_ids.max()) + 1) if song_ids.size else self.num_songs
+        merged = FingerprintIndex.from_postings(
+            np.concatenate([self.posting_hashes(), np.asarray(hashes, dtype=HASH_DTYPE)]),
+            np.concatenate([self.song_ids, song_ids]),
+            np.concatenate([self.times, np.asarray(times, dtype=TIME_DTYPE)]),
+            num_songs,
+        )
+        self.__dict__.update(merged.__dict__)
+        return self
+
+    def lookup(self, query_hashes):
+        """Finds the postings of every query hash with a vectorized binary search
+
+        Parameters
+        ----------
+        query_hashes : numpy.ndarray, shape-(Q,), packed fingerprint hashes
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            query_pos, song_ids, times; one entry per matching posting, where
+            query_pos is the index into query_hashes that hit the posting
+        """
+        query_hashes = np.asarray(query_hashes, dtype=HASH_DTYPE)
+        if self.hashes.size == 0 or query_hashes.size == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, self.song_ids[:0], self.times[:0]
+
+        candidates = filter_candidates(self.key_filter, query_hashes)
+        keys = np.searchsorted(self.hashes, query_hashes[candidates])
+        keys = np.minimum(keys, self.hashes.size - 1)
+        found = np.flatnonzero(self.hashes[keys] == query_hashes[candidates])
+        query_pos, keys = candidates[found], keys[found]
+
+        starts = self.offsets[keys]
+        lengths = self.offsets[keys + 1] - starts
+        # posting index = start of the list + position within the list
+        rows = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return np.repeat(query_pos, lengths), self.song_ids[rows], self.times[rows]
+
+
+class SegmentedIndex:
+    """A fingerprint index made of immutable FingerprintIndex segments
+
+    New songs go into a new small segment instead of being merged into the
+    existing ones, so adding a song costs time proportional to the song and
+    not to the catalog. Queries look up every segment and concatenate the
+    postings; `compacted` merges all segments back into one.
+
+    Removing a song only sets its bit in the `deleted` tombstone bitmap;
+    lookups drop the postings of deleted songs and `compacted` leaves them out.
+
+    Parameters
+    ----------
+    segments : list of FingerprintIndex, segments already stored on disk
+    names : list of str, optional; storage name of each segment
+    num_songs : int
+        Number of dense song ids handed out so far
+    params : frontend.AnalysisParams, optional
+        Analysis settings the fingerprints were made with
+    num_shards : int
+        Number of hash ranges a query is split into and searched in parallel;
+        see `shards`
+    deleted : numpy.ndarray of bool, optional
+        Tombstone bitmap; deleted[song_id] is True once the song is removed.
+        Song ids past its end are live.
+    max_postings : int, optional
+        Query hashes with more postings than this (summed over segments) are
+        skipped, like stop words; None looks up every hash
+    weighting : str, optional
+        "idf" weights each vote by how rare its key is, see
+        manageFingerprints.idf_weights; None counts every vote as 1
+
+    Attributes
+    ----------
+    posting_cache : query_cache.PostingCache or None
+        Caches the merged posting lists `lookup` reads; see query_cache.attach
+    result_cache : query_cache.ResultCache or None
+        Query results kept by callers such as interface_functions.find_song;
+        cleared whenever a song is added or removed
+    generation : int
+        Bumped whenever the segments or the tombstones change, so state
+        derived from them (such as `shards`) knows to rebuild; code that
+        swaps segments itself, like index_storage.save_index, bumps it too
+    """
+
+    def __init__(self, segments=(), names=None, num_songs=0, params=None, num_shards=1, deleted=None,
+                 max_postings=None, weighting=None):
+        self.segments = list(segments)
+        self.names = list(names) if names is not None else [None] * len(self.segments)
+        # segments added in memory that have not been saved yet
+        self.pending = []
+        self.num_songs = int(num_songs)
+        self.params = params
+        self.num_shards = int(num_shards)
+        self.deleted = np.zeros(0, dtype=bool) if deleted is None else np.asarray(deleted, dtype=bool)
+        self.max_postings = max_postings
+        self.weighting = weighting
+        self.posting_cache = None
+        self.result_cache = None
+        self.generation = 0
+        self._shards = (None, None)
+
+    def all_segments(self):
+        return self.segments + self.pending
+
+    def __len__(self):
+        """Total number of keys summed over segments; a key in several segments counts once per segment"""
+        return sum(len(segment) for segment in self.all_segments())
+
+    @property
+    def num_postings(self):
+        return sum(segment.num_postings for segment in self.all_segments())
+
+    def add(self, fingerprints, song_id):
+        """Adds every fingerprint of one song as a new pending segment
+
+        Parameters
+        ----------
+        fingerprints : list of (f1, f2, delta t, t_anchor) tuples or a
+                       shape-(N, 4) integer array
+        song_id : int, dense id of the song
+
+        Returns
+        -------
+        SegmentedIndex
+            self, updated in place
+        """
+        hashes, times = pack_fingerprints(fingerprints)
+        return self.add_postings(hashes, np.full(hashes.size, song_id, dtype=SONG_DTYPE), times)
+
+    def add_postings(self, hashes, song_ids, times):
+        """Adds a batch of postings, possibly from many songs, as one new pending segment
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray, shape-(P,), packed fingerprint hash of each posting
+        song_ids : numpy.ndarray, shape-(P,), dense song id of each posting
+        times : numpy.ndarray, shape-(P,), anchor time of each posting
+
+        Returns
+        -------
+        SegmentedIndex
+            self, updated in place
+        """
+        segment = FingerprintIndex.from_postings(hashes, song_ids, times)
+        self.num_songs = max(self.num_songs, segment.num_songs)
+        self.pending.append(segment)
+        self.generation += 1
+        if self.posting_cache is not None:
+            self.posting_cache.discard(segment.hashes)
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        return self
+
+    def posting_counts(self, query_hashes):
+        """Returns the posting-list length of every query hash summed over segments"""
+        counts = np.zeros(np.size(query_hashes), dtype=np.int64)
+        for segment in self.all_segments():
+            counts += segment.posting_counts(query_hashes)
+        return counts
+
+    def key_statistics(self):
+        """Returns every distinct key with its total posting-list length over all segments
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray]
+            hashes (sorted, uint64) and posting counts (int64)
+        """
+        segments = self.all_segments()
+        if not segments:
+            return np.zeros(0, dtype=HASH_DTYPE), np.zeros(0, dtype=np.int64)
+        keys = [segment.keys() for segment in segments]
+        hashes, inverse = np.unique(np.concatenate([hashes for hashes, lengths in keys]), return_inverse=True)
+        lengths = np.concatenate([lengths for hashes, lengths in keys])
+        return hashes, np.bincount(inverse.ravel(), weights=lengths, minlength=hashes.size).astype(np.int64)
+
+    def remove(self, song_id):
+        """Marks a song as deleted; its postings stay in the segments until compaction
+
+        Returns
+        -------
+        SegmentedIndex
+            self, updated in place
+        """
+        if song_id >= self.deleted.size:
+            self.deleted = np.concatenate([self.deleted, np.zeros(max(song_id + 1, self.num_songs)
+                                                                 - self.deleted.size, dtype=bool)])
+        self.deleted[song_id] = True
+        self.generation += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        return self
+
+    def is_live(self, song_ids):
+        """Returns a boolean mask of the song ids that have not been deleted"""
+        song_ids = np.asarray(song_ids)
+        live = song_ids >= self.deleted.size
+        live[~live] = ~self.deleted[song_ids[~live]]
+        return live
+
+    def lookup(self, query_hashes):
+        """Finds the postings of every query hash in every segment
+
+        Postings of deleted songs are left out. With a posting_cache, only
+        the hashes it does not hold are looked up in the segments.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            query_pos, song_ids, times; see `FingerprintIndex.lookup`
+        """
+        if self.posting_cache is not None:
+            query_pos, song_ids, times = self.posting_cache.lookup(_Segments(self), query_hashes)
+        else:
+            query_pos, song_ids, times = _Segments(self).lookup(query_hashes)
+        if self.deleted.any():
+            live = self.is_live(song_ids)
+            query_pos, song_ids, times = query_pos[live], song_ids[live], times[live]
+        return query_pos, song_ids, times
+
+    def shards(self):
+        """Partitions the index into num_shards hash ranges
+
+        The ranges are cut at quantiles of the largest segment's keys so each
+        shard holds about the same number of keys, and every segment is split
+        at the same hashes so a query hash only has to be looked up in one shard.
+        The shards are lookup-only views of the segment arrays (see
+        `FingerprintIndex.slice_keys`) and are cached until the generation
+        changes.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, list of SegmentedIndex]
+            bounds (num_shards - 1 sorted hashes, see `FingerprintIndex.split`)
+            and the shards
+        """
+        key = (self.generation, self.num_shards)
+        if self._shards[0] != key:
+            segments = self.all_segments()
+            largest = max(segments, key=len, default=FingerprintIndex())
+            bounds = np.unique(largest.boundary_hashes(self.num_shards))
+            pieces = [segment.split(bounds) for segment in segments]
+            shards = [SegmentedIndex([segment_pieces[k] for segment_pieces in pieces], num_songs=self.num_songs,
+                                     deleted=self.deleted)
+                      for k in range(bounds.size + 1)]
+            self._shards = (key, (bounds, shards))
+        # the shards cover disjoint hashes, so they can share one posting cache
+        for shard in self._shards[1][1]:
+            shard.posting_cache = self.posting_cache
+        return self._shards[1]
+
+    def compacted(self):
+        """Merges every segment into a single FingerprintIndex, dropping the postings of deleted songs"""
+        postings = [segment.postings() for segment in self.all_segments()]
+        hashes = np.concatenate([part[0] for part in postings] or [np.zeros(0, HASH_DTYPE)])
+        song_ids = np.concatenate([part[1] for part in postings] or [np.zeros(0, SONG_DTYPE)])
+        times = np.concatenate([part[2] for part in postings] or [np.zeros(0, TIME_DTYPE)])
+        if self.deleted.any():
+            live = self.is_live(song_ids)
+            hashes, song_ids, times = hashes[live], song_ids[live], times[live]
+        return FingerprintIndex.from_postings(hashes, song_ids, times, self.num_songs)
+
+
+class _Segments:
+    """The postings of every segment of a SegmentedIndex, before tombstones and caching"""
+
+    def __init__(self, index):
+        self.segments = index.all_segments()
+
+    def lookup(self, query_hashes):
+        results = [segment.lookup(query_hashes) for segment in self.segments]
+        if not results:
+            return FingerprintIndex().lookup(query_hashes)
+        query_pos, song_ids, times = zip(*results)
+        return np.concatenate(query_pos), np.concatenate(song_ids), np.concatenate(times)
@@ -0,0 +1,181 @@
+"""Front End
+configurable analysis from audio samples to fingerprints
+
+The analysis settings are an `AnalysisParams` tuple stored with each database,
+so songs and queries are always fingerprinted the same way.
+
+LEGACY_PARAMS reproduces the original pipeline: 44.1 kHz, NFFT=4096, all 2049
+frequency bins, linear power and one 75th-percentile threshold over the whole
+spectrogram.
+
+DEFAULT_PARAMS resamples to 11025 Hz with NFFT=1024, which keeps the same
+10.8 Hz / 46 ms resolution at a quarter of the FFT cost, and keeps only the
+150-5000 Hz band where melodies carry most of their energy. It uses log power
+with a 75th-percentile threshold per frequency band, so quiet bands still get
+peaks and loud ones do not flood the index. It then keeps the 30 strongest
+peaks per second and pairs each with the next 10, so every song adds about
+300 fingerprints per second of audio however loud or dense it is.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+import find_peaks as fp
+import instrumentation as inst
+import stft
+
+AnalysisParams = namedtuple("AnalysisParams", [
+    "sampling_rate",  # Hz the audio is resampled to
+    "nfft",  # samples per FFT frame
+    "noverlap",  # samples shared by consecutive frames
+    "fmin",  # lowest frequency kept, Hz
+    "fmax",  # highest frequency kept, Hz; None keeps everything up to Nyquist
+    "log_magnitude",  # threshold and find peaks on log power instead of power
+    "threshold",  # "global", "band" (per frequency row) or "time" (per column)
+    "percentile",  # amplitude percentile used as the threshold
+    "peaks_per_second",  # strongest peaks kept per second of audio; None keeps all
+    "fanout_value",  # fingerprints made per anchor peak
+], defaults=(None, 15))
+
+LEGACY_PARAMS = AnalysisParams(
+    sampling_rate=44100, nfft=4096, noverlap=2048, fmin=0, fmax=None,
+    log_magnitude=False, threshold="global", percentile=75,
+)
+
+DEFAULT_PARAMS = AnalysisParams(
+    sampling_rate=11025, nfft=1024, noverlap=512, fmin=150, fmax=5000,
+    log_magnitude=True, threshold="band", percentile=75,
+    peaks_per_second=30, fanout_value=10,
+)
+
+THRESHOLD_MODES = ("global", "band", "time")
+
+
+def band_rows(params):
+    """Returns the slice of spectrogram rows between params.fmin and params.fmax"""
+    bin_hz = params.sampling_rate / params.nfft
+    first = int(np.ceil(params.fmin / bin_hz))
+    if params.fmax is None:
+        return slice(first, None)
+    return slice(first, int(np.floor(params.fmax / bin_hz)) + 1)
+
+
+def resample(samples, rate, params):
+    """Resamples samples from rate to params.sampling_rate"""
+    if rate == params.sampling_rate:
+        return samples
+    import soxr
+
+    return soxr.resample(np.asarray(samples, dtype=np.float32), rate, params.sampling_rate)
+
+
+def finish_spectrogram(power, params):
+    """Crops raw spectrogram power to the analysis band and applies the log scale
+
+    Parameters
+    ----------
+    power : numpy.ndarray, shape-(nfft // 2 + 1, W), as returned by stft.power_spectrogram
+    params : AnalysisParams
+
+    Returns
+    -------
+    numpy.ndarray, shape-(H, W)
+    """
+    power = power[band_rows(params)]
+    if params.log_magnitude:
+        power = np.log10(np.maximum(power, 1e-20))
+    return power
+
+
+def spectrogram(samples, rate, params):
+    """Computes the analysis spectrogram of samples
+
+    Parameters
+    ----------
+    samples : numpy.ndarray, shape-(N,), mono audio
+    rate : int, sampling rate of samples, Hz
+    params : AnalysisParams
+
+    Returns
+    -------
+    numpy.ndarray, shape-(H, W)
+        rows - freqs within the band, columns - times
+    """
+    with inst.stage("resample"):
+        samples = resample(samples, rate, params)
+    with inst.stage("spectrogram"):
+        power = stft.power_spectrogram(samples, params.sampling_rate, params.nfft, params.noverlap)
+        return finish_spectrogram(power, params)
+
+
+def peak_threshold(spectrogram, params):
+    """Returns the amplitude threshold for peak finding
+
+    Returns
+    -------
+    float or numpy.ndarray
+        a scalar for "global", a shape-(H, 1) column of per-band thresholds
+        for "band", or a shape-(1, W) row of per-time-slice thresholds for
+        "time"; all broadcast against the spectrogram
+    """
+    if params.threshold == "global":
+        return np.percentile(spectrogram, params.percentile)
+    if params.threshold == "band":
+        return np.percentile(spectrogram, params.percentile, axis=1, keepdims=True)
+    if params.threshold == "time":
+        return np.percentile(spectrogram, params.percentile, axis=0, keepdims=True)
+    raise ValueError(f"threshold must be one of {THRESHOLD_MODES}, not {params.threshold!r}")
+
+
+def budget_window_cols(params):
+    """Returns how many spectrogram columns make up one second of audio"""
+    return max(1, int(round(params.sampling_rate / (params.nfft - params.noverlap))))
+
+
+def apply_peak_budget(peaks, amplitudes, params):
+    """Keeps the params.peaks_per_second strongest peaks of every second
+
+    Parameters
+    ----------
+    peaks : numpy.ndarray, shape-(N, 2), (row, col) in column-major order,
+            with columns counted from the start of the audio
+    amplitudes : numpy.ndarray, shape-(N,), spectrogram value of each peak
+    params : AnalysisParams
+
+    Returns
+    -------
+    numpy.ndarray, shape-(M, 2)
+    """
+    if params.peaks_per_second is None:
+        return peaks
+    return fp.strongest_peaks(peaks, amplitudes, budget_window_cols(params), params.peaks_per_second)
+
+
+def fingerprint_spectrogram(spectrogram, params):
+    """Finds the peaks of an analysis spectrogram and pairs them into fingerprints
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 4)
+        One (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    with inst.stage("peaks"):
+        neighborhood = fp.binary_structure(2, 1)
+        peaks = fp.local_peak_array(spectrogram, neighborhood, peak_threshold(spectrogram, params))
+        peaks = apply_peak_budget(peaks, spectrogram[peaks[:, 0], peaks[:, 1]], params)
+    inst.count("peaks", len(peaks))
+    with inst.stage("fingerprints"):
+        fingerprints = fp.fanout_pairs(peaks, params.fanout_value, len(peaks))
+    inst.count("fingerprints", len(fingerprints))
+    return fingerprints
+
+
+def fingerprint_samples(samples, rate, params):
+    """Fingerprints mono audio samples with the given analysis settings
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 4)
+        One (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    return fingerprint_spectrogram(spectrogram(samples, rate, params), params)
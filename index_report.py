@@ -0,0 +1,225 @@
+"""Index Report
+posting-list statistics of a database and the effect of pruning common keys
+
+Prints how long the posting lists of a database are, which keys are the most
+common, how large and how selective the segments' key filters are (see
+bloom_filter), and, given the folder of songs the database was built from, how
+query time and recall change with a max_postings stop-list and IDF vote
+weighting (see index_storage.configure_queries).
+
+Usage: python index_report.py DATABASE [--top 20] [--songs SONG_DIR]
+                              [--caps 100,1000,none] [--queries 50]
+                              [--clip-seconds 5] [--snr-db 10] [--json report.json]
+                              [--build-filters]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import conversion as c
+import fingerprint_cache as fc
+import fingerprint_index as fi
+import frontend as fe
+import index_storage as storage
+import instrumentation as inst
+import manageFingerprints as mf
+from density_report import make_queries
+from interface_functions import MIN_CONFIDENCE, indexed_files, read_song_list
+
+
+def statistics(database, top=20):
+    """Summarizes the posting lists of a database
+
+    Parameters
+    ----------
+    database : fingerprint_index.SegmentedIndex
+    top : int, number of most common keys to list
+
+    Returns
+    -------
+    dict
+        number of keys and postings, a histogram of posting-list lengths in
+        power-of-two buckets, the share of postings held by the most common
+        1% of keys, and the top most common keys with their (f1, f2, dt),
+        posting count and number of distinct songs
+    """
+    hashes, lengths = database.key_statistics()
+    buckets = np.bincount(np.log2(np.maximum(lengths, 1)).astype(np.int64)) if lengths.size else []
+    order = np.argsort(lengths)[::-1]
+    hot = order[:max(1, lengths.size // 100)]
+
+    top_keys = []
+    for key in order[:top]:
+        query_pos, song_ids, times = database.lookup(hashes[key:key + 1])
+        f1, f2, dt = (int(value[0]) for value in fi.unpack_hashes(hashes[key:key + 1]))
+        top_keys.append({"f1": f1, "f2": f2, "dt": dt, "postings": int(lengths[key]),
+                         "songs": int(np.unique(song_ids).size)})
+
+    return {
+        "keys": int(hashes.size),
+        "postings": int(lengths.sum()),
+        "songs": database.num_songs,
+        "length_histogram": {f"{2 ** bucket}-{2 ** (bucket + 1) - 1}": int(count)
+                             for bucket, count in enumerate(buckets) if count},
+        "top_1pct_share": float(lengths[hot].sum() / max(lengths.sum(), 1)),
+        "top_keys": top_keys,
+    }
+
+
+def filter_statistics(database):
+    """Summarizes the key filters of the segments of a database
+
+    Parameters
+    ----------
+    database : fingerprint_index.SegmentedIndex
+
+    Returns
+    -------
+    dict
+        per segment with a filter, its keys, bytes, bits per key and expected
+        and measured false-positive rates (bloom_filter.BlockedBloomFilter.statistics),
+        plus the number of segments without a filter and the filters' total bytes
+    """
+    segments = {}
+    for name, segment in zip(database.names, database.segments):
+        if segment.key_filter is not None:
+            segments[name] = segment.key_filter.statistics()
+    return {
+        "segments": segments,
+        "unfiltered_segments": len(database.segments) - len(segments),
+        "bytes": sum(stats["bytes"] for stats in segments.values()),
+    }
+
+
+def impact(database, metadata, song_dir, caps, num_queries=50, clip_seconds=5, snr_db=10):
+    """Measures query time and recall for every max_postings cap, with and without IDF weighting
+
+    Queries are noisy excerpts of the songs in song_dir; a song's true ID is
+    found by matching its file hash with the content_hash in metadata. A query
+    counts as recalled when its best manageFingerprints.match_song candidate is
+    the true song with at least MIN_CONFIDENCE, as interface_functions.find_song
+    reports it.
+
+    Parameters
+    ----------
+    database : fingerprint_index.SegmentedIndex
+    metadata : dict, metadata table of the database
+    song_dir : str or Path, the songs the database was built from
+    caps : list of int or None, max_postings values; None skips nothing
+    num_queries, clip_seconds, snr_db : see density_report.make_queries
+
+    Returns
+    -------
+    list of dict, one per (cap, weighting), with the recall, the mean
+    confidence of the best candidate and the cost per query
+    """
+    params = database.params
+    ids = indexed_files(metadata)
+    songs, song_ids = [], []
+    for path, info in read_song_list(song_dir):
+        song_id = ids.get(fc.file_hash(path))
+        if song_id is not None:
+            songs.append(c.load_samples(path, params.sampling_rate)[0])
+            song_ids.append(song_id)
+    if not songs:
+        raise ValueError(f"none of the songs in {song_dir} are in the database")
+    queries = [(song_ids[index], *fi.pack_fingerprints(fe.fingerprint_samples(samples, params.sampling_rate, params)))
+               for index, samples in make_queries(songs, num_queries, clip_seconds, snr_db,
+                                                  params.sampling_rate)]
+
+    rows = []
+    saved = database.max_postings, database.weighting
+    try:
+        for cap in caps:
+            for weighting in (None, "idf"):
+                database.max_postings, database.weighting = cap, weighting
+                correct = 0
+                confidence = 0.0
+                with inst.Metrics() as metrics:
+                    start = time.perf_counter()
+                    for song_id, hashes, times in queries:
+                        matches = mf.match_song(hashes, times, database)
+                        if matches:
+                            correct += matches[0].song_id == song_id and matches[0].confidence >= MIN_CONFIDENCE
+                            confidence += matches[0].confidence
+                    seconds = time.perf_counter() - start
+                counters = metrics.report()["counters"]
+                rows.append({
+                    "max_postings": cap,
+                    "weighting": weighting,
+                    "recall": correct / len(queries),
+                    "confidence": confidence / len(queries),
+                    "ms_per_query": 1000 * seconds / len(queries),
+                    "postings_per_query": counters.get("postings_scanned", 0) / len(queries),
+                    "stopped_per_query": counters.get("stopped_hashes", 0) / len(queries),
+                    "filtered_per_query": counters.get("filter_rejected", 0) / len(queries),
+                })
+    finally:
+        database.max_postings, database.weighting = saved
+    return rows
+
+
+def print_statistics(stats):
+    print(f"{stats['keys']} keys, {stats['postings']} postings, {stats['songs']} songs")
+    print(f"the most common 1% of keys hold {stats['top_1pct_share']:.1%} of the postings\n")
+    print(f"{'postings per key':>18} {'keys':>10}")
+    for bucket, count in stats["length_histogram"].items():
+        print(f"{bucket:>18} {count:>10}")
+    print(f"\n{'f1':>6} {'f2':>6} {'dt':>4} {'postings':>9} {'songs':>7}")
+    for key in stats["top_keys"]:
+        print(f"{key['f1']:>6} {key['f2']:>6} {key['dt']:>4} {key['postings']:>9} {key['songs']:>7}")
+
+
+def print_filter_statistics(stats):
+    print(f"\n{'segment':>12} {'keys':>10} {'filter KiB':>11} {'bits/key':>9} {'expected FPR':>13} {'measured FPR':>13}")
+    for name, segment in stats["segments"].items():
+        print(f"{name:>12} {segment['keys']:>10} {segment['bytes'] / 1024:>11.1f} {segment['bits_per_key']:>9.2f} "
+              f"{segment['expected_false_positive_rate']:>13.3%} {segment['measured_false_positive_rate']:>13.3%}")
+    print(f"{len(stats['segments'])} filters, {stats['bytes'] / 1024:.1f} KiB in all; "
+          f"{stats['unfiltered_segments']} segments without a filter")
+
+
+def print_impact(rows):
+    print(f"\n{'max_postings':>12} {'weighting':>9} {'recall':>7} {'confidence':>10} {'ms/query':>9} {'postings/query':>15} "
+          f"{'stopped/query':>14} {'filtered/query':>15}")
+    for row in rows:
+        print(f"{str(row['max_postings']):>12} {str(row['weighting']):>9} {row['recall']:>7.2%} {row['confidence']:>10.2f} "
+              f"{row['ms_per_query']:>9.2f} {row['postings_per_query']:>15.0f} {row['stopped_per_query']:>14.1f} "
+              f"{row['filtered_per_query']:>15.1f}")
+
+
+def _int_list(text):
+    return [None if value == "none" else int(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Posting-list statistics and the effect of pruning common keys")
+    parser.add_argument("database")
+    parser.add_argument("--top", type=int, default=20, help="number of most common keys to list")
+    parser.add_argument("--songs", help="folder or manifest of the songs in the database, to measure recall")
+    parser.add_argument("--caps", type=_int_list, default=[None, 10000, 1000, 100],
+                        help="comma-separated max_postings values; 'none' skips nothing")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--clip-seconds", type=float, default=5)
+    parser.add_argument("--snr-db", type=float, default=10)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--build-filters", action="store_true",
+                        help="first write the key filters missing from the database's segments")
+    args = parser.parse_args()
+
+    if args.build_filters:
+        built = storage.build_filters(args.database)
+        print(f"Built {len(built)} key filters.\n")
+    metadata, database = storage.open_database(args.database)
+    report = {"statistics": statistics(database, args.top), "filters": filter_statistics(database)}
+    print_statistics(report["statistics"])
+    print_filter_statistics(report["filters"])
+    if args.songs:
+        report["impact"] = impact(database, metadata, args.songs, args.caps, args.queries,
+                                  args.clip_seconds, args.snr_db)
+        print_impact(report["impact"])
+    if args.json:
+        with open(args.json, mode="w") as opened_file:
+            json.dump(report, opened_file, indent=2)
@@ -0,0 +1,573 @@
+"""Index Storage
+versioned on-disk database format
+
+A database is a directory:
+
+database/
+    manifest.json        format name and version, analysis parameters, num_songs,
+                         query settings (shards, max_postings, weighting),
+                         list of live segments
+    metadata.sqlite      {song ID: {"title": ..., "artist": ..., "genre": ..., "fingerprints": ...}},
+                         indexed by title, artist, genre and content hash (see metadata_store)
+    tombstones.npy       bit-packed bitmap of removed song IDs (absent until a song is removed)
+    LOCK                 serializes manifest updates between writers and compaction
+    seg-000000/          one immutable segment of the fingerprint index
+        hashes.npy
+        offsets.npy
+        song_ids.npy
+        times.npy
+    seg-000001/          a segment of a database created with compression="bitpack"
+        block_hashes.npy   (see compressed_index; about 4x smaller)
+        ...
+        filter.npy         Bloom filter of the segment's keys (see bloom_filter)
+
+The index arrays are opened with np.load(mmap_mode="r"), so opening a database
+only reads the manifest and the .npy headers and a query only faults in the pages
+its binary searches and posting lists touch. Several processes can map the same
+files at once.
+
+Segments are never modified once written. Saving new songs writes them as new
+small segments (LSM-style) and appends their names to the manifest, so adding a
+song costs time proportional to the song rather than to the catalog.
+`compact_database` merges the segments into one, on demand or in a background
+thread. The manifest is always swapped in with os.replace, so readers see a
+consistent snapshot of segments while saves and compactions run.
+
+Song IDs are dense and handed out by `reserve_song_ids`, which bumps the
+manifest's num_songs under the write lock, so processes adding songs at the
+same time never give two songs the same ID.
+
+Removing a song only sets its bit in tombstones.npy; queries drop its
+postings and compaction leaves them out of the merged segment. Song IDs are
+never reused, so bits are never cleared.
+
+With compression="bitpack" every segment is written bit-packed and its
+postings are decoded on demand by the queries that hit them. Plain and
+compressed segments can live side by side in one database.
+
+Segments are written with a blocked Bloom filter of their keys (the manifest's
+"filter_bits" bits per key, 0 for none) when it saves work: always for
+bit-packed segments, whose lookups decode blocks, and for plain segments of at
+least FILTER_MIN_KEYS keys, whose binary searches miss the CPU caches. Lookups
+drop the query hashes a segment's filter rules out before searching it.
+Segments without filter.npy, e.g. of older databases, are searched as before;
+`build_filters` adds the missing ones.
+
+The "shards" setting does not change the files: an opened index is split into
+that many hash ranges (SegmentedIndex.shards) and each query searches them in
+parallel threads.
+"""
+import contextlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import frontend as fe
+import instrumentation as inst
+import bloom_filter as bf
+import compressed_index as ci
+import metadata_store as ms
+from fingerprint_index import FingerprintIndex, SegmentedIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows; fall back to the in-process lock only
+    fcntl = None
+
+FORMAT_NAME = "song-matching-index"
+FORMAT_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+METADATA_FILE = ms.STORE_FILE
+TOMBSTONES_FILE = "tombstones.npy"
+LOCK_FILE = "LOCK"
+INDEX_ARRAYS = ("hashes", "offsets", "song_ids", "times")
+COMPRESSION_CODECS = (None, "bitpack")
+FILTER_FILE = "filter.npy"
+
+# plain segments smaller than this are binary-searched within the CPU caches,
+# which is cheaper than testing a filter first
+FILTER_MIN_KEYS = 1 << 20
+
+# meta_save starts a background compaction once this many segments pile up
+MAX_SEGMENTS = 16
+
+_thread_lock = threading.Lock()
+_compaction_lock = threading.Lock()
+
+
+def is_database(path):
+    """Returns True if path is a database directory in this format"""
+    return (Path(path) / MANIFEST_FILE).is_file()
+
+
+def analysis_params(manifest):
+    """Returns the frontend.AnalysisParams a database was built with
+
+    Databases from before the parameters were recorded used LEGACY_PARAMS.
+    """
+    if "analysis" not in manifest:
+        return fe.LEGACY_PARAMS
+    return fe.AnalysisParams(**manifest["analysis"])
+
+
+def read_manifest(path):
+    """Reads and validates the manifest of the database at path
+
+    Version 1 manifests, which point at a single "index" directory, are
+    read as a database with one segment.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+
+    Returns
+    -------
+    dict
+    """
+    with open(Path(path) / MANIFEST_FILE, mode="r") as opened_file:
+        manifest = json.load(opened_file)
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a {FORMAT_NAME} database")
+    if manifest.get("version") == 1:
+        manifest = {
+            "format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "segments": [manifest["index"]],
+            "next_segment": manifest["generation"] + 1,
+            "num_songs": manifest["num_songs"],
+        }
+    if manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(
+            f"{path} uses format version {manifest.get('version')}, expected {FORMAT_VERSION}"
+        )
+    return manifest
+
+
+def _write_json(file_name, data):
+    """Writes data to file_name atomically"""
+    tmp_name = f"{file_name}.tmp"
+    with open(tmp_name, mode="w") as opened_file:
+        json.dump(data, opened_file)
+    os.replace(tmp_name, file_name)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Holds the database's write lock for the duration of the with-block"""
+    with _thread_lock, open(Path(path) / LOCK_FILE, mode="a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_metadata(path):
+    """Opens the metadata table of the database at path
+
+    Only the SQLite file is opened; rows are read as they are looked up.
+
+    Returns
+    -------
+    metadata_store.MetadataTable
+        {song ID (int): metadata dict}
+    """
+    return ms.MetadataTable(ms.MetadataStore(path))
+
+
+def save_metadata(path, metadata):
+    """Saves the metadata table of the database at path
+
+    A MetadataTable of this database writes only its changes; any other
+    mapping replaces the whole table.
+    """
+    if isinstance(metadata, ms.MetadataTable) and metadata.store.path == Path(path):
+        metadata.commit()
+    else:
+        ms.MetadataStore(path).replace(dict(metadata.items()))
+
+
+def load_tombstones(path):
+    """Loads the tombstone bitmap of the database at path
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        deleted[song_id] is True for removed songs; empty if none were removed
+    """
+    try:
+        return np.unpackbits(np.load(Path(path) / TOMBSTONES_FILE)).astype(bool)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=bool)
+
+
+def save_tombstones(path, deleted):
+    """Adds the removed songs in deleted to the tombstone bitmap of the database at path
+
+    Bits already set on disk, e.g. by another writer, are kept.
+    """
+    path = Path(path)
+    with _locked(path):
+        on_disk = load_tombstones(path)
+        merged = np.zeros(max(on_disk.size, deleted.size), dtype=bool)
+        merged[:on_disk.size] |= on_disk
+        merged[:deleted.size] |= deleted
+        tmp_name = path / f"{TOMBSTONES_FILE}.tmp.npy"
+        np.save(tmp_name, np.packbits(merged))
+        os.replace(tmp_name, path / TOMBSTONES_FILE)
+
+
+def open_segment(segment_dir):
+    """Memory-maps one segment directory as a read-only FingerprintIndex or CompressedIndex"""
+    segment_dir = Path(segment_dir)
+    if (segment_dir / "data.npy").is_file():
+        names, segment_class = ci.ARRAYS, ci.CompressedIndex
+    else:
+        names, segment_class = INDEX_ARRAYS, FingerprintIndex
+    arrays = {name: np.load(segment_dir / f"{name}.npy", mmap_mode="r") for name in names}
+    segment = segment_class(**arrays)
+    if (segment_dir / FILTER_FILE).is_file():
+        segment.key_filter = bf.BlockedBloomFilter(np.load(segment_dir / FILTER_FILE, mmap_mode="r"), len(segment))
+    return segment
+
+
+def _filter_bits(manifest):
+    """Returns the filter bits per key new segments of a database get; 0 means no filters"""
+    return manifest.get("filter_bits", bf.DEFAULT_BITS_PER_KEY)
+
+
+def _wants_filter(num_keys, compressed, filter_bits):
+    """Returns True if a segment of this size and kind is worth a key filter"""
+    return filter_bits > 0 and (compressed or num_keys >= FILTER_MIN_KEYS)
+
+
+def _key_filter(segment, filter_bits):
+    keys = segment.key_hashes() if isinstance(segment, ci.CompressedIndex) else segment.hashes
+    return bf.BlockedBloomFilter.from_hashes(keys, filter_bits)
+
+
+def _write_segment(segment_dir, segment, compression=None, filter_bits=0):
+    """Writes a FingerprintIndex into a new segment directory
+
+    The segment is bit-packed when compression is set and gets a key filter
+    of filter_bits bits per key when `_wants_filter` says so.
+    """
+    compressed = compression == "bitpack" or isinstance(segment, ci.CompressedIndex)
+    key_filter = None
+    if _wants_filter(len(segment), compressed, filter_bits):
+        key_filter = _key_filter(segment, filter_bits)
+    if compressed and not isinstance(segment, ci.CompressedIndex):
+        segment = ci.CompressedIndex.from_index(segment)
+    names = ci.ARRAYS if isinstance(segment, ci.CompressedIndex) else INDEX_ARRAYS
+    segment_dir.mkdir()
+    for name in names:
+        np.save(segment_dir / f"{name}.npy", np.ascontiguousarray(getattr(segment, name)))
+    if key_filter is not None:
+        np.save(segment_dir / FILTER_FILE, key_filter.blocks)
+
+
+def reserve_song_ids(path, count=1):
+    """Hands out count new song IDs of the database at path
+
+    The IDs are taken from the manifest's num_songs under the write lock, so
+    two processes adding songs at once get different IDs. IDs whose songs are
+    never saved, e.g. because the writer failed, are left unused.
+
+    Returns
+    -------
+    int, the first of the count consecutive IDs
+    """
+    with _locked(path):
+        manifest = read_manifest(path)
+        first = manifest["num_songs"]
+        manifest["num_songs"] = first + count
+        _write_json(Path(path) / MANIFEST_FILE, manifest)
+    return first
+
+
+def _reserve_segment_name(path):
+    """Claims the next unused segment directory name of the database at path"""
+    with _locked(path):
+        manifest = read_manifest(path)
+        name = f"seg-{manifest['next_segment']:06d}"
+        manifest["next_segment"] += 1
+        _write_json(Path(path) / MANIFEST_FILE, manifest)
+    return name
+
+
+def open_index(path, manifest=None):
+    """Memory-maps every segment of the database at path
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+    manifest : dict, optional; read from disk when omitted
+
+    Returns
+    -------
+    SegmentedIndex
+        backed by read-only np.memmap arrays
+    """
+    path = Path(path)
+    for attempt in range(3):
+        if manifest is None:
+            manifest = read_manifest(path)
+        try:
+            segments = [open_segment(path / name) for name in manifest["segments"]]
+            break
+        except FileNotFoundError:
+            # a compaction removed a segment between reading the manifest and opening it
+            if attempt == 2:
+                raise
+            manifest = None
+    return SegmentedIndex(segments, manifest["segments"], manifest["num_songs"],
+                          analysis_params(manifest), manifest.get("shards", 1), load_tombstones(path),
+                          manifest.get("max_postings"), manifest.get("weighting"))
+
+
+def save_index(path, index):
+    """Writes the pending segments of index to the database at path
+
+    Only segments added since the index was opened are written; existing
+    segments are left untouched. Afterwards the new segments in index are
+    swapped for their memory-mapped copies.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+    index : SegmentedIndex
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    written = []
+    for segment in index.pending:
+        name = _reserve_segment_name(path)
+        _write_segment(path / name, segment, manifest.get("compression"), _filter_bits(manifest))
+        written.append(name)
+
+    with _locked(path):
+        manifest = read_manifest(path)
+        manifest["segments"] = manifest["segments"] + written
+        manifest["num_songs"] = max(manifest["num_songs"], index.num_songs)
+        _write_json(path / MANIFEST_FILE, manifest)
+
+    index.segments += [open_segment(path / name) for name in written]
+    index.names += written
+    index.pending = []
+    index.generation += 1
+    return manifest
+
+
+def compact_database(path, background=False):
+    """Merges every segment of the database at path into a single segment
+
+    Queries that opened the database before or during compaction keep using
+    their snapshot of the old segments. Segments saved while the compaction
+    runs are kept alongside the merged one. Postings of removed songs are
+    dropped from the merged segment.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+    background : bool, if True run in a background thread and return it
+
+    Returns
+    -------
+    threading.Thread if background is True, otherwise None
+    """
+    if background:
+        thread = threading.Thread(target=compact_database, args=(path,))
+        thread.start()
+        return thread
+
+    if not _compaction_lock.acquire(blocking=False):
+        return None  # this process is already compacting
+    try:
+        _compact(Path(path))
+    finally:
+        _compaction_lock.release()
+    return None
+
+
+def _compact(path):
+    """Does the work of `compact_database`"""
+    index = open_index(path)
+    merged_names = index.names
+    if len(merged_names) == 0:
+        return
+    if len(merged_names) == 1 and not (index.deleted.any()
+                                       and not index.is_live(index.segments[0].postings()[1]).all()):
+        return
+
+    name = _reserve_segment_name(path)
+    manifest = read_manifest(path)
+    _write_segment(path / name, index.compacted(), manifest.get("compression"), _filter_bits(manifest))
+
+    with _locked(path):
+        manifest = read_manifest(path)
+        if not set(merged_names) <= set(manifest["segments"]):
+            # another compaction already replaced some of these segments
+            shutil.rmtree(path / name, ignore_errors=True)
+            return
+        added_since = [segment for segment in manifest["segments"] if segment not in merged_names]
+        manifest["segments"] = [name] + added_since
+        _write_json(path / MANIFEST_FILE, manifest)
+
+    # readers that still map the old segments keep their open file handles
+    for old_name in merged_names:
+        shutil.rmtree(path / old_name, ignore_errors=True)
+
+
+def create_database(path, params=fe.DEFAULT_PARAMS, shards=1, max_postings=None, weighting=None,
+                    compression=None, filter_bits=bf.DEFAULT_BITS_PER_KEY):
+    """Initializes an empty database directory at path
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, directory to create; must not already hold a database
+    params : frontend.AnalysisParams, analysis settings every song and query
+             of this database is fingerprinted with
+    shards : int, number of hash ranges each query is split into and searched
+             in parallel; about one per core for large catalogs
+    max_postings, weighting : query settings, see `configure_queries`
+    compression : str, optional; "bitpack" stores segments bit-packed (see
+                  compressed_index), about 4x smaller for somewhat slower lookups
+    filter_bits : float, bits per key of the Bloom filters written in front of
+                  large and bit-packed segments (see bloom_filter); 0 writes none
+    """
+    if compression not in COMPRESSION_CODECS:
+        raise ValueError(f"compression must be one of {COMPRESSION_CODECS}, not {compression!r}")
+    if filter_bits < 0:
+        raise ValueError("filter_bits must not be negative")
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    path = Path(path)
+    if is_database(path):
+        raise FileExistsError(f"{path} already contains a database")
+    path.mkdir(parents=True, exist_ok=True)
+
+    save_metadata(path, {})
+    _write_json(path / MANIFEST_FILE, {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "analysis": params._asdict(),
+        "shards": shards,
+        "max_postings": max_postings,
+        "weighting": weighting,
+        "compression": compression,
+        "filter_bits": filter_bits,
+        "segments": [],
+        "next_segment": 0,
+        "num_songs": 0,
+    })
+
+
+def configure_queries(path, max_postings=None, weighting=None):
+    """Changes how queries against the database at path are scored
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+    max_postings : int, optional; query hashes with more postings than this
+                   are skipped as too common to tell songs apart
+    weighting : str, optional; "idf" weights every vote by the rarity of its
+                key (manageFingerprints.idf_weights), None counts votes equally
+    """
+    if weighting not in (None, "idf"):
+        raise ValueError(f"weighting must be None or 'idf', not {weighting!r}")
+    with _locked(path):
+        manifest = read_manifest(path)
+        manifest["max_postings"] = max_postings
+        manifest["weighting"] = weighting
+        _write_json(Path(path) / MANIFEST_FILE, manifest)
+
+
+def build_filters(path):
+    """Writes the key filters missing from the segments of the database at path
+
+    Segments saved before filters existed, or while filter_bits was 0, get
+    the filter `_write_segment` would give them now. Segments are immutable,
+    so the filter files are written next to them without taking the lock;
+    processes that already opened the database pick them up on reopening.
+
+    Returns
+    -------
+    list of str, the names of the segments that got a filter
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    filter_bits = _filter_bits(manifest)
+    built = []
+    for name in manifest["segments"]:
+        try:
+            segment = open_segment(path / name)
+        except FileNotFoundError:
+            continue  # compacted away since the manifest was read
+        compressed = isinstance(segment, ci.CompressedIndex)
+        if segment.key_filter is not None or not _wants_filter(len(segment), compressed, filter_bits):
+            continue
+        tmp_name = path / name / f"{FILTER_FILE}.tmp.npy"
+        np.save(tmp_name, _key_filter(segment, filter_bits).blocks)
+        os.replace(tmp_name, path / name / FILTER_FILE)
+        built.append(name)
+    return built
+
+
+def database_version(path):
+    """Returns a token that changes whenever songs are added to or removed from the database at path
+
+    The manifest and tombstone bitmap are always replaced with new files
+    (os.replace), so their inode, size and modification time identify a
+    version; a process holding an open database compares tokens to notice
+    that another one has saved changes.
+    """
+    version = []
+    for name in (MANIFEST_FILE, TOMBSTONES_FILE):
+        try:
+            stat = os.stat(Path(path) / name)
+        except FileNotFoundError:
+            version.append(None)
+            continue
+        version.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+
+def open_database(path):
+    """Opens the database at path
+
+    Returns
+    -------
+    Tuple[dict, SegmentedIndex]
+        (metadata, database); the index is memory-mapped read-only
+    """
+    with inst.stage("db_load"):
+        return load_metadata(path), open_index(path)
+
+
+def save_database(path, metadata, index):
+    """Saves both the metadata table and the new segments of index to the database at path
+
+    Songs removed from index are added to the tombstone bitmap. Starts a
+    background compaction when the database has more than MAX_SEGMENTS segments.
+
+    Returns
+    -------
+    threading.Thread or None
+        the background compaction, if one was started
+    """
+    with inst.stage("db_save"):
+        # tombstones go before and new songs after the metadata, so a reader
+        # never matches a song it has no metadata for
+        if index.deleted.any():
+            save_tombstones(path, index.deleted)
+        save_metadata(path, metadata)
+        manifest = save_index(path, index)
+    if len(manifest["segments"]) > MAX_SEGMENTS:
+        return compact_database(path, background=True)
+    return None
@@ -0,0 +1,144 @@
+"""Instrumentation
+optional timers, counters and memory high-water marks for the recognition pipeline
+
+Pipeline functions mark their work with
+
+    with instrumentation.stage("spectrogram"):
+        ...
+    instrumentation.count("peaks", len(peaks))
+
+Nothing is measured until a listener is added: `stage` then returns a shared
+do-nothing context manager and `count` returns right away, so the hooks cost
+one function call each when profiling is off.
+
+A listener is any callable taking one event dict:
+
+    {"event": "stage", "name": ..., "seconds": ..., "max_rss": ..., "rss_growth": ...}
+    {"event": "count", "name": ..., "value": ...}
+
+max_rss is the process's peak resident set size in bytes when the stage
+ended and rss_growth how much that peak rose during the stage. `Metrics`
+is a listener that adds the events up. Work done in worker processes (e.g.
+by interface_functions.add_songs) is not seen by listeners in the parent.
+"""
+import contextlib
+import sys
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:  # Windows; memory is not reported
+    resource = None
+
+_listeners = []
+_disabled_stage = contextlib.nullcontext()
+
+
+def max_rss():
+    """Returns the peak resident set size of this process so far, in bytes (0 if unknown)"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def enabled():
+    """Returns True if any listener is registered"""
+    return bool(_listeners)
+
+
+def add_listener(listener):
+    """Registers a callable that receives every event"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Unregisters a listener added with `add_listener`"""
+    _listeners.remove(listener)
+
+
+def stage(name):
+    """Returns a context manager that times the with-block as stage name
+
+    Stages may nest; each reports its own inclusive time.
+    """
+    if not _listeners:
+        return _disabled_stage
+    return _timed_stage(name)
+
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    rss_before = max_rss()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rss_after = max_rss()
+        _emit({"event": "stage", "name": name, "seconds": seconds,
+               "max_rss": rss_after, "rss_growth": rss_after - rss_before})
+
+
+def count(name, value=1):
+    """Adds value to the counter name"""
+    if _listeners:
+        _emit({"event": "count", "name": name, "value": int(value)})
+
+
+def _emit(event):
+    for listener in list(_listeners):
+        listener(event)
+
+
+class Metrics:
+    """Listener that totals stage times and counters
+
+    Use as a context manager to listen only for the duration of a with-block:
+
+        with instrumentation.Metrics() as metrics:
+            interface_functions.find_song(0, "clip.mp3", "database")
+        metrics.print_report()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max_rss": 0, "rss_growth": 0})
+        self.counters = defaultdict(int)
+
+    def __call__(self, event):
+        with self._lock:
+            if event["event"] == "count":
+                self.counters[event["name"]] += event["value"]
+                return
+            totals = self.stages[event["name"]]
+            totals["calls"] += 1
+            totals["seconds"] += event["seconds"]
+            totals["max_rss"] = max(totals["max_rss"], event["max_rss"])
+            totals["rss_growth"] += event["rss_growth"]
+
+    def __enter__(self):
+        add_listener(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_listener(self)
+
+    def report(self):
+        """Returns the totals as a plain dict, e.g. for json.dump"""
+        with self._lock:
+            return {"stages": {name: dict(totals) for name, totals in self.stages.items()},
+                    "counters": dict(self.counters)}
+
+    def print_report(self):
+        """Prints one row per stage followed by the counters"""
+        report = self.report()
+        print(f"{'stage':<20} {'calls':>6} {'seconds':>9} {'peak RSS MB':>12} {'RSS growth MB':>14}")
+        for name, totals in report["stages"].items():
+            print(f"{name:<20} {totals['calls']:>6} {totals['seconds']:>9.3f} "
+                  f"{totals['max_rss'] / 2 ** 20:>12.1f} {totals['rss_growth'] / 2 ** 20:>14.1f}")
+        for name, value in report["counters"].items():
+            print(f"{name:<20} {value:>12}")
@@ -12,67 +12,174 @@ guarding against the adding the same song to the database multiple times (option
 Parameters
 ---------------
 metadata = a dictionary with {song ID: [Title: song_title, Name: song_name, Genre : genre_name] }
-database = a dictionary with parameter fingerprints (key): list of song IDs
+database = a fingerprint_index.SegmentedIndex mapping packed (f1, f2, delta t) fingerprints
+           to postings of (song ID, anchor time); song IDs are dense ints
 matchdatabase = a dictionary with {song ID: fingerprints}
 file_name = seperate file
 """
+import collections
+import csv
+import functools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pickle 
-import uuid
-import matplotlib.pyplot as plt
-from microphone import record_audio
-import librosa as lib
-import matplotlib.mlab as mlab
 from pathlib import Path
 import conversion as c
-import find_peaks as fp
+import fingerprint_cache as fc
+import fingerprint_index as fi
+import frontend as fe
+import index_storage as storage
 import manageFingerprints as mf
+import query_cache as qc
 import song_metadata as sm
-from scipy.ndimage.morphology import generate_binary_structure
+import streaming
+
+AUDIO_EXTENSIONS = {".mp3", ".wav", ".flac", ".ogg", ".m4a"}
+# spectrogram columns (~0.5 s) searched for peaks at a time when listening live
+LIVE_WINDOW_FRAMES = 10
+# smallest manageFingerprints.match_song confidence reported as a match by find_song
+MIN_CONFIDENCE = 0.5
+
+# {database directory: (version, metadata, database)} opened by open_for_queries
+_query_databases = {}
 
-metadata = {}
-database = {}
 def meta_save(metadata, database, file_name):
-    """Saves both complete databases onto a specified file.
+    """Saves both complete databases into a specified database directory.
 
-    Generates a tuple, for which the first element is the metadata database
-    and the second element is the song fingerprint database. Saves the tuple
-    to a file specified by file_name. 
+    Writes the metadata table, and the fingerprints added since the database
+    was loaded as new index segments, into the database directory specified
+    by file_name (see index_storage). Existing segments are not rewritten.
 
     Parameters
     ----------
     metadata : dict, stores song ID #'s as keys and known song
                metadata as values
-    database : dict, stores song fingerprints as keys and songs that
-               have those fingerprints as values
-    file_name : string, points to file in which the two databases will
-                be saved
+    database : SegmentedIndex, stores song fingerprints as keys and songs
+               that have those fingerprints as values
+    file_name : string, points to the database directory in which the two
+                databases will be saved
     """
 
-    with open(file_name, mode ="wb") as opened_file:
-        pickle.dump((metadata, database), opened_file)
+    storage.save_database(file_name, metadata, database)
 
 def meta_load(file_name):
-    """Loads both complete databases from a specified file.
+    """Loads both complete databases from a specified database directory.
+
+    The fingerprint index is memory-mapped rather than read, so loading takes
+    the same time regardless of how many songs are in the database.
+
+    Parameters
+    ----------
+    file_name : string, points to the database directory from which the two
+                databases will be loaded
+
+    Returns
+    -------
+    Tuple[dict, SegmentedIndex]
+        (metadata, database)
+    """
+
+    return storage.open_database(file_name)
+
+def open_for_queries(file_path):
+    """Opens a database for queries, reusing this process's open copy and its caches
+
+    The first call opens the database and attaches a posting-list cache and
+    a result cache (see query_cache). Later calls return the same objects
+    until songs are added or removed, by this process (e.g. `add_song`) or
+    by another one; the database is then reopened with empty caches.
 
-    Saves the two dictionary elements of the tuple from the specified file
-    as the global variables "metadata" and "database", respectively.
     Parameters
     ----------
-    file_name : string, points to file from which the two databases will
-                be saved
+    file_path : string, points to the database directory
+
+    Returns
+    -------
+    Tuple[dict, SegmentedIndex]
+        (metadata, database)
+    """
+    key = Path(file_path).resolve()
+    version = storage.database_version(file_path)
+    cached = _query_databases.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    metadata, database = meta_load(file_path)
+    qc.attach(database)
+    _query_databases[key] = (version, metadata, database)
+    return metadata, database
+
+def compact_database(file_path):
+    """Merges the index segments of a database into one to speed up queries
+
+    Parameters
+    ----------
+    file_path : string, points to the database directory
+    """
+
+    storage.compact_database(file_path)
+    print("Database compacted.")
+
+def fingerprint_file(mp3_file_path, params=fe.DEFAULT_PARAMS, stream=False):
+    """Decodes an audio file and returns its fingerprints
+
+    Parameters
+    ------------
+    mp3_file_path : string, points to the audio file to fingerprint
+    params : frontend.AnalysisParams, analysis settings; use the database's
+             (database.params) so songs and queries match
+    stream : bool, if True decode and fingerprint the file block by block
+             (see streaming), which keeps memory bounded for long files such
+             as DJ mixes; the amplitude threshold is then taken per window
+             of the spectrogram instead of over the whole song
+
+    Returns
+    ------------
+    numpy.ndarray, shape-(N, 4); one (f1, f2, delta t, t_anchor) row per fingerprint
+    """
+    if stream:
+        return np.concatenate([np.zeros((0, 4), dtype=np.int64)]
+                              + list(streaming.stream_fingerprints(mp3_file_path, params)))
+    samples, rate = c.load_samples(mp3_file_path, params.sampling_rate)
+    return fe.fingerprint_samples(samples, rate, params)
+
+def packed_fingerprints(mp3_file_path, params=fe.DEFAULT_PARAMS, stream=False, content_hash=None,
+                        cache_dir=fc.DEFAULT_CACHE_DIR):
+    """Returns the packed fingerprints of an audio file, from the fingerprint cache when possible
+
+    Parameters
+    ------------
+    mp3_file_path, params, stream : see `fingerprint_file`
+    content_hash : string, optional; fingerprint_cache.file_hash of the file,
+                   computed when omitted
+    cache_dir : string or Path, fingerprint cache directory; None disables the cache
+
+    Returns
+    ------------
+    (hashes, times) - see fingerprint_index.pack_fingerprints
     """
+    if cache_dir is None:
+        return fi.pack_fingerprints(fingerprint_file(mp3_file_path, params, stream))
+    if content_hash is None:
+        content_hash = fc.file_hash(mp3_file_path)
+    cached = fc.load(cache_dir, content_hash, params, stream)
+    if cached is not None:
+        return cached
+    hashes, times = fi.pack_fingerprints(fingerprint_file(mp3_file_path, params, stream))
+    fc.store(cache_dir, content_hash, params, hashes, times, stream)
+    return hashes, times
 
-    with open(file_name, mode="rb") as opened_file:
-        metadata, database  = pickle.load(opened_file)
-    return metadata,database
+def indexed_files(metadata):
+    """Returns {content hash: song ID} for every song whose file hash is known"""
+    return {data["content_hash"]: song_id for song_id, data in metadata.items() if "content_hash" in data}
 
-def add_song(mp3_file_path, file_path):
+def add_song(mp3_file_path, file_path, info=None):
     """Processes and adds the song (mp3 file) into the database of songs
     
     Collects the digital audio data from the file by creating samples out 
-    of the file. Then creates and addd fingerprints to a dict(database) with
-    its value as a generated song_id from uuid. Prompts the user for data
+    of the file. Then creates and addd fingerprints to the fingerprint index
+    (database) under a new song_id reserved with index_storage.reserve_song_ids. Prompts the user for data
     about the song and adds the song_id as the key and the song's data as a 
     dictionary onto another dict(metadata)
     
@@ -80,21 +187,241 @@ def add_song(mp3_file_path, file_path):
     ------------
     mp3_file_path : string, points to file for a song that will be processed
                     and added to the database
-    file_path : file, consists of tuple(metadata, database) that will be updated 
-    as songs and fingerprints are added into both dictionaries.
+    file_path : database directory, consists of (metadata, database) that will be
+    updated as songs and fingerprints are added into both.
+    info : dict, optional; known title/artist/genre of the song. The user is
+           only prompted for them if info is None
+
+    Returns
+    ------------
+    int or None; the new song ID, or None if the file was already in the database
     """ 
     metadata, database = meta_load(file_path)
-    spectrogram, rate  = c.file_to_samples(mp3_file_path)
-    fpe = generate_binary_structure(2, 1)
-    threshold = np.percentile(spectrogram, 75) #75th percentile amplitude
-    peaks = fp.local_peak_locations(spectrogram, fpe, threshold)
-    fingerprints = fp.create_fingerprints(peaks)
-    song_id = uuid.uuid1()
+    content_hash = fc.file_hash(mp3_file_path)
+    song_id = metadata.find_content_hash(content_hash)
+    if song_id is not None:
+        print("This song is already in the database as \"" + sm.get_metadata(metadata, song_id, "title") + "\".")
+        return
+    fingerprints = fi.unpack_fingerprints(*packed_fingerprints(mp3_file_path, database.params,
+                                                                content_hash=content_hash))
+    song_id = storage.reserve_song_ids(file_path)
     updated_database = mf.add_fingerprints(fingerprints, song_id, database)
     database = updated_database
-    meda = sm.add_metadata(len(fingerprints))
+    if info is None:
+        meda = sm.add_metadata(len(fingerprints))
+        meda["content_hash"] = content_hash
+    else:
+        meda = sm.make_metadata(len(fingerprints), content_hash=content_hash, **info)
     metadata[song_id] = meda
     meta_save(metadata,database,file_path)
+    return song_id
+
+
+def remove_song(song_id, file_path):
+    """Removes a song from the database
+
+    The song's ID is only marked as deleted in the index's tombstone bitmap,
+    which queries filter on, so removing takes the same time however large
+    the database is. Its postings are physically dropped the next time the
+    database is compacted.
+
+    Parameters
+    ------------
+    song_id : int, ID of the song to remove
+    file_path : string, points to the database directory
+
+    Returns
+    ------------
+    dict, the removed song's metadata
+    """
+    metadata, database = meta_load(file_path)
+    if song_id not in metadata:
+        raise KeyError(f"song {song_id} is not in the database")
+    database.remove(song_id)
+    removed = metadata.pop(song_id)
+    meta_save(metadata, database, file_path)
+    return removed
+
+def replace_song(song_id, mp3_file_path, file_path):
+    """Replaces the audio of a song, keeping its title, artist and genre
+
+    The old song is removed as in `remove_song` and the new audio is added
+    under a new song ID, which is returned.
+
+    Parameters
+    ------------
+    song_id : int, ID of the song to replace
+    mp3_file_path : string, points to the new audio file
+    file_path : string, points to the database directory
+
+    Returns
+    ------------
+    int, the song's new ID
+    """
+    metadata, database = meta_load(file_path)
+    if song_id not in metadata:
+        raise KeyError(f"song {song_id} is not in the database")
+    content_hash = fc.file_hash(mp3_file_path)
+    hashes, times = packed_fingerprints(mp3_file_path, database.params, content_hash=content_hash)
+    new_id = storage.reserve_song_ids(file_path)
+    database.remove(song_id)
+    database.add_postings(hashes, np.full(hashes.size, new_id, dtype=fi.SONG_DTYPE), times)
+    old = metadata.pop(song_id)
+    metadata[new_id] = sm.make_metadata(int(hashes.size), old.get("title"), old.get("artist"),
+                                        old.get("genre"), content_hash)
+    meta_save(metadata, database, file_path)
+    return new_id
+
+def read_song_list(source):
+    """Lists the songs to ingest from a directory or a manifest file
+
+    Parameters
+    ------------
+    source : string or Path; either a directory, which is searched recursively
+             for audio files, or a .csv/.json manifest. A CSV manifest has a
+             header with the columns path, title, artist, genre; a JSON manifest
+             is a list of objects with the same keys. Relative paths are taken
+             relative to the manifest.
+
+    Returns
+    ------------
+    list of (Path, dict) pairs; the audio file and its known title/artist/genre
+    """
+    source = Path(source)
+    if source.is_dir():
+        return [(path, {"title": path.stem}) for path in sorted(source.rglob("*"))
+                if path.suffix.lower() in AUDIO_EXTENSIONS]
+
+    if source.suffix.lower() == ".csv":
+        with open(source, mode="r", newline="") as opened_file:
+            rows = list(csv.DictReader(opened_file))
+    elif source.suffix.lower() == ".json":
+        with open(source, mode="r") as opened_file:
+            rows = json.load(opened_file)
+    else:
+        raise ValueError(f"{source} is neither a directory nor a .csv/.json manifest")
+
+    songs = []
+    for row in rows:
+        path = Path(row["path"])
+        if not path.is_absolute():
+            path = source.parent / path
+        songs.append((path, {key: row.get(key) for key in ("title", "artist", "genre")}))
+    return songs
+
+def _fingerprint_job(mp3_file_path, content_hash, params, stream=False, cache_dir=fc.DEFAULT_CACHE_DIR):
+    """Worker for `add_songs`; returns (hashes, times, error) for one file
+
+    Fingerprints are sent back packed, which is far cheaper to pickle between
+    processes than a list of tuples.
+    """
+    try:
+        hashes, times = packed_fingerprints(mp3_file_path, params, stream, content_hash, cache_dir)
+    except Exception as error:
+        return None, None, f"{type(error).__name__}: {error}"
+    return hashes, times, None
+
+def add_songs(source, file_path, workers=None, batch_size=100, stream=False, cache_dir=fc.DEFAULT_CACHE_DIR):
+    """Processes and adds every song listed by a directory or manifest
+    
+    Files are decoded and fingerprinted in a pool of worker processes, while
+    this process is the single writer that collects their fingerprints. Each
+    batch of batch_size songs is saved as one new index segment instead of
+    once per song, and no metadata is prompted for.
+
+    Files whose contents are already in the database (or earlier in source)
+    are skipped, and fingerprints are taken from the fingerprint cache when
+    the same file was analysed with the same settings before.
+    
+    Parameters
+    ------------
+    source : string or Path, directory or manifest understood by `read_song_list`
+    file_path : database directory that will be updated
+    workers : int, optional; number of worker processes, defaults to the CPU count
+    batch_size : int, number of songs merged into the index per save
+    stream : bool, fingerprint each file block by block, see `fingerprint_file`
+    cache_dir : string or Path, fingerprint cache directory; None disables the cache
+
+    Returns
+    ------------
+    dict with the number of songs added, skipped as duplicates and failed,
+    fingerprints added, and the overall files/sec and fingerprints/sec
+    """
+    metadata, database = meta_load(file_path)
+    start = time.perf_counter()
+    added = failed = skipped = total_fingerprints = 0
+
+    hashed = []
+    for path, info in read_song_list(source):
+        try:
+            hashed.append((path, info, fc.file_hash(path)))
+        except OSError as error:
+            print(f"Skipping {path}: {type(error).__name__}: {error}")
+            failed += 1
+    # one indexed query for the whole source instead of reading every song's metadata
+    known = set(metadata.find_content_hashes(content_hash for path, info, content_hash in hashed))
+    songs = []
+    for path, info, content_hash in hashed:
+        if content_hash in known:
+            skipped += 1
+            continue
+        known.add(content_hash)
+        songs.append((path, info, content_hash))
+    total = len(songs) + failed
+    batch = []
+
+    def commit():
+        if batch:
+            # IDs are reserved per batch so concurrent writers never share one
+            song_ids = []
+            for song_id, (hashes, times, data) in enumerate(batch, storage.reserve_song_ids(file_path, len(batch))):
+                metadata[song_id] = data
+                song_ids.append(np.full(hashes.size, song_id, dtype=fi.SONG_DTYPE))
+            database.add_postings(np.concatenate([hashes for hashes, times, data in batch]), np.concatenate(song_ids),
+                                  np.concatenate([times for hashes, times, data in batch]))
+            meta_save(metadata, database, file_path)
+            batch.clear()
+        elapsed = time.perf_counter() - start
+        print(f"{added + failed}/{total} files, {added / elapsed:.2f} files/sec, "
+              f"{total_fingerprints / elapsed:.0f} fingerprints/sec")
+
+    def collect(song, job):
+        nonlocal added, failed, total_fingerprints
+        path, info, content_hash = song
+        hashes, times, error = job.result()
+        if error is not None:
+            print(f"Skipping {path}: {error}")
+            failed += 1
+            return
+        batch.append((hashes, times, sm.make_metadata(int(hashes.size), content_hash=content_hash, **info)))
+        added += 1
+        total_fingerprints += hashes.size
+        if len(batch) >= batch_size:
+            commit()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        fingerprint = functools.partial(_fingerprint_job, params=database.params, stream=stream, cache_dir=cache_dir)
+        # keep at most batch_size files per worker in flight, so finished
+        # fingerprints don't pile up in memory while a batch is being saved
+        window = batch_size * (workers or os.cpu_count() or 1)
+        pending = collections.deque()
+        for song in songs:
+            pending.append((song, executor.submit(fingerprint, song[0], song[2])))
+            if len(pending) >= window:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+    commit()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "added": added,
+        "skipped": skipped,
+        "failed": failed,
+        "fingerprints": total_fingerprints,
+        "files_per_sec": added / elapsed,
+        "fingerprints_per_sec": total_fingerprints / elapsed,
+    }
 
 
 def find_song(duration, mp3_file_path, file_path):
@@ -118,33 +445,256 @@ def find_song(duration, mp3_file_path, file_path):
     is then converted into a spectrogram to be used to find key fingerprints
     in the recording. These fingerprints, and the times in which they occur
     in the recording are compared to the existing database of songs and the 
-    best match is displayed for the user.
+    best match is displayed for the user if its confidence (see
+    manageFingerprints.match_song) is at least MIN_CONFIDENCE.
+
+    The database is opened with `open_for_queries`, so repeated calls in one
+    process share its caches: a clip whose fingerprints were matched before
+    is answered from the result cache.
+
+    Returns
+    ------------
+    list of manageFingerprints.Match; the ranked candidates, best first
     """ 
-    metadata, database = meta_load(file_path)
+    metadata, database = open_for_queries(file_path)
     if mp3_file_path is not None:
-        spectrogram, rate = c.file_to_samples(mp3_file_path)
+        samples, rate = c.load_samples(mp3_file_path, database.params.sampling_rate)
+    else:
+        samples, rate = c.record_samples(duration)
+    #samples -> fingerprint -> shortlist and verify candidates (match_song)
+    fingerprints = fe.fingerprint_samples(samples, rate, database.params)
+    hashes, times = fi.pack_fingerprints(fingerprints)
+    key = qc.query_digest(hashes, times, "match_song")
+    matches = database.result_cache.get(key)
+    if matches is None:
+        matches = mf.match_song(hashes, times, database)
+        database.result_cache.put(key, matches)
+    if not matches or matches[0].confidence < MIN_CONFIDENCE:
+        print("No match found. Please try again.")
+    else:
+        song_id = matches[0].song_id
+        print("You are currently listening to \"" + sm.get_metadata(metadata, song_id, "title") + "\" by " + sm.get_metadata(metadata, song_id, "artist") + ". Genre: " + sm.get_metadata(metadata, song_id, "genre"))
+        print(f"Confidence: {matches[0].confidence:.1%}")
+    return matches
+
+def _fingerprint_clip(clip, params):
+    """Worker for `find_songs`; returns (hashes, times, seconds, error) for one clip
+
+    clip is either an audio file path or a (samples, rate) pair.
+    """
+    start = time.perf_counter()
+    try:
+        if isinstance(clip, tuple):
+            fingerprints = fe.fingerprint_samples(clip[0], clip[1], params)
+        else:
+            fingerprints = fingerprint_file(clip, params)
+        hashes, times = fi.pack_fingerprints(fingerprints)
+    except Exception as error:
+        return None, None, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+    return hashes, times, time.perf_counter() - start, None
+
+def find_songs(source, file_path, window=None, hop=None, output=None, workers=None, batch_size=64,
+               min_confidence=MIN_CONFIDENCE):
+    """Identifies the song in every clip of a folder, or in every window of a long recording
+
+    The database is opened once (`open_for_queries`). Clips are fingerprinted
+    in a pool of worker processes, one clip per job (one FFT call per clip
+    beats one call over a batch of clips, see `benchmark.py --stft`), and
+    matched batch_size at a time with one shortlist
+    lookup per batch (`manageFingerprints.match_songs`), which ranks every
+    clip exactly as `find_song` would; clips with the same fingerprints as an
+    earlier clip, e.g. a jingle that recurs in a broadcast, are answered from
+    the result cache instead.
+
+    Parameters
+    ------------
+    source : string or Path; a directory or manifest of clips (see
+             `read_song_list`), or a single long recording when window is given
+    file_path : string, points to the database directory
+    window : float, optional; cut source into windows of this many seconds
+    hop : float, optional; seconds between window starts, defaults to window
+    output : string or Path, optional; write one result per clip to this file,
+             as CSV if it ends in .csv and as JSON lines otherwise
+    workers : int, optional; number of worker processes, defaults to the CPU count
+    batch_size : int, number of clips looked up together
+    min_confidence : float, smallest confidence of the best song that counts
+                     as a match, MIN_CONFIDENCE like `find_song` by default
+
+    Returns
+    ------------
+    list of dict, one per clip in order, with the keys clip, start (seconds
+    into source, window mode only), song_id (None when there is no match),
+    title, artist, score, offset (seconds into the song), confidence (see
+    `manageFingerprints.match_song`), matches (the ranked candidates, each a
+    dict with song_id, score, offset and confidence), fingerprints, latency
+    (seconds spent fingerprinting and looking up the clip) and error
+    """
+    metadata, database = open_for_queries(file_path)
+    params = database.params
+    hop_seconds = (params.nfft - params.noverlap) / params.sampling_rate
+    if window is not None:
+        clips = (((str(source), start), (samples, params.sampling_rate))
+                 for start, samples in c.window_samples(source, params.sampling_rate, window, hop))
     else:
-        spectrogram, rate = c.mic_to_samples(duration)
-    #mic_to_samples -> fingerprint -> tally -> highest tally (find_song_id)
-    fpe = generate_binary_structure(2, 1)
-    threshold = np.percentile(spectrogram, 75) #75th percentile amplitude
-    peaks = fp.local_peak_locations(spectrogram, fpe, threshold)
-    fingerprints = fp.create_fingerprints(peaks)
-    tallies = mf.tally_fingerprints(fingerprints, database)
-    song_id = mf.find_song_id(tallies, 0.05 ,len(fingerprints))
+        clips = (((str(path), None), path) for path, info in read_song_list(source))
+
+    results = []
+    writer = None
+    opened_file = open(output, mode="w", newline="") if output is not None else None
+
+    def finish(batch):
+        start = time.perf_counter()
+        keys = [qc.query_digest(hashes, times, "match_song") if error is None else None
+                for name, hashes, times, seconds, error in batch]
+        scored, queries = {}, {}
+        for key, (name, hashes, times, seconds, error) in zip(keys, batch):
+            if key is not None and key not in scored:
+                scored[key] = database.result_cache.get(key)
+                if scored[key] is None:
+                    queries[key] = (hashes, times)
+        for key, result in zip(queries, mf.match_songs(list(queries.values()), database) if queries else []):
+            scored[key] = result
+            database.result_cache.put(key, result)
+        lookup_seconds = (time.perf_counter() - start) / max(len(scored), 1)
+        finished = []
+        for key, ((clip, clip_start), hashes, times, seconds, error) in zip(keys, batch):
+            result = {"clip": clip, "start": clip_start, "song_id": None, "title": None, "artist": None,
+                      "score": 0, "offset": None, "confidence": 0.0, "matches": [], "fingerprints": 0,
+                      "latency": seconds, "error": error}
+            if error is None:
+                matches = [match._replace(offset=match.offset * hop_seconds)._asdict() for match in scored[key]]
+                result.update(matches=matches, fingerprints=int(hashes.size), latency=seconds + lookup_seconds)
+                if matches:
+                    result.update(score=matches[0]["score"], confidence=matches[0]["confidence"])
+                    if matches[0]["confidence"] >= min_confidence:
+                        result.update(song_id=matches[0]["song_id"], offset=matches[0]["offset"])
+            finished.append(result)
+        # one metadata query for every match in the batch
+        found = metadata.lookup(result["song_id"] for result in finished if result["song_id"] is not None)
+        for result in finished:
+            if result["song_id"] is not None:
+                result.update(title=found.get(result["song_id"], {}).get("title"),
+                              artist=found.get(result["song_id"], {}).get("artist"))
+            write(result)
+            results.append(result)
+
+    def write(result):
+        nonlocal writer
+        if opened_file is None:
+            return
+        if str(output).lower().endswith(".csv"):
+            if writer is None:
+                writer = csv.DictWriter(opened_file, fieldnames=list(result))
+                writer.writeheader()
+            writer.writerow({**result, "matches": json.dumps(result["matches"])})
+        else:
+            opened_file.write(json.dumps(result) + "\n")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # keep at most two batches of clips in flight so long recordings stream through
+            pending = []
+            batch = []
+            for name, clip in clips:
+                pending.append((name, executor.submit(_fingerprint_clip, clip, params)))
+                if len(pending) >= 2 * batch_size:
+                    for name, job in pending[:batch_size]:
+                        batch.append((name, *job.result()))
+                    del pending[:batch_size]
+                    finish(batch)
+                    batch = []
+            for name, job in pending:
+                batch.append((name, *job.result()))
+                if len(batch) >= batch_size:
+                    finish(batch)
+                    batch = []
+            if batch:
+                finish(batch)
+    finally:
+        if opened_file is not None:
+            opened_file.close()
+    return results
+
+def listen_for_song(max_duration, file_path, source=None, margin=2.0, min_score=20):
+    """Listens to the microphone and prints the song as soon as it is recognized
+
+    Audio is fingerprinted chunk by chunk as it arrives and each chunk's
+    matches are added to a running time-offset histogram. Listening stops
+    as soon as the best song's score is decisive (see
+    `manageFingerprints.OffsetVotes.is_decisive`), or after max_duration
+    seconds, in which case the 5% threshold of `manageFingerprints.find_song_id` applies.
+
+    Parameters
+    ------------
+    max_duration : float, longest time to listen for, in seconds
+    file_path : string, points to the database directory
+    source : iterable of (samples, rate) chunks, optional; defaults to
+             conversion.MicrophoneSource(); conversion.FileSource can stand
+             in for the microphone
+    margin : float, how many times the runner-up's score the best score must
+             reach to stop early
+    min_score : int, smallest best score that can stop early
+
+    Returns
+    ------------
+    (song_id, seconds) - the matched song_id or "No match found", and the
+    seconds of audio that were needed
+    """
+    metadata, database = open_for_queries(file_path)
+    if source is None:
+        source = c.MicrophoneSource()
+
+    stream = None
+    votes = mf.OffsetVotes()
+    num_fingerprints = 0
+    seconds = 0.0
+    for samples, rate in source:
+        if stream is None:
+            stream = streaming.FingerprintStream(rate, database.params, window_frames=LIVE_WINDOW_FRAMES)
+        seconds += len(samples) / rate
+        last = seconds >= max_duration
+        fingerprints = stream.push(samples, last=last)
+        num_fingerprints += len(fingerprints)
+        votes.add_matches(fingerprints, database)
+        if last or votes.is_decisive(margin, min_score):
+            break
+    else:
+        if stream is not None:
+            fingerprints = stream.flush()
+            num_fingerprints += len(fingerprints)
+            votes.add_matches(fingerprints, database)
+
+    if votes.is_decisive(margin, min_score):
+        song_id = mf.find_song_id(votes.tallies(), 0, 1)
+    else:
+        song_id = mf.find_song_id(votes.tallies(), 0.05, max(num_fingerprints, 1))
     if song_id == "No match found":
         print("No match found. Please try again.")
     else:
+        print(f"Recognized after {seconds:.1f} seconds of audio.")
         print("You are currently listening to \"" + sm.get_metadata(metadata, song_id, "title") + "\" by " + sm.get_metadata(metadata, song_id, "artist") + ". Genre: " + sm.get_metadata(metadata, song_id, "genre"))
-def print_song_database():
+    return song_id, seconds
+
+def print_song_database(file_path, offset=0, limit=None, text=None, title=None, artist=None, genre=None):
     """Prints out a list of songs that are already in the database
 
-    Song data is printed out in the format "(title) by (artist). Genre: (genre)"
-    """ 
+    Song data is printed out in the format "(song ID). (title) by (artist). Genre: (genre)".
+    Only the matching rows of the metadata table are read, not the
+    fingerprint index.
 
+    Parameters
+    ------------
+    file_path : database directory
+    offset, limit : int, optional; print only one page of songs
+    text, title, artist, genre : string, optional; print only the matching
+                                 songs, see metadata_store.MetadataStore.search
+    """ 
+    metadata = storage.load_metadata(file_path)
+    songs = metadata.search(text, title, artist, genre, offset, limit)
     print("List of Songs")
     print("------------------")
-    for key in metadata:
-        print("\"" + metadata[key][0] +"\" by "  + metadata[key][1] + ". Genre: " + metadata[key][2])
+    for song_id, data in songs:
+        print(f"{song_id}. \"" + data.get("title", "Unknown") + "\" by "
+              + data.get("artist", "Unknown") + ". Genre: " + data.get("genre", "Unknown"))
     print("------------------")
-
+    return songs
@@ -1,25 +1,146 @@
+import argparse
 import interface_functions as intFunc
+import instrumentation as inst
 from pathlib import Path
 
-# Main
+DATABASE_PATH = 'database'
+
 root = Path(".")
-print("Developed by @therealshazam\n")
-print("What would you like to do?")
-function = input("1. Add a Song\n2. Find a song\n")
-if function == '1':
-    song_path = root / input("Please enter the relative path to the .mp3 file: ")
-    intFunc.add_song(song_path, 'database.pickle')
-elif function == '2':
-    print("Would you like to record a song sample or import an audio file?")
-    method = input("1. Record a song sample\n2. Import an audio file\n")
-    if method == '1':
-        duration = input("How long is your song clip? ")
-        intFunc.find_song(int(duration), None, 'database.pickle')
-    elif method == '2':
+
+
+def menu(database_path):
+    """Asks what to do and does it, prompting for everything it needs"""
+    print("Developed by @therealshazam\n")
+    print("What would you like to do?")
+    function = input("1. Add a Song\n2. Find a song\n3. Add a folder or manifest of songs\n4. Compact the database\n5. Identify the songs in a folder of clips or a long recording\n6. Remove a song\n7. Replace a song's audio\n")
+    if function == '1':
         song_path = root / input("Please enter the relative path to the .mp3 file: ")
-        intFunc.find_song(0, song_path, 'database.pickle')
+        intFunc.add_song(song_path, database_path)
+    elif function == '2':
+        print("Would you like to record a song sample or import an audio file?")
+        method = input("1. Record a song sample\n2. Import an audio file\n3. Listen until the song is recognized\n")
+        if method == '1':
+            duration = input("How long is your song clip? ")
+            intFunc.find_song(int(duration), None, database_path)
+        elif method == '2':
+            song_path = root / input("Please enter the relative path to the .mp3 file: ")
+            intFunc.find_song(0, song_path, database_path)
+        elif method == '3':
+            max_duration = input("How many seconds should I listen for at most? ")
+            intFunc.listen_for_song(float(max_duration), database_path)
+        else:
+            print("Sorry something went wrong.")
+    elif function == '3':
+        source = root / input("Please enter the relative path to the folder or .csv/.json manifest: ")
+        print_summary(intFunc.add_songs(source, database_path))
+    elif function == '4':
+        intFunc.compact_database(database_path)
+    elif function == '5':
+        source = root / input("Please enter the relative path to the folder or .csv/.json manifest of clips, or the recording: ")
+        window = hop = None
+        if not (source.is_dir() or source.suffix.lower() in (".csv", ".json")):
+            window = float(input("How many seconds long is each window? "))
+            hop = float(input("How many seconds apart do windows start? ") or window)
+        output = input("Where should the results go (.jsonl or .csv)? ")
+        results = intFunc.find_songs(source, database_path, window, hop, output)
+        matched = sum(result["song_id"] is not None for result in results)
+        print(f"Matched {matched} of {len(results)} clips. Results written to {output}.")
+    elif function == '6':
+        song_id = int(input("Please enter the ID of the song to remove: "))
+        removed = intFunc.remove_song(song_id, database_path)
+        print("Removed \"" + removed["title"] + "\" by " + removed["artist"] + ".")
+    elif function == '7':
+        song_id = int(input("Please enter the ID of the song to replace: "))
+        song_path = root / input("Please enter the relative path to the new .mp3 file: ")
+        new_id = intFunc.replace_song(song_id, song_path, database_path)
+        print(f"Replaced. The song's new ID is {new_id}.")
     else:
         print("Sorry something went wrong.")
 
-else:
-    print("Sorry something went wrong.")
+
+def print_summary(summary):
+    print(f"Added {summary['added']} songs ({summary['skipped']} already in the database, {summary['failed']} failed), "
+          f"{summary['files_per_sec']:.2f} files/sec, {summary['fingerprints_per_sec']:.0f} fingerprints/sec")
+
+
+def add(args):
+    """Adds audio files, folders and manifests without prompting"""
+    for source in args.paths:
+        source = root / source
+        if source.is_dir() or source.suffix.lower() in (".csv", ".json"):
+            print_summary(intFunc.add_songs(source, args.database, workers=args.workers))
+            continue
+        info = {"title": args.title or source.stem, "artist": args.artist, "genre": args.genre}
+        song_id = intFunc.add_song(source, args.database, info)
+        if song_id is not None:
+            print(f"Added \"{info['title']}\" as song {song_id}.")
+
+
+def find(args):
+    """Identifies an audio file, a recording or live microphone input"""
+    if args.record is not None:
+        intFunc.find_song(args.record, None, args.database)
+    elif args.listen is not None:
+        intFunc.listen_for_song(args.listen, args.database)
+    elif args.path is not None:
+        intFunc.find_song(0, root / args.path, args.database)
+    else:
+        raise SystemExit("find needs an audio file, --record SECONDS or --listen SECONDS")
+
+
+def list_songs(args):
+    songs = intFunc.print_song_database(args.database, args.offset, args.limit, args.search,
+                                        args.title, args.artist, args.genre)
+    if args.limit is not None and len(songs) == args.limit:
+        print(f"More songs may follow: --offset {args.offset + args.limit}")
+
+
+# Main
+# python main.py runs the interactive menu; python main.py add|find|list ... runs one command
+# python main.py --profile ... prints per-stage timings, counters and memory at the end
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add songs to a database and recognize clips")
+    parser.add_argument("--database", default=DATABASE_PATH, help="database directory")
+    parser.add_argument("--profile", action="store_true", help="print per-stage timings, counters and memory")
+    commands = parser.add_subparsers(dest="command", metavar="{add,find,list}",
+                                     help="run one command instead of the interactive menu")
+
+    add_parser = commands.add_parser("add", help="add audio files, folders or .csv/.json manifests")
+    add_parser.add_argument("paths", nargs="+")
+    add_parser.add_argument("--title", help="title of a single file; defaults to its name")
+    add_parser.add_argument("--artist")
+    add_parser.add_argument("--genre")
+    add_parser.add_argument("--workers", type=int, help="fingerprinting processes for folders and manifests")
+    add_parser.set_defaults(run=add)
+
+    find_parser = commands.add_parser("find", help="identify an audio file or microphone input")
+    find_parser.add_argument("path", nargs="?", help="audio file to identify")
+    find_parser.add_argument("--record", type=int, metavar="SECONDS", help="record a clip of this length instead")
+    find_parser.add_argument("--listen", type=float, metavar="SECONDS",
+                             help="listen until the song is recognized, for at most this long")
+    find_parser.set_defaults(run=find)
+
+    list_parser = commands.add_parser("list", help="list or search the songs in the database")
+    list_parser.add_argument("--search", metavar="TEXT", help="only songs whose title, artist or genre contains TEXT")
+    list_parser.add_argument("--title", help="only songs whose title starts with this")
+    list_parser.add_argument("--artist", help="only songs whose artist starts with this")
+    list_parser.add_argument("--genre", help="only songs whose genre starts with this")
+    list_parser.add_argument("--offset", type=int, default=0, help="skip this many songs")
+    list_parser.add_argument("--limit", type=int, help="list at most this many songs")
+    list_parser.set_defaults(run=list_songs)
+
+    args = parser.parse_args()
+
+    metrics = None
+    if args.profile:
+        metrics = inst.Metrics()
+        inst.add_listener(metrics)
+
+    if args.command is None:
+        menu(args.database)
+    else:
+        args.run(args)
+
+    if metrics is not None:
+        print()
+        metrics.print_report()
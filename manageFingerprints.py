@@ -1,61 +1,522 @@
-# database: keys: pairing/fingerprint value: list of song ids
+# database: keys: packed (f1, f2, delta t) hash value: postings of (song_id, t_anchor)
+import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import fingerprint_index as fi
+import instrumentation as inst
 import song_metadata as sm
 
+# a (song, offset) histogram bin is stored as song << 32 | (offset + OFFSET_BIAS)
+OFFSET_BIAS = 1 << 31
+
+# shared by every sharded query; NumPy's searches and sorts release the GIL
+_shard_pool = None
+_shard_pool_size = 0
+
+# one ranked result of `match_song`; offset is in spectrogram frames
+Match = namedtuple("Match", ["song_id", "score", "offset", "confidence"])
+
 def add_fingerprints(fingerprints, song_id, database):
     '''
     Adds a list of fingerprints into the fingerprint database
-    This database has keys: fingerprints and values: list of song ids
+    This database maps packed (f1, f2, delta t) hashes to postings of (song_id, t_anchor)
 
     Returns the updated fingerprint database (database)
 
     Parameters
     -----------
-    song_id: id of a song
-    database: fingerprint database (dictionary)
-    fingerprints: numpy array containing all fingerprints for a certain song
+    song_id: dense integer id of a song
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+    fingerprints: list of fingerprints in the format [(f1, f2, delta t, t_anchor), ...] or a shape-(N, 4) array
 
     Returns
     --------
     Updated fingerprint database including all of the new fingerprints and song_id
+
+    Notes
+    --------
+    The anchor time is kept out of the key so that the same pair of peaks matches
+    wherever it occurs in a recording; it is stored in the posting instead and used
+    to line the query up against the song in `tally_fingerprints`.
     '''
-    for fingerprint in fingerprints:
-        if fingerprint in database:
-            list2 = database[fingerprint]
-            if list2 == None:
-                list2 = []
-            list2.append(song_id)
-            database[fingerprint] = list2
-        else:
-            database[fingerprint] = [song_id]
-    return database
+    with inst.stage("index_add"):
+        return database.add(fingerprints, song_id)
 
 
 def tally_fingerprints(pairings, database):
     '''
-    Tallies all of the songs that contain each pairing in pairings (fingerprints)
+    Scores every song that shares a fingerprint with pairings by time-offset voting
 
-    Returns a dictionary that contains a list of songs and the number of tallies (key: song_id, value: tallies)
+    Each colliding fingerprint votes for the offset t_db - t_query between the song
+    and the query. A real match lines up at one offset, so a song's score is the
+    height of the tallest bin of its offset histogram rather than the raw number of
+    collisions.
+
+    Returns a dictionary that contains a list of songs and their scores (key: song_id, value: tallies)
 
     Parameters
     -----------
-    pairings: a numpy array containing fingerprints
-    database: database of fingerprints (key: fingerprint, value: list of song_ids
+    pairings: list of query fingerprints in the format [(f1, f2, delta t, t_anchor), ...] or a shape-(N, 4) array
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
 
     Returns
     --------
     tallies - a dictionary that is keeping track of the tallies (key: song_ids, value: number of tallies)
     '''
+    songs, scores, _ = tally_offsets(pairings, database)
+    return {int(song_id): score.item() for song_id, score in zip(songs, scores)}
+
+
+def tally_offsets(pairings, database):
+    '''
+    Looks up the postings hit by pairings and scores them with `score_offsets`
+
+    Parameters
+    -----------
+    pairings: list of query fingerprints in the format [(f1, f2, delta t, t_anchor), ...] or a shape-(N, 4) array
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+
+    Returns
+    --------
+    (song_ids, scores, offsets) - numpy arrays with each matched song id, its peak
+    vote count and its winning offset
+    '''
+    hashes, query_times = fi.pack_fingerprints(pairings)
+    return score_histogram(*offset_histogram(hashes, query_times, database))
+
+
+def offset_histogram(hashes, query_times, database, groups=None):
+    '''
+    Builds the time-offset histogram of every song hit by a query
+
+    When database has more than one shard (fingerprint_index.SegmentedIndex.num_shards),
+    the query hashes are split by hash range, every shard looks up its part and
+    builds its own histogram in a thread pool, and the histograms are merged.
+
+    Parameters
+    -----------
+    hashes: numpy array of packed query fingerprint hashes
+    query_times: numpy array of the anchor time of each query fingerprint
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+    groups: optional numpy array added to the song id of every posting hit by each query
+            fingerprint, to keep the histograms of batched queries apart
+
+    Returns
+    --------
+    (bins, counts) - numpy arrays with every non-empty bin, encoded as
+    song << 32 | (offset + OFFSET_BIAS) and sorted, and its vote count
+    '''
+    inst.count("query_hashes", len(hashes))
+    with inst.stage("lookup"):
+        return _sharded_histogram(hashes, query_times, database, groups)
+
+
+def idf_weights(posting_counts, num_songs):
+    '''
+    Returns the vote weight of keys with the given posting-list lengths
+
+    A key that occurs once in the catalog weighs 1 and the weight falls off
+    with the logarithm of how common the key is, like the inverse document
+    frequency of TF-IDF: log(1 + N / n) / log(1 + N) for a key with n postings
+    in a catalog of N songs.
+
+    Parameters
+    -----------
+    posting_counts: numpy array of posting-list lengths, at least 1
+    num_songs: number of songs in the catalog
+    '''
+    num_songs = max(num_songs, 1)
+    return np.log1p(num_songs / np.maximum(posting_counts, 1)) / np.log1p(num_songs)
+
+
+def _sharded_histogram(hashes, query_times, database, groups=None):
+    '''
+    Does the work of `offset_histogram`
+    '''
+    max_postings = getattr(database, "max_postings", None)
+    weighting = getattr(database, "weighting", None)
+    if getattr(database, "num_shards", 1) <= 1:
+        return _histogram(hashes, query_times, database, groups, max_postings, weighting)
+
+    global _shard_pool, _shard_pool_size
+    bounds, shards = database.shards()
+    # the shard each query hash falls in, see FingerprintIndex.split
+    shard_of = np.searchsorted(bounds, hashes, side="right")
+    order = np.argsort(shard_of, kind="stable")
+    cuts = np.searchsorted(shard_of[order], np.arange(len(shards) + 1))
+    if _shard_pool_size < len(shards):
+        if _shard_pool is not None:
+            # queries already running on the old pool finish; its threads then exit
+            _shard_pool.shutdown(wait=False)
+        _shard_pool, _shard_pool_size = ThreadPoolExecutor(max_workers=len(shards)), len(shards)
+
+    parts = [order[start:stop] for start, stop in zip(cuts[:-1], cuts[1:])]
+    histograms = list(_shard_pool.map(
+        lambda shard, part: _histogram(hashes[part], query_times[part], shard,
+                                       None if groups is None else groups[part], max_postings, weighting),
+        shards, parts))
+    bins, inverse = np.unique(np.concatenate([bins for bins, counts in histograms]), return_inverse=True)
+    counts = np.concatenate([counts for bins, counts in histograms])
+    return bins, np.bincount(inverse.ravel(), weights=counts, minlength=bins.size).astype(counts.dtype)
+
+
+def _histogram(hashes, query_times, database, groups=None, max_postings=None, weighting=None):
+    '''
+    Builds the offset histogram of one index or shard, see `offset_histogram`
+
+    max_postings and weighting are the stop-list and vote weighting of
+    fingerprint_index.SegmentedIndex.
+    '''
+    if max_postings is not None or weighting is not None:
+        posting_counts = database.posting_counts(hashes)
+        if max_postings is not None:
+            keep = posting_counts <= max_postings
+            inst.count("stopped_hashes", keep.size - np.count_nonzero(keep))
+            hashes, query_times, posting_counts = hashes[keep], query_times[keep], posting_counts[keep]
+            groups = None if groups is None else groups[keep]
+
+    query_pos, song_ids, times = database.lookup(hashes)
+    inst.count("postings_scanned", song_ids.size)
+    song_ids = song_ids.astype(np.int64)
+    if groups is not None:
+        song_ids += groups[query_pos]
+    offsets = times.astype(np.int64) - query_times[query_pos]
+    bins = (song_ids << 32) | (offsets + OFFSET_BIAS)
+    if weighting is None:
+        return np.unique(bins, return_counts=True)
+    if weighting != "idf":
+        raise ValueError(f"weighting must be None or 'idf', not {weighting!r}")
+    bins, inverse = np.unique(bins, return_inverse=True)
+    weights = idf_weights(posting_counts, database.num_songs)[query_pos]
+    return bins, np.bincount(inverse.ravel(), weights=weights, minlength=bins.size)
+
+
+def score_histogram(bins, counts):
+    '''
+    Finds the tallest bin of every song in a histogram from `offset_histogram`
+
+    Returns
+    --------
+    (songs, scores, best_offsets) - see `score_offsets`
+    '''
+    with inst.stage("score"):
+        songs = bins >> 32
+        best = _tallest_bins(songs, counts)
+    inst.count("candidates_scored", best.size)
+    return songs[best], counts[best], (bins[best] & 0xFFFFFFFF) - OFFSET_BIAS
+
+
+def score_offsets(song_idx, offsets):
+    '''
+    Finds the peak of the time-offset histogram of every song
+
+    Parameters
+    -----------
+    song_idx: numpy array of non-negative integer song ids, one per colliding posting
+    offsets: numpy array of t_db - t_query for each colliding posting
+
+    Returns
+    --------
+    (songs, scores, best_offsets) - numpy arrays holding each song id that received a
+    vote, the height of its tallest offset bin, and the offset of that bin
+    '''
+    song_idx = np.asarray(song_idx, dtype=np.int64).ravel()
+    offsets = np.asarray(offsets, dtype=np.int64).ravel()
+    if song_idx.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # encode each (song, offset) bin as a single integer so one np.unique builds every histogram
+    low = offsets.min()
+    span = int(offsets.max() - low) + 1
+    bins, counts = np.unique(song_idx * span + (offsets - low), return_counts=True)
+    songs = bins // span
+
+    best = _tallest_bins(songs, counts)
+    return songs[best], counts[best], bins[best] % span + low
+
+
+def _tallest_bins(songs, counts):
+    '''
+    Returns the position of the tallest histogram bin of every song
+
+    Parameters
+    -----------
+    songs: numpy array with the song of each bin, sorted
+    counts: numpy array with the height of each bin
+    '''
+    # bins are sorted by song, so the tallest bin of a song is the last one after sorting by count
+    order = np.lexsort((counts, songs))
+    last = np.ones(order.size, dtype=bool)
+    last[:-1] = songs[order][1:] != songs[order][:-1]
+    return order[last]
+
+
+class OffsetVotes:
+    '''
+    Accumulates time-offset histogram votes over successive batches of query fingerprints
+
+    Used when a query arrives in pieces (e.g. live microphone input) so that the
+    histogram does not have to be rebuilt from every posting each time.
+    '''
+
+    def __init__(self):
+        self.bins = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, song_ids, offsets):
+        '''
+        Adds one vote per colliding posting
+
+        Parameters
+        -----------
+        song_ids: numpy array of song ids, one per colliding posting
+        offsets: numpy array of t_db - t_query for each colliding posting
+        '''
+        new_bins = (np.asarray(song_ids, dtype=np.int64) << 32) | (np.asarray(offsets, dtype=np.int64) + OFFSET_BIAS)
+        self.add_histogram(new_bins, np.ones(new_bins.size, dtype=np.int64))
+
+    def add_histogram(self, bins, counts):
+        '''
+        Adds the votes of a histogram from `offset_histogram`
+        '''
+        self.bins, inverse = np.unique(np.concatenate([self.bins, bins]), return_inverse=True)
+        weights = np.concatenate([self.counts, counts])
+        self.counts = np.bincount(inverse.ravel(), weights=weights).astype(weights.dtype)
+
+    def add_matches(self, pairings, database):
+        '''
+        Looks up pairings in database and adds their votes
+
+        Parameters
+        -----------
+        pairings: query fingerprints in the format [(f1, f2, delta t, t_anchor), ...] or a shape-(N, 4) array
+        database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+        '''
+        hashes, query_times = fi.pack_fingerprints(pairings)
+        self.add_histogram(*offset_histogram(hashes, query_times, database))
+
+    def scores(self):
+        '''
+        Returns
+        --------
+        (songs, scores, best_offsets) - see `score_offsets`
+        '''
+        return score_histogram(self.bins, self.counts)
+
+    def tallies(self):
+        '''
+        Returns the scores as a tallies dictionary (key: song_id, value: tallies), like `tally_fingerprints`
+        '''
+        songs, scores, _ = self.scores()
+        return {int(song_id): score.item() for song_id, score in zip(songs, scores)}
+
+    def is_decisive(self, margin, min_score):
+        '''
+        Checks whether the best song is far enough ahead to stop listening
+
+        Parameters
+        -----------
+        margin: how many times the runner-up's score the best score must be
+        min_score: smallest best score that can be decisive
+
+        Returns
+        --------
+        True if the best score is at least min_score and at least margin times the runner-up's
+        '''
+        _, scores, _ = self.scores()
+        if scores.size == 0:
+            return False
+        top = np.sort(scores)[::-1]
+        runner_up = top[1] if top.size > 1 else 0
+        return top[0] >= min_score and top[0] >= margin * max(runner_up, 1)
+
+
+def match_song(hashes, query_times, database, top_k=5, sample_postings=5000, num_candidates=20,
+               chunk_size=256, max_postings_scanned=1000000, decisive_z=5.0, min_score=10, min_fraction=0.02):
+    '''
+    Ranks the songs most likely to contain a query with a two-stage search
+
+    1. Shortlist: only the query's most selective hashes (the shortest posting
+       lists, up to sample_postings postings in total) are looked up, and the
+       num_candidates songs with the tallest offset bins are kept.
+    2. Verify: the remaining hashes are looked up from most to least selective,
+       chunk_size at a time, and exact time-offset votes are counted for the
+       candidates only. Verification stops early once the leader is decisively
+       ahead, i.e. the difference between the two best scores is more than
+       decisive_z standard deviations of Poisson vote counts,
+       (s1 - s2) / sqrt(s1 + s2) >= decisive_z, and s1 reaches the score floor
+       max(min_score, min_fraction * number of query hashes). The most
+       common hashes, which cost the most and tell songs apart the least, are
+       never looked up beyond max_postings_scanned postings, so the work per
+       query is bounded however large the catalog.
+
+    Parameters
+    -----------
+    hashes: numpy array of packed query fingerprint hashes (fingerprint_index.pack_fingerprints)
+    query_times: numpy array of the anchor time of each query fingerprint
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+    top_k: number of results returned
+    sample_postings, num_candidates: size of the shortlist stage
+    chunk_size, max_postings_scanned, decisive_z: see above
+    min_score, min_fraction: the score floor; smaller scores never stop
+                             verification early and get confidence 0
+
+    Returns
+    --------
+    list of at most top_k Match(song_id, score, offset, confidence), best first
+
+    Notes
+    --------
+    confidence is the probability that a score is not a chance alignment.
+    Chance votes land evenly on the M (song, offset) bins they could fall in:
+    for every song in the shortlist histogram, the span between its earliest
+    and latest voted offset. The chance level is the number of votes of every
+    hash that was looked up (for all songs, not just the candidates), less the
+    best score, divided by M. A score s then has probability P(X >= s),
+    X ~ Poisson(chance level), of arising by chance in one bin, and
+    confidence = 1 - min(1, M * P) (a Bonferroni correction over every bin).
+    Scores below the floor get confidence 0: songs that share musical
+    material with the query (or a removed song) can line up a few votes far
+    more often than uniform chance predicts, but not a fixed share of the
+    query's fingerprints.
+    '''
+    return match_songs([(hashes, query_times)], database, top_k, sample_postings, num_candidates, chunk_size,
+                       max_postings_scanned, decisive_z, min_score, min_fraction)[0]
+
+
+def match_songs(queries, database, top_k=5, sample_postings=5000, num_candidates=20,
+                chunk_size=256, max_postings_scanned=1000000, decisive_z=5.0, min_score=10, min_fraction=0.02):
+    '''
+    Ranks the songs most likely to contain each of several queries, see `match_song`
+
+    The posting counts and the shortlist stage of every query are looked up
+    together, so the binary searches and posting-list reads are shared, and one
+    offset histogram is built over (query, song, offset) bins. Verification
+    then runs query by query; every query gets the same results as it would
+    from `match_song` on its own.
+
+    Parameters
+    -----------
+    queries: list of (hashes, query_times) pairs, each from fingerprint_index.pack_fingerprints
+    database: fingerprint database (fingerprint_index.FingerprintIndex or SegmentedIndex)
+    top_k, sample_postings, num_candidates, chunk_size, max_postings_scanned,
+    decisive_z, min_score, min_fraction: see `match_song`
+
+    Returns
+    --------
+    list with one list of Match per query, see `match_song`
+    '''
+    queries = [(np.asarray(hashes, dtype=fi.HASH_DTYPE), np.asarray(query_times, dtype=np.int64))
+               for hashes, query_times in queries]
+    sizes = [hashes.size for hashes, query_times in queries]
+    all_counts = database.posting_counts(np.concatenate([hashes for hashes, query_times in queries]
+                                                        + [np.zeros(0, dtype=fi.HASH_DTYPE)]))
+    plans = []
+    for (hashes, query_times), posting_counts in zip(queries, np.split(all_counts, np.cumsum(sizes)[:-1])):
+        # most selective first; hashes that are not in the index cost nothing and are dropped
+        order = np.argsort(posting_counts, kind="stable")
+        order = order[posting_counts[order] > 0]
+        scanned = np.cumsum(posting_counts[order])
+        order = order[:max(1, np.searchsorted(scanned, max_postings_scanned, side="right"))]
+        plans.append((order, order[:max(1, np.searchsorted(scanned, sample_postings, side="right"))]))
+
+    with inst.stage("shortlist"):
+        num_songs = max(database.num_songs, 1)
+        query_of = np.repeat(np.arange(len(queries)), [sample.size for order, sample in plans])
+        bins, counts = offset_histogram(
+            np.concatenate([hashes[sample] for (hashes, query_times), (order, sample) in zip(queries, plans)]
+                           + [np.zeros(0, dtype=fi.HASH_DTYPE)]),
+            np.concatenate([query_times[sample] for (hashes, query_times), (order, sample) in zip(queries, plans)]
+                           + [np.zeros(0, dtype=np.int64)]),
+            database, query_of * num_songs)
+        # bins are sorted, so each query's bins are one contiguous run
+        bounds = np.searchsorted(bins >> 32, np.arange(len(queries) + 1) * num_songs)
+
+    results = []
+    for query, (hashes, query_times), (order, sample) in zip(range(len(queries)), queries, plans):
+        if order.size == 0:
+            results.append([])
+            continue
+        query_bins = bins[bounds[query]:bounds[query + 1]] - (query * num_songs << 32)
+        results.append(_verify(hashes, query_times, order, sample.size, query_bins,
+                               counts[bounds[query]:bounds[query + 1]], database, top_k, num_candidates,
+                               chunk_size, decisive_z, max(min_score, min_fraction * hashes.size, 1)))
+    return results
+
+
+def _verify(hashes, query_times, order, sample_size, bins, counts, database, top_k, num_candidates,
+            chunk_size, decisive_z, floor):
+    '''
+    Shortlists candidates from the histogram of a query's most selective hashes
+    and verifies them with the rest, see `match_song`
+
+    order holds the query hashes to look up, most selective first; the first
+    sample_size of them built (bins, counts). Returns the ranked list of Match.
+    '''
+    total_votes = float(counts.sum())
+    num_bins = _offset_bins(bins)
+    songs, scores, _ = score_histogram(bins, counts)
+    candidates = np.sort(songs[np.argsort(-scores, kind="stable")[:num_candidates]])
+    inst.count("shortlisted", candidates.size)
+
+    with inst.stage("verify"):
+        votes = OffsetVotes()
+        keep = np.isin(bins >> 32, candidates)
+        votes.add_histogram(bins[keep], counts[keep])
+        for start in range(sample_size, order.size, chunk_size):
+            songs, scores, _ = votes.scores()
+            top = np.sort(scores)[::-1]
+            leader, runner_up = (top[0] if top.size else 0), (top[1] if top.size > 1 else 0)
+            if leader >= floor and (leader - runner_up) / math.sqrt(leader + runner_up) >= decisive_z:
+                inst.count("early_stops")
+                break
+            chunk = order[start:start + chunk_size]
+            bins, counts = offset_histogram(hashes[chunk], query_times[chunk], database)
+            total_votes += float(counts.sum())
+            keep = np.isin(bins >> 32, candidates)
+            votes.add_histogram(bins[keep], counts[keep])
+        songs, scores, offsets = votes.scores()
+
+    ranked = np.lexsort((songs, -scores))
+    leader = scores[ranked[0]].item() if ranked.size else 0
+    chance = max(total_votes - leader, 0.0) / max(num_bins, 1)
+    return [Match(int(songs[i]), scores[i].item(), int(offsets[i]),
+                  1 - min(1.0, num_bins * _poisson_tail(scores[i], chance)) if scores[i] >= floor else 0.0)
+            for i in ranked[:top_k]]
+
+
+def _offset_bins(bins):
+    '''
+    Returns the number of (song, offset) bins the votes of a histogram could have landed in
+
+    For every song, that is the span between its earliest and latest voted
+    offset; bins is sorted, as `offset_histogram` returns it.
+    '''
+    if bins.size == 0:
+        return 0
+    songs = bins >> 32
+    first = np.flatnonzero(np.append(True, songs[1:] != songs[:-1]))
+    last = np.append(first[1:], bins.size) - 1
+    return int(np.sum((bins[last] & 0xFFFFFFFF) - (bins[first] & 0xFFFFFFFF) + 1))
+
+
+def _poisson_tail(score, mean):
+    '''
+    Returns P(X >= score) for X ~ Poisson(mean), rounding score down to a whole number of votes
+    '''
+    k = int(score)
+    if mean <= 0:
+        return 0.0 if k > 0 else 1.0
+    if k <= mean:
+        # sum the lower tail, which is short here
+        return max(0.0, 1 - sum(math.exp(j * math.log(mean) - mean - math.lgamma(j + 1)) for j in range(k)))
+    # the terms fall off at least geometrically with ratio mean / (k + 1) past the mode
+    term = math.exp(k * math.log(mean) - mean - math.lgamma(k + 1))
+    return min(1.0, term / (1 - mean / (k + 1)))
 
-    tallies = {}
-    for pairing in pairings:
-        if pairing in database:
-            song_ids = database[pairing]
-            for song_id in song_ids:
-                if song_id in tallies:
-                    tallies[song_id] = tallies[song_id] + 1
-                else:
-                    tallies[song_id] = 1
-    return tallies
 
 def add_song_fingerprints(database, fingerprints, song_id):
     '''
@@ -92,5 +553,7 @@ def find_song_id(tallies, threshold, num_fingerprints):
     --------
     returns song_id if there is a match or "No match found"
     '''
+    if not tallies:
+        return "No match found"
     song_id = max(tallies, key=tallies.get)
     return song_id if int(tallies[song_id]) / int(num_fingerprints) >= threshold else "No match found"
@@ -0,0 +1,337 @@
+"""Metadata Store
+song metadata in an indexed SQLite table, separate from the fingerprint index
+
+Every database directory holds metadata.sqlite with one row per song:
+
+songs(song_id INTEGER PRIMARY KEY,   the dense song ID used by the index
+      title, artist, genre TEXT,     indexed, compared case-insensitively
+      fingerprints INTEGER,
+      content_hash TEXT,             indexed, see fingerprint_cache.file_hash
+      extra TEXT)                    JSON of any other keys of the metadata dict
+
+Listing a page of songs, searching them or printing the titles of a few
+matches reads only the rows it needs, so it takes milliseconds however large
+the catalog and its fingerprint index are.
+
+`MetadataTable` is the {song ID: metadata dict} mapping the rest of the code
+uses. Reads go to SQLite; assignments and deletions are kept in memory until
+`commit` writes them in one transaction (index_storage.save_metadata does,
+between saving the tombstones and the new index segments). Metadata dicts
+read from the table are copies, so change a song by assigning a new dict.
+
+The table runs in WAL mode, so readers are never blocked by a writer. A
+database whose metadata is still in the metadata.json of earlier versions
+is imported into SQLite the first time it is opened.
+"""
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+
+STORE_FILE = "metadata.sqlite"
+LEGACY_FILE = "metadata.json"
+COLUMNS = ("fingerprints", "title", "artist", "genre", "content_hash")
+SORT_COLUMNS = ("song_id", "title", "artist", "genre")
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    song_id INTEGER PRIMARY KEY,
+    fingerprints INTEGER,
+    title TEXT COLLATE NOCASE,
+    artist TEXT COLLATE NOCASE,
+    genre TEXT COLLATE NOCASE,
+    content_hash TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS songs_title ON songs (title);
+CREATE INDEX IF NOT EXISTS songs_artist ON songs (artist);
+CREATE INDEX IF NOT EXISTS songs_genre ON songs (genre);
+CREATE INDEX IF NOT EXISTS songs_content_hash ON songs (content_hash);
+"""
+
+
+def _row(song_id, data):
+    """Splits a metadata dict into the values of one songs row"""
+    extra = {key: value for key, value in data.items() if key not in COLUMNS}
+    return (int(song_id), *(data.get(key) for key in COLUMNS), json.dumps(extra) if extra else None)
+
+
+def _metadata(row):
+    """Turns a songs row (without song_id) back into a metadata dict"""
+    data = {key: value for key, value in zip(COLUMNS, row) if value is not None}
+    if row[len(COLUMNS)] is not None:
+        data.update(json.loads(row[len(COLUMNS)]))
+    return data
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class MetadataStore:
+    """The songs table of one database
+
+    Parameters
+    ----------
+    path : str or pathlib.Path, database directory
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path / STORE_FILE, timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._create()
+
+    def _create(self):
+        """Creates the table, importing metadata.json if there is one"""
+        legacy_file = self.path / LEGACY_FILE
+        with self.transaction() as connection:
+            # another process may have created it while this one waited for the write lock
+            if connection.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            for statement in filter(str.strip, _SCHEMA.split(";")):
+                connection.execute(statement)
+            if legacy_file.is_file():
+                with open(legacy_file, mode="r") as opened_file:
+                    legacy = json.load(opened_file)
+                connection.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       [_row(song_id, data) for song_id, data in legacy.items()])
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        if legacy_file.is_file():
+            os.remove(legacy_file)
+
+    def transaction(self):
+        """Returns a context manager holding SQLite's write lock; commits on success"""
+        return _Transaction(self)
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def count(self):
+        """Returns the number of songs"""
+        return self._query("SELECT COUNT(*) FROM songs")[0][0]
+
+    def get(self, song_id):
+        """Returns the metadata dict of one song, or None"""
+        rows = self._query(f"SELECT {', '.join(COLUMNS)}, extra FROM songs WHERE song_id = ?", (int(song_id),))
+        return _metadata(rows[0]) if rows else None
+
+    def get_many(self, song_ids):
+        """Looks up the metadata of several songs at once, e.g. the top matches of a query
+
+        Returns
+        -------
+        dict
+            {song ID: metadata dict} for the IDs that exist
+        """
+        song_ids = sorted({int(song_id) for song_id in song_ids})
+        found = {}
+        # stay below SQLite's limit on the number of parameters per statement
+        for start in range(0, len(song_ids), 500):
+            chunk = song_ids[start:start + 500]
+            rows = self._query(f"SELECT song_id, {', '.join(COLUMNS)}, extra FROM songs "
+                               f"WHERE song_id IN ({', '.join('?' * len(chunk))})", chunk)
+            found.update((row[0], _metadata(row[1:])) for row in rows)
+        return found
+
+    def song_ids(self):
+        """Returns every song ID in increasing order"""
+        return [row[0] for row in self._query("SELECT song_id FROM songs ORDER BY song_id")]
+
+    def items(self):
+        """Returns every (song ID, metadata dict) pair in increasing order of song ID"""
+        rows = self._query(f"SELECT song_id, {', '.join(COLUMNS)}, extra FROM songs ORDER BY song_id")
+        return [(row[0], _metadata(row[1:])) for row in rows]
+
+    def find_content_hash(self, content_hash):
+        """Returns the ID of the song whose audio file has this content hash, or None"""
+        rows = self._query("SELECT song_id FROM songs WHERE content_hash = ? LIMIT 1", (content_hash,))
+        return rows[0][0] if rows else None
+
+    def find_content_hashes(self, content_hashes):
+        """Looks up several content hashes at once, e.g. every file of a batch being added
+
+        Returns
+        -------
+        dict
+            {content hash: song ID} for the hashes that are in the table
+        """
+        content_hashes = sorted(set(content_hashes))
+        found = {}
+        for start in range(0, len(content_hashes), 500):
+            chunk = content_hashes[start:start + 500]
+            rows = self._query(f"SELECT content_hash, song_id FROM songs "
+                               f"WHERE content_hash IN ({', '.join('?' * len(chunk))})", chunk)
+            found.update(rows)
+        return found
+
+    def search(self, text=None, title=None, artist=None, genre=None, offset=0, limit=50, order_by="song_id"):
+        """Lists one page of the songs matching every given condition
+
+        Parameters
+        ----------
+        text : str, optional; must occur in the title, artist or genre
+        title, artist, genre : str, optional; the field must start with this
+                               (prefix matches use the column's index)
+        offset : int, number of matching songs to skip
+        limit : int or None, page size; None returns every remaining song
+        order_by : str, one of SORT_COLUMNS
+
+        All comparisons ignore case. Without any condition this pages
+        through the whole catalog.
+
+        Returns
+        -------
+        list of (song ID, metadata dict) pairs
+        """
+        if order_by not in SORT_COLUMNS:
+            raise ValueError(f"order_by must be one of {SORT_COLUMNS}, not {order_by!r}")
+        conditions, parameters = [], []
+        for column, prefix in (("title", title), ("artist", artist), ("genre", genre)):
+            if prefix:
+                conditions.append(f"{column} LIKE ? ESCAPE '\\'")
+                parameters.append(_escape_like(prefix) + "%")
+        if text:
+            conditions.append("(title LIKE ? ESCAPE '\\' OR artist LIKE ? ESCAPE '\\' OR genre LIKE ? ESCAPE '\\')")
+            parameters.extend(["%" + _escape_like(text) + "%"] * 3)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._query(f"SELECT song_id, {', '.join(COLUMNS)}, extra FROM songs {where} "
+                           f"ORDER BY {order_by}, song_id LIMIT ? OFFSET ?",
+                           (*parameters, -1 if limit is None else int(limit), int(offset)))
+        return [(row[0], _metadata(row[1:])) for row in rows]
+
+    def write(self, changed, removed=()):
+        """Inserts or replaces the songs in changed and deletes those in removed, atomically
+
+        Parameters
+        ----------
+        changed : dict, {song ID: metadata dict}
+        removed : iterable of song IDs
+        """
+        with self.transaction() as connection:
+            connection.executemany("DELETE FROM songs WHERE song_id = ?", [(int(song_id),) for song_id in removed])
+            connection.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   [_row(song_id, data) for song_id, data in changed.items()])
+
+    def replace(self, metadata):
+        """Makes the table hold exactly metadata, a {song ID: metadata dict}, atomically"""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM songs")
+            connection.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   [_row(song_id, data) for song_id, data in metadata.items()])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            self.store._connection.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.store._lock.release()
+            raise
+        return self.store._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.store._connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.store._lock.release()
+
+
+class MetadataTable(MutableMapping):
+    """{song ID: metadata dict} view of a MetadataStore that buffers changes until `commit`
+
+    Parameters
+    ----------
+    store : MetadataStore
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._changed = {}
+        self._removed = set()
+
+    def __getitem__(self, song_id):
+        if song_id in self._changed:
+            return self._changed[song_id]
+        data = None if song_id in self._removed else self.store.get(song_id)
+        if data is None:
+            raise KeyError(song_id)
+        return data
+
+    def __setitem__(self, song_id, data):
+        self._removed.discard(song_id)
+        self._changed[song_id] = data
+
+    def __delitem__(self, song_id):
+        if song_id not in self:
+            raise KeyError(song_id)
+        self._changed.pop(song_id, None)
+        self._removed.add(song_id)
+
+    def __contains__(self, song_id):
+        try:
+            self[song_id]
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(song_id for song_id, data in self.items())
+
+    def __len__(self):
+        return len(self.items())
+
+    def items(self):
+        """Returns every (song ID, metadata dict) pair, reading the store once"""
+        merged = {song_id: data for song_id, data in self.store.items() if song_id not in self._removed}
+        merged.update(self._changed)
+        return sorted(merged.items())
+
+    def lookup(self, song_ids):
+        """Returns {song ID: metadata dict} for the given IDs that exist, with one query"""
+        wanted = {int(song_id) for song_id in song_ids}
+        found = self.store.get_many(wanted - set(self._changed) - self._removed)
+        found.update((song_id, self._changed[song_id]) for song_id in wanted & set(self._changed))
+        return found
+
+    def find_content_hash(self, content_hash):
+        """Returns the ID of the song whose audio file has this content hash, or None"""
+        for song_id, data in self._changed.items():
+            if data.get("content_hash") == content_hash:
+                return song_id
+        song_id = self.store.find_content_hash(content_hash)
+        return None if song_id in self._removed else song_id
+
+    def find_content_hashes(self, content_hashes):
+        """Returns {content hash: song ID} for the given hashes that belong to a song, with one query"""
+        wanted = set(content_hashes)
+        found = {content_hash: song_id for content_hash, song_id in self.store.find_content_hashes(wanted).items()
+                 if song_id not in self._removed and song_id not in self._changed}
+        found.update((data["content_hash"], song_id) for song_id, data in self._changed.items()
+                     if data.get("content_hash") in wanted)
+        return found
+
+    def search(self, *args, **kwargs):
+        """Pages through or searches the committed songs, see MetadataStore.search"""
+        return self.store.search(*args, **kwargs)
+
+    def commit(self):
+        """Writes the buffered changes to the store in one transaction"""
+        self.store.write(self._changed, self._removed)
+        self._changed = {}
+        self._removed = set()
@@ -0,0 +1,93 @@
+"""Migrate Database
+one-shot conversion of a pickled (metadata, database) file into the on-disk
+format of index_storage
+
+Usage: python migrate_database.py [database.pickle] [database]
+
+Understands every pickled layout the project has used:
+    {(f1, f2, delta t, t_anchor): [song ID, ...]}     original layout
+    {(f1, f2, delta t): [(song ID, t_anchor), ...]}   offset-voting layout
+    FingerprintIndex                                  packed-hash layout
+
+Song IDs (e.g. uuid.UUID) are renumbered to dense ints in the order they appear
+in the metadata dictionary, followed by any IDs that only appear in the index.
+"""
+import pickle
+import sys
+
+import numpy as np
+
+import frontend as fe
+import index_storage as storage
+from fingerprint_index import FingerprintIndex, SegmentedIndex, pack_hashes
+
+
+def _dense_ids(metadata, song_ids):
+    """Maps every song ID onto a dense int, keeping the metadata order first"""
+    dense = {}
+    for song_id in list(metadata) + list(song_ids):
+        if song_id not in dense:
+            dense[song_id] = len(dense)
+    return dense
+
+
+def convert(metadata, database):
+    """Converts a pickled (metadata, database) pair to the current in-memory types
+
+    Parameters
+    ----------
+    metadata : dict, {song ID: metadata dict}
+    database : dict or FingerprintIndex, fingerprint database in any pickled layout
+
+    Returns
+    -------
+    Tuple[dict, SegmentedIndex]
+        metadata keyed by dense int song IDs and the matching index, held
+        as a single unsaved segment
+    """
+    if isinstance(database, FingerprintIndex):
+        index = SegmentedIndex(num_songs=database.num_songs)
+        index.add_postings(database.posting_hashes(), database.song_ids, database.times)
+        return {int(song_id): data for song_id, data in metadata.items()}, index
+
+    rows = []
+    for key, postings in database.items():
+        if not postings:
+            continue
+        if len(key) == 4:
+            f1, f2, dt, t_anchor = key
+            rows.extend((f1, f2, dt, song_id, t_anchor) for song_id in postings)
+        else:
+            f1, f2, dt = key
+            rows.extend((f1, f2, dt, song_id, t_anchor) for song_id, t_anchor in postings)
+
+    dense = _dense_ids(metadata, (row[3] for row in rows))
+    new_metadata = {dense[song_id]: data for song_id, data in metadata.items()}
+    index = SegmentedIndex(num_songs=len(dense))
+    if not rows:
+        return new_metadata, index
+
+    f1, f2, dt, song_ids, times = zip(*rows)
+    index.add_postings(
+        pack_hashes(np.array(f1), np.array(f2), np.array(dt)),
+        np.array([dense[song_id] for song_id in song_ids]),
+        np.array(times),
+    )
+    return new_metadata, index
+
+
+def migrate(pickle_file, database_path):
+    """Converts the pickle at pickle_file into a new database at database_path"""
+    with open(pickle_file, mode="rb") as opened_file:
+        metadata, database = pickle.load(opened_file)
+    metadata, index = convert(metadata, database)
+    # the pickled fingerprints were made by the original front end
+    storage.create_database(database_path, fe.LEGACY_PARAMS)
+    storage.save_database(database_path, metadata, index)
+    print(f"Migrated {len(metadata)} songs and {index.num_postings} fingerprints to {database_path}")
+
+
+if __name__ == "__main__":
+    pickle_file = sys.argv[1] if len(sys.argv) > 1 else "database.pickle"
+    database_path = sys.argv[2] if len(sys.argv) > 2 else "database"
+    migrate(pickle_file, database_path)
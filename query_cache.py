@@ -0,0 +1,362 @@
+"""Query Cache
+bounded in-memory caches of decoded posting lists and of query results
+
+Monitoring traffic keeps hitting the same popular songs, the same frequent
+fingerprint hashes and often the very same clip. A long-running process
+(recognition_server, interface_functions.find_songs / listen_for_song) can
+attach two caches to its open SegmentedIndex with `attach`:
+
+PostingCache   every segment's postings of recently queried hashes, merged
+               and decoded (bit-packed segments are decoded once, not per
+               query), including the hashes that are in no segment; least
+               recently used lists are evicted once the arrays exceed
+               max_bytes. Tombstones are applied after the cache, so
+               removing a song does not invalidate it; adding a song drops
+               exactly the hashes of its new segment.
+ResultCache    {query digest: result} with the max_entries most recently
+               used results; a digest (`query_digest`) covers the query's
+               set of (hash, time) fingerprints and the matching settings.
+               Adding or removing a song clears it.
+
+SegmentedIndex.add_postings and remove invalidate both caches, so songs
+added or removed in the same process (e.g. interface_functions.add_song) are
+seen by the next query. Another process's changes are picked up when the
+database is reopened (recognition_server's "reload" request).
+
+Both caches count hits, misses and evictions (`stats`) and report them to
+instrumentation as <name>_hits, <name>_misses and <name>_evictions.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import fingerprint_index as fi
+import instrumentation as inst
+
+DEFAULT_POSTING_BYTES = 64 << 20
+DEFAULT_RESULTS = 1024
+# hash, offset and last-use tick of one cached posting list, bytes
+_KEY_BYTES = 24
+
+
+class _Lists:
+    """Posting lists of a set of hashes in CSR layout (see fingerprint_index), with a last-use tick per hash
+
+    A hash may have an empty list: it is then known not to be in the index.
+    """
+
+    def __init__(self, hashes, offsets, song_ids, times, used):
+        self.hashes = hashes
+        self.offsets = offsets
+        self.song_ids = song_ids
+        self.times = times
+        self.used = used
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=fi.HASH_DTYPE), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=fi.SONG_DTYPE),
+                   np.zeros(0, dtype=fi.TIME_DTYPE), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def fetch(cls, index, hashes, tick):
+        """Looks up the sorted, unique hashes in index and keeps their (possibly empty) lists"""
+        query_pos, song_ids, times = index.lookup(hashes)
+        order = np.argsort(query_pos, kind="stable")
+        offsets = np.searchsorted(query_pos[order], np.arange(hashes.size + 1)).astype(np.int64)
+        return cls(hashes, offsets, song_ids[order], times[order], np.full(hashes.size, tick, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.hashes.size * _KEY_BYTES + self.song_ids.nbytes + self.times.nbytes
+
+    def key_bytes(self):
+        """Returns the bytes each hash and its list take"""
+        return _KEY_BYTES + np.diff(self.offsets) * (self.song_ids.itemsize + self.times.itemsize)
+
+    def find(self, hashes):
+        """Returns (slots, found): the slot of each hash, and which ones are here"""
+        if self.hashes.size == 0:
+            return np.zeros(hashes.size, dtype=np.int64), np.zeros(hashes.size, dtype=bool)
+        slots = np.minimum(np.searchsorted(self.hashes, hashes), self.hashes.size - 1)
+        return slots, self.hashes[slots] == hashes
+
+    def rows(self, slots):
+        """Returns (lengths, rows): list length of each slot and the postings of all of them in order"""
+        starts = self.offsets[slots]
+        lengths = self.offsets[slots + 1] - starts
+        return lengths, np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+    def take(self, slots):
+        """Returns the lists of the given slots, in that order, as a new _Lists"""
+        lengths, rows = self.rows(slots)
+        return _Lists(self.hashes[slots], np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                      self.song_ids[rows], self.times[rows], self.used[slots])
+
+    @staticmethod
+    def merge(pieces):
+        """Merges several _Lists into one sorted by hash; a hash in several pieces is kept once"""
+        sizes = [piece.song_ids.size for piece in pieces]
+        shifts = np.repeat(np.cumsum([0] + sizes[:-1]), [piece.hashes.size for piece in pieces])
+        merged = _Lists(np.concatenate([piece.hashes for piece in pieces]),
+                        np.append(np.concatenate([piece.offsets[:-1] for piece in pieces]) + shifts,
+                                  sum(sizes)).astype(np.int64),
+                        np.concatenate([piece.song_ids for piece in pieces]),
+                        np.concatenate([piece.times for piece in pieces]),
+                        np.concatenate([piece.used for piece in pieces]))
+        order = np.argsort(merged.hashes, kind="stable")
+        ordered = merged.hashes[order]
+        first = np.concatenate([[True], ordered[1:] != ordered[:-1]])
+        return merged.take(order[first])
+
+
+class PostingCache:
+    """Cache of the merged posting list of each hash, bounded by the bytes of its arrays
+
+    The lists live in a few CSR arrays rather than one dict entry per hash, so
+    finding and gathering the lists of a query is a handful of vectorized
+    binary searches. Lists fetched by a query are staged as one small piece;
+    staged pieces are merged together once there are MAX_STAGED of them, and
+    into the main piece once they hold half as many bytes as it does or the
+    cache is over max_bytes. Eviction happens at that merge and keeps the
+    most recently used lists, leaving a quarter of max_bytes free for staging,
+    so a stream of misses pays for one rebuild per max_bytes / 4 fetched.
+
+    Hashes that are not in the index are cached too, as empty lists.
+
+    Parameters
+    ----------
+    max_bytes : int, largest size of the cached arrays (hashes, offsets,
+                last-use ticks and postings)
+    name : str, prefix of the instrumentation counters
+    """
+
+    MAX_STAGED = 8
+
+    def __init__(self, max_bytes=DEFAULT_POSTING_BYTES, name="posting_cache"):
+        self.max_bytes = int(max_bytes)
+        self.name = name
+        self.hits = self.misses = self.evictions = 0
+        self._main = _Lists.empty()
+        self._staged = []
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(piece.hashes.size for piece in [self._main] + self._staged)
+
+    @property
+    def nbytes(self):
+        return sum(piece.nbytes for piece in [self._main] + self._staged)
+
+    def lookup(self, index, query_hashes):
+        """Finds the postings of every query hash, looking up only uncached hashes in index
+
+        Parameters
+        ----------
+        index : any index with `lookup`, e.g. the segments of a SegmentedIndex
+        query_hashes : numpy.ndarray, shape-(Q,), packed fingerprint hashes
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            query_pos, song_ids, times; see fingerprint_index.FingerprintIndex.lookup,
+            except that postings are grouped by where they were cached
+        """
+        query_hashes = np.asarray(query_hashes, dtype=fi.HASH_DTYPE)
+        unique, inverse = np.unique(query_hashes, return_inverse=True)
+        piece_of = np.zeros(unique.size, dtype=np.int64)
+        slot_of = np.zeros(unique.size, dtype=np.int64)
+        remaining = np.arange(unique.size)
+        with self._lock:
+            self._tick += 1
+            tick = self._tick
+            pieces = [self._main] + self._staged
+            for number, piece in enumerate(pieces):
+                slots, found = piece.find(unique[remaining])
+                piece.used[slots[found]] = tick
+                piece_of[remaining[found]] = number
+                slot_of[remaining[found]] = slots[found]
+                remaining = remaining[~found]
+                if remaining.size == 0:
+                    break
+        self._count(unique.size - remaining.size, remaining.size, 0)
+
+        if remaining.size:
+            fetched = _Lists.fetch(index, unique[remaining], tick)
+            piece_of[remaining] = len(pieces)
+            slot_of[remaining] = np.arange(remaining.size)
+            pieces.append(fetched)
+            self._stage(fetched)
+
+        # gather the postings of every query position, one piece at a time
+        inverse = inverse.ravel()
+        results = []
+        for number, piece in enumerate(pieces):
+            query_pos = np.flatnonzero(piece_of[inverse] == number)
+            if query_pos.size:
+                lengths, rows = piece.rows(slot_of[inverse[query_pos]])
+                results.append((np.repeat(query_pos, lengths), piece.song_ids[rows], piece.times[rows]))
+        if not results:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=fi.SONG_DTYPE), np.zeros(0, dtype=fi.TIME_DTYPE)
+        query_pos, song_ids, times = zip(*results)
+        return np.concatenate(query_pos), np.concatenate(song_ids), np.concatenate(times)
+
+    def _stage(self, fetched):
+        """Adds freshly fetched lists, merging and evicting when needed"""
+        evicted = 0
+        with self._lock:
+            self._staged.append(fetched)
+            if len(self._staged) > self.MAX_STAGED:
+                self._staged = [_Lists.merge(self._staged)]
+            staged_bytes = sum(piece.nbytes for piece in self._staged)
+            if 2 * staged_bytes > self._main.nbytes or self._main.nbytes + staged_bytes > self.max_bytes:
+                merged = _Lists.merge([self._main] + self._staged)
+                if merged.nbytes > self.max_bytes:
+                    # keep the most recently used lists that fit in three quarters of the budget
+                    order = np.argsort(-merged.used, kind="stable")
+                    keep = np.sort(order[np.cumsum(merged.key_bytes()[order]) <= 3 * self.max_bytes // 4])
+                    evicted = merged.hashes.size - keep.size
+                    merged = merged.take(keep)
+                self._main, self._staged = merged, []
+        self._count(0, 0, evicted)
+
+    def discard(self, hashes):
+        """Drops the cached lists of the given hashes, e.g. those of a newly added segment"""
+        hashes = np.asarray(hashes, dtype=fi.HASH_DTYPE)
+        with self._lock:
+            pieces = []
+            for piece in [self._main] + self._staged:
+                stale = np.isin(piece.hashes, hashes)
+                pieces.append(piece.take(np.flatnonzero(~stale)) if stale.any() else piece)
+            self._main, self._staged = pieces[0], pieces[1:]
+
+    def clear(self):
+        with self._lock:
+            self._main, self._staged = _Lists.empty(), []
+
+    def _count(self, hits, misses, evictions):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+        inst.count(f"{self.name}_hits", hits)
+        inst.count(f"{self.name}_misses", misses)
+        if evictions:
+            inst.count(f"{self.name}_evictions", evictions)
+
+    def stats(self):
+        """Returns the cached hashes, bytes, hits, misses, evictions and hit rate as a dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": sum(piece.hashes.size for piece in [self._main] + self._staged),
+                    "bytes": self.nbytes, "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class ResultCache:
+    """LRU cache of query results keyed by `query_digest`
+
+    Parameters
+    ----------
+    max_entries : int, most results kept
+    name : str, prefix of the instrumentation counters
+    """
+
+    def __init__(self, max_entries=DEFAULT_RESULTS, name="result_cache"):
+        self.max_entries = int(max_entries)
+        self.name = name
+        self.hits = self.misses = self.evictions = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key):
+        """Returns the cached result of key, or None"""
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._results.move_to_end(key)
+        inst.count(f"{self.name}_hits" if result is not None else f"{self.name}_misses")
+        return result
+
+    def put(self, key, result):
+        """Caches result under key, evicting the least recently used results beyond max_entries"""
+        evicted = 0
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            inst.count(f"{self.name}_evictions", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        """Returns the entries, hits, misses, evictions and hit rate as a dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._results), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def query_digest(hashes, times, *settings):
+    """Returns a digest of a query's set of fingerprints and the settings it is matched with
+
+    Parameters
+    ----------
+    hashes, times : numpy.ndarray, the packed query (fingerprint_index.pack_fingerprints);
+                    the order of the fingerprints does not matter
+    settings : anything with a stable repr, e.g. the matcher and its keyword arguments
+
+    Returns
+    -------
+    str
+    """
+    hashes = np.asarray(hashes, dtype=fi.HASH_DTYPE)
+    times = np.asarray(times, dtype=np.int64)
+    order = np.lexsort((times, hashes))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(hashes[order].tobytes())
+    digest.update(times[order].tobytes())
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+
+def attach(database, max_posting_bytes=DEFAULT_POSTING_BYTES, max_results=DEFAULT_RESULTS):
+    """Gives an open SegmentedIndex a posting-list cache and a result cache
+
+    Parameters
+    ----------
+    database : fingerprint_index.SegmentedIndex
+    max_posting_bytes : int, size of the posting cache; 0 disables it
+    max_results : int, size of the result cache; 0 disables it
+
+    Returns
+    -------
+    SegmentedIndex
+        database, updated in place
+    """
+    database.posting_cache = PostingCache(max_posting_bytes) if max_posting_bytes > 0 else None
+    database.result_cache = ResultCache(max_results) if max_results > 0 else None
+    return database
+
+
+def stats(database):
+    """Returns {"postings": ..., "results": ...} cache statistics of a database (None when not attached)"""
+    return {"postings": None if database.posting_cache is None else database.posting_cache.stats(),
+            "results": None if database.result_cache is None else database.result_cache.stats()}
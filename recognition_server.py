@@ -0,0 +1,301 @@
+"""Recognition Server
+long-running recognition service with a preloaded index
+
+Starting a one-shot script per query pays for importing librosa and friends
+and opening the database every time. The server does that once, keeps a pool
+of warmed-up worker processes for decoding and fingerprinting, and batches
+concurrent queries into one shortlist lookup (manageFingerprints.match_songs).
+Clips are ranked and accepted exactly as interface_functions.find_song does.
+
+Protocol (Unix socket, or TCP with --port): each request is one line of JSON
+followed by "length" bytes of payload; each response is one line of JSON.
+
+    {"type": "file", "length": N, "suffix": ".mp3"}       payload is an audio file
+    {"type": "pcm", "length": N, "rate": 44100,
+     "dtype": "int16"}                                      payload is mono raw PCM
+    {"type": "reload"}                                      reopen the database to
+                                                            pick up added songs
+    {"type": "stats"}                                       hit rates and sizes of the
+                                                            posting and result caches
+
+Identical clips (the same set of fingerprints) are answered from a result
+cache, and the posting lists of frequent hashes are kept decoded in memory;
+see query_cache. Both are emptied when the database is reloaded.
+
+Usage: python recognition_server.py serve [database] [--socket PATH | --port PORT]
+                                   [--posting-cache-mb 64] [--result-cache 1024]
+       python recognition_server.py find CLIP [--socket PATH | --port PORT]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import conversion as c
+import fingerprint_index as fi
+import frontend as fe
+import index_storage as storage
+import interface_functions as intFunc
+import manageFingerprints as mf
+import query_cache as qc
+
+DEFAULT_SOCKET = "recognition.sock"
+
+
+def _fingerprint_request(header, payload, params):
+    """Worker: decodes one request's audio and returns its packed fingerprints"""
+    if header["type"] == "pcm":
+        samples = np.frombuffer(payload, dtype=header.get("dtype", "int16")).astype(np.float32)
+        rate = header["rate"]
+    else:
+        # librosa falls back to decoders that need a real file for some formats
+        with tempfile.NamedTemporaryFile(suffix=header.get("suffix", ""), delete=False) as opened_file:
+            opened_file.write(payload)
+        try:
+            samples, rate = c.load_samples(opened_file.name, params.sampling_rate)
+        finally:
+            os.remove(opened_file.name)
+    return fi.pack_fingerprints(fe.fingerprint_samples(samples, rate, params))
+
+
+class RecognitionServer:
+    """Answers recognition requests against one database
+
+    Parameters
+    ----------
+    file_path : string, points to the database directory
+    workers : int, optional; number of fingerprinting processes, defaults to the CPU count
+    max_batch : int, most queries looked up together
+    batch_window : float, seconds to wait for more queries before looking up a batch
+    posting_cache_bytes : int, size of the posting-list cache; 0 disables it
+    result_cache_entries : int, size of the query-result cache; 0 disables it
+    """
+
+    def __init__(self, file_path, workers=None, max_batch=32, batch_window=0.005,
+                 posting_cache_bytes=qc.DEFAULT_POSTING_BYTES, result_cache_entries=qc.DEFAULT_RESULTS):
+        self.file_path = file_path
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.posting_cache_bytes = posting_cache_bytes
+        self.result_cache_entries = result_cache_entries
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.reload()
+
+    def reload(self):
+        """Reopens the database, picking up songs added since the server started, with empty caches"""
+        self.metadata, self.database = storage.open_database(self.file_path)
+        qc.attach(self.database, self.posting_cache_bytes, self.result_cache_entries)
+
+    def warm_up(self):
+        """Starts every worker process and runs one fingerprint through it"""
+        silence = {"type": "pcm", "rate": self.database.params.sampling_rate, "dtype": "int16"}
+        payload = np.zeros(self.database.params.sampling_rate, dtype=np.int16).tobytes()
+        jobs = [self.pool.submit(_fingerprint_request, silence, payload, self.database.params)
+                for _ in range(self.workers)]
+        for job in jobs:
+            job.result()
+
+    async def serve(self, socket_path=DEFAULT_SOCKET, port=None):
+        """Serves requests until cancelled"""
+        self.warm_up()
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        if port is not None:
+            server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self._handle, socket_path)
+        print(f"Serving {self.database.num_songs} songs on {port if port is not None else socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+
+    async def _handle(self, reader, writer):
+        """Answers every request sent over one connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                header = json.loads(line)
+                payload = await reader.readexactly(header.get("length", 0))
+                try:
+                    response = await self._respond(header, payload)
+                except Exception as error:
+                    response = {"error": f"{type(error).__name__}: {error}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, header, payload):
+        """Produces the response to one request"""
+        if header["type"] == "reload":
+            self.reload()
+            return {"songs": self.database.num_songs}
+        if header["type"] == "stats":
+            return qc.stats(self.database)
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        hashes, times = await loop.run_in_executor(
+            self.pool, _fingerprint_request, header, payload, self.database.params)
+        database = self.database
+        key = qc.query_digest(hashes, times, "match_song")
+        matches = database.result_cache.get(key) if database.result_cache is not None else None
+        if matches is None:
+            result = loop.create_future()
+            await self.queue.put((hashes, times, result))
+            matches = await result
+            if database.result_cache is not None:
+                database.result_cache.put(key, matches)
+
+        hop_seconds = (database.params.nfft - database.params.noverlap) / database.params.sampling_rate
+        response = {"song_id": None, "confidence": matches[0].confidence if matches else 0.0,
+                    "matches": [{"song_id": match.song_id, "score": match.score,
+                                 "offset_seconds": match.offset * hop_seconds, "confidence": match.confidence}
+                                for match in matches],
+                    "fingerprints": int(hashes.size), "latency": time.perf_counter() - start}
+        if matches and matches[0].confidence >= intFunc.MIN_CONFIDENCE:
+            song_id = matches[0].song_id
+            data = self.metadata.lookup([song_id]).get(song_id, {})
+            response.update(
+                song_id=song_id,
+                score=matches[0].score,
+                offset_seconds=matches[0].offset * hop_seconds,
+                **{key: data.get(key) for key in ("title", "artist", "genre")},
+            )
+        return response
+
+    async def _batcher(self):
+        """Collects queued queries into batches and ranks each batch with one shortlist lookup"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [(hashes, times) for hashes, times, result in batch]
+            try:
+                results = await loop.run_in_executor(None, mf.match_songs, queries, self.database)
+            except Exception as error:
+                for hashes, times, result in batch:
+                    result.set_exception(error)
+                continue
+            for (hashes, times, result), matches in zip(batch, results):
+                result.set_result(matches)
+
+
+def _connect(socket_path=DEFAULT_SOCKET, port=None):
+    if port is not None:
+        return socket.create_connection(("127.0.0.1", port))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    return connection
+
+
+def request(header, payload=b"", socket_path=DEFAULT_SOCKET, port=None):
+    """Sends one request to a running server and returns its response
+
+    Parameters
+    ----------
+    header : dict, request header without "length"
+    payload : bytes
+    socket_path : string, Unix socket of the server
+    port : int, optional; connect over TCP to this local port instead
+
+    Returns
+    -------
+    dict
+    """
+    with _connect(socket_path, port) as connection:
+        connection.sendall(json.dumps(dict(header, length=len(payload))).encode() + b"\n" + payload)
+        with connection.makefile("rb") as response:
+            return json.loads(response.readline())
+
+
+def recognize_file(mp3_file_path, socket_path=DEFAULT_SOCKET, port=None):
+    """Asks a running server to recognize an audio file; see `request` for the response"""
+    mp3_file_path = Path(mp3_file_path)
+    return request({"type": "file", "suffix": mp3_file_path.suffix}, mp3_file_path.read_bytes(),
+                   socket_path, port)
+
+
+def recognize_samples(samples, rate, socket_path=DEFAULT_SOCKET, port=None):
+    """Asks a running server to recognize raw mono samples; see `request` for the response"""
+    samples = np.asarray(samples)
+    dtype = "int16" if samples.dtype == np.int16 else "float32"
+    return request({"type": "pcm", "rate": rate, "dtype": dtype}, samples.astype(dtype).tobytes(),
+                   socket_path, port)
+
+
+def find_song_remote(duration, mp3_file_path, socket_path=DEFAULT_SOCKET, port=None):
+    """Drop-in for interface_functions.find_song that asks a running server
+
+    Parameters
+    ------------
+    duration : int, seconds to record when mp3_file_path is None
+    mp3_file_path : string, points to a file to match, or None to record
+    socket_path : string, Unix socket of the server
+    port : int, optional; connect over TCP to this local port instead
+    """
+    if mp3_file_path is not None:
+        response = recognize_file(mp3_file_path, socket_path, port)
+    else:
+        samples, rate = c.record_samples(duration)
+        response = recognize_samples(samples, rate, socket_path, port)
+
+    if "error" in response:
+        print("Something went wrong: " + response["error"])
+    elif response["song_id"] is None:
+        print("No match found. Please try again.")
+    else:
+        print(f"You are currently listening to \"{response.get('title') or 'Unknown'}\" by "
+              f"{response.get('artist') or 'Unknown'}. Genre: {response.get('genre') or 'Unknown'}")
+        print(f"Confidence: {response['confidence']:.1%}")
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Song recognition server and client")
+    parser.add_argument("command", choices=["serve", "find"])
+    parser.add_argument("path", nargs="?", default="database",
+                        help="database directory to serve, or clip to find")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--posting-cache-mb", type=float, default=qc.DEFAULT_POSTING_BYTES / 2 ** 20,
+                        help="memory for cached posting lists; 0 disables the cache")
+    parser.add_argument("--result-cache", type=int, default=qc.DEFAULT_RESULTS,
+                        help="number of query results cached; 0 disables the cache")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = RecognitionServer(args.path, workers=args.workers,
+                                   posting_cache_bytes=int(args.posting_cache_mb * 2 ** 20),
+                                   result_cache_entries=args.result_cache)
+        try:
+            asyncio.run(server.serve(args.socket, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        find_song_remote(0, args.path, args.socket, args.port)
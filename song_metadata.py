@@ -85,6 +85,34 @@ def add_metadata(fingerprints):
     return data
 
 
+def make_metadata(fingerprints, title=None, artist=None, genre=None, content_hash=None):
+    """Creates a metadata dictionary without prompting the user
+
+    Parameters
+    ----------
+    fingerprints : int, number of fingerprints associated with the song
+    title, artist, genre (optional) : string, known metadata; missing or
+                                      empty values are stored as "Unknown"
+    content_hash (optional) : string, hash of the song's audio file (see
+                              fingerprint_cache.file_hash), used to skip
+                              files that are already in the database
+
+    Returns
+    -------
+    dict
+    keys = metadata category (title, artist, genre)
+    values = provided metadata or "Unknown"
+    """
+    data = dict()
+    data["fingerprints"] = fingerprints
+    data["title"] = title or "Unknown"
+    data["artist"] = artist or "Unknown"
+    data["genre"] = genre or "Unknown"
+    if content_hash is not None:
+        data["content_hash"] = content_hash
+    return data
+
+
 def get_metadata(metadata, id, query=None):
     """Returns requested metadata for given song id
 
@@ -0,0 +1,182 @@
+"""STFT
+float32 short-time Fourier transform computing the same power spectrogram as mlab.specgram
+
+`power_spectrogram(samples, rate, nfft, noverlap)` returns what
+mlab.specgram(samples, NFFT=nfft, Fs=rate, window=mlab.window_hanning,
+noverlap=noverlap)[0] does (one-sided PSD scaled by frequency, no detrending)
+but
+
+- frames are a strided view of the samples, not copies;
+- the Hann window and the PSD scale are computed once per (nfft, rate) and
+  cached;
+- everything is float32, so frames, spectra and powers take half the memory
+  bandwidth of mlab's float64 and complex128;
+- the FFTs run in scipy.fft.rfft with `workers` threads, and the windowed
+  frames are written into a scratch buffer that is reused between calls;
+- `power_spectrograms` transforms the frames of many signals (e.g. a batch
+  of query clips) with one rfft call. The batch's spectrum outgrows the CPU
+  caches, so this has so far been slower than looping over
+  `power_spectrogram`, which is what the pipeline does;
+  `python benchmark.py --stft` times both.
+
+The powers agree with mlab.specgram to float32 precision (median relative
+error around 1e-7, a few 1e-4 in near-silent bins), which is far below the
+differences peak finding can see; `python benchmark.py --stft` measures both
+the error and the speedup.
+
+`Engine` objects hold the scratch buffer and are not shared between threads;
+the module functions keep one engine per thread and frame layout.
+"""
+import functools
+import os
+import threading
+
+import numpy as np
+
+# FFT threads per call; -1 would use every core, which oversubscribes the
+# machine when ingest already runs one process per core
+DEFAULT_WORKERS = int(os.environ.get("SONG_MATCHING_FFT_WORKERS", 1))
+
+_engines = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def hann_window(nfft):
+    """Returns the float32 Hann window of length nfft, as mlab.window_hanning uses; read-only"""
+    window = np.hanning(nfft).astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+
+@functools.lru_cache(maxsize=None)
+def psd_scale(nfft, rate):
+    """Returns the float32 factor mlab.specgram scales each one-sided power bin by; read-only
+
+    Every bin except DC (and Nyquist for even nfft) is doubled to fold in the
+    negative frequencies, and all are divided by rate * sum(window ** 2).
+    """
+    window = np.hanning(nfft)
+    scale = np.full(nfft // 2 + 1, 2.0)
+    scale[0] = 1.0
+    if nfft % 2 == 0:
+        scale[-1] = 1.0
+    scale = (scale / (rate * (window ** 2).sum())).astype(np.float32)
+    scale.flags.writeable = False
+    return scale
+
+
+def frames(samples, nfft, noverlap):
+    """Returns a shape-(W, nfft) strided view of the frames of samples, without copying them
+
+    samples : numpy.ndarray, shape-(N,) with N >= nfft
+    """
+    return np.lib.stride_tricks.sliding_window_view(samples, nfft)[::nfft - noverlap]
+
+
+class Engine:
+    """Computes power spectrograms for one frame layout, reusing its buffers
+
+    Parameters
+    ----------
+    nfft : int, samples per frame
+    noverlap : int, samples shared by consecutive frames
+    rate : int, sampling rate, Hz; only used for the PSD scale
+    workers : int, FFT threads (see scipy.fft.rfft)
+    """
+
+    def __init__(self, nfft, noverlap, rate, workers=DEFAULT_WORKERS):
+        self.nfft = nfft
+        self.noverlap = noverlap
+        self.rate = rate
+        self.workers = workers
+        self.window = hann_window(nfft)
+        self.scale = psd_scale(nfft, rate)
+        self._scratch = np.zeros((0, nfft), dtype=np.float32)
+
+    def _windowed(self, num):
+        """Returns a scratch buffer for num windowed frames, growing it when needed"""
+        if self._scratch.shape[0] < num:
+            self._scratch = np.empty((max(num, 2 * self._scratch.shape[0]), self.nfft), dtype=np.float32)
+        return self._scratch[:num]
+
+    def _frames(self, samples):
+        samples = np.asarray(samples, dtype=np.float32).ravel()
+        if samples.size < self.nfft:
+            samples = np.pad(samples, (0, self.nfft - samples.size))
+        return frames(samples, self.nfft, self.noverlap)
+
+    def _power(self, windowed):
+        """Turns windowed frames into scaled powers, shape-(W, nfft // 2 + 1)"""
+        from scipy import fft
+
+        spectrum = fft.rfft(windowed, axis=1, workers=self.workers)
+        out = np.empty(spectrum.shape, dtype=np.float32)
+        np.multiply(spectrum.real, spectrum.real, out=out)
+        out += spectrum.imag * spectrum.imag
+        out *= self.scale
+        return out
+
+    def power(self, samples):
+        """Returns the power spectrogram of samples
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,), mono audio at self.rate
+
+        Returns
+        -------
+        numpy.ndarray, shape-(nfft // 2 + 1, W), float32
+            rows - freqs, columns - times, like mlab.specgram
+        """
+        view = self._frames(samples)
+        windowed = self._windowed(view.shape[0])
+        np.multiply(view, self.window, out=windowed)
+        return self._power(windowed).T
+
+    def powers(self, signals):
+        """Returns the power spectrogram of each of several signals, with one FFT call
+
+        Parameters
+        ----------
+        signals : iterable of numpy.ndarray, shape-(N_i,)
+
+        Returns
+        -------
+        list of numpy.ndarray, shape-(nfft // 2 + 1, W_i)
+        """
+        views = [self._frames(samples) for samples in signals]
+        bounds = np.cumsum([0] + [view.shape[0] for view in views])
+        windowed = self._windowed(int(bounds[-1]))
+        for view, start in zip(views, bounds):
+            np.multiply(view, self.window, out=windowed[start:start + view.shape[0]])
+        power = self._power(windowed)
+        return [power[start:stop].T for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def engine(nfft, noverlap, rate, workers=DEFAULT_WORKERS):
+    """Returns this thread's Engine for the given frame layout, creating it on first use"""
+    key = (nfft, noverlap, rate, workers)
+    cache = _engines.__dict__.setdefault("engines", {})
+    if key not in cache:
+        cache[key] = Engine(nfft, noverlap, rate, workers)
+    return cache[key]
+
+
+def power_spectrogram(samples, rate, nfft, noverlap, workers=DEFAULT_WORKERS):
+    """Returns the power spectrogram of samples, like mlab.specgram with a Hann window
+
+    Returns
+    -------
+    numpy.ndarray, shape-(nfft // 2 + 1, W), float32
+    """
+    return engine(nfft, noverlap, rate, workers).power(samples)
+
+
+def power_spectrograms(signals, rate, nfft, noverlap, workers=DEFAULT_WORKERS):
+    """Returns the power spectrogram of each signal in signals, transforming them all at once
+
+    Returns
+    -------
+    list of numpy.ndarray, shape-(nfft // 2 + 1, W_i), float32
+    """
+    return engine(nfft, noverlap, rate, workers).powers(signals)
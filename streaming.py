@@ -0,0 +1,217 @@
+"""Streaming
+incremental spectrogram, peak finding and fingerprinting over blocks of audio
+
+`FingerprintStream` turns blocks of samples into fingerprints as they arrive,
+keeping only a few frames and peaks of state between blocks:
+
+SpectrogramStream  samples  -> spectrogram columns; carries the overlap
+                               between blocks so frames are identical to
+                               running stft.power_spectrogram over the whole signal
+PeakStream         columns  -> peaks; searches a sliding window of columns,
+                               keeping the neighborhood's width of columns
+                               on either side so window edges are exact
+FingerprintStream  peaks    -> fingerprints; pairs each peak once its
+                               fanout_value following peaks have arrived
+
+The only difference from fingerprinting a whole file at once is the amplitude
+threshold, which is the percentile over each window instead of the whole song
+(for "global" and "band" thresholds; "time" thresholds are per column anyway).
+"""
+import numpy as np
+
+import conversion as c
+import find_peaks as fp
+import frontend as fe
+import stft
+
+
+class SpectrogramStream:
+    """Computes spectrogram columns incrementally, matching stft.power_spectrogram
+
+    Parameters
+    ----------
+    params : frontend.AnalysisParams; samples must be at params.sampling_rate
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.rate = params.sampling_rate
+        self.nfft = params.nfft
+        self.noverlap = params.noverlap
+        self.engine = stft.Engine(self.nfft, self.noverlap, self.rate)
+        self._carry = np.zeros(0, dtype=np.float32)
+
+    def push(self, samples):
+        """Adds samples and returns the spectrogram columns they complete
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+
+        Returns
+        -------
+        numpy.ndarray, shape-(H, F)
+            rows - freqs within the analysis band, columns - the F newly
+            completed frames
+        """
+        buffer = np.concatenate([self._carry, np.asarray(samples, dtype=np.float32)])
+        hop = self.nfft - self.noverlap
+        num_frames = (len(buffer) - self.noverlap) // hop if len(buffer) >= self.nfft else 0
+        # the next frame starts at num_frames * hop; keep everything from there on
+        self._carry = buffer[num_frames * hop:]
+        if num_frames == 0:
+            return fe.finish_spectrogram(np.zeros((self.nfft // 2 + 1, 0), dtype=np.float32), self.params)
+
+        power = self.engine.power(buffer[:(num_frames - 1) * hop + self.nfft])
+        return fe.finish_spectrogram(power, self.params)
+
+
+class PeakStream:
+    """Finds local peaks over a sliding window of spectrogram columns
+
+    Parameters
+    ----------
+    neighborhood : numpy.ndarray, shape-(h, w), see `find_peaks.local_peak_array`
+    params : frontend.AnalysisParams, chooses how each window's threshold is computed
+    window_frames : int, number of columns searched at a time
+    amp_min : float, optional; fixed threshold to use instead of the percentile
+    """
+
+    def __init__(self, neighborhood, params, window_frames=256, amp_min=None):
+        self.neighborhood = neighborhood
+        self.radius = neighborhood.shape[1] // 2
+        self.params = params
+        self.window_frames = window_frames
+        self.amp_min = amp_min
+        self._buffer = None
+        self._buffer_start = 0  # absolute column of self._buffer[:, 0]
+        self._done = 0  # absolute column up to which peaks have been returned
+
+    def push(self, columns, last=False):
+        """Adds spectrogram columns and returns the peaks that are now final
+
+        Parameters
+        ----------
+        columns : numpy.ndarray, shape-(H, F)
+        last : bool, True once no more columns will follow
+
+        Returns
+        -------
+        numpy.ndarray, shape-(N, 2)
+            (row, col) of each new peak, with absolute column indices, in
+            column-major order
+        """
+        if self._buffer is None:
+            self._buffer = columns
+        else:
+            self._buffer = np.concatenate([self._buffer, columns], axis=1)
+        buffer_end = self._buffer_start + self._buffer.shape[1]
+
+        # a column is final once the neighborhood's width of columns after it is known
+        ready = buffer_end if last else buffer_end - self.radius
+        if self.params.peaks_per_second is not None and not last:
+            # the peak budget is per second, so only finish whole seconds
+            ready -= ready % fe.budget_window_cols(self.params)
+        if ready <= self._done or (not last and ready - self._done < self.window_frames):
+            return np.zeros((0, 2), dtype=np.int64)
+
+        first, stop = self._done - self._buffer_start, ready - self._buffer_start
+        if self.amp_min is not None:
+            threshold = self.amp_min
+        elif self.params.threshold == "time":
+            # one threshold per column, so it has to cover the whole buffer
+            threshold = fe.peak_threshold(self._buffer, self.params)
+        else:
+            threshold = fe.peak_threshold(self._buffer[:, first:stop], self.params)
+        peaks = fp.local_peak_array(self._buffer, self.neighborhood, threshold)
+        peaks = peaks[(peaks[:, 1] >= first) & (peaks[:, 1] < stop)]
+        amplitudes = self._buffer[peaks[:, 0], peaks[:, 1]]
+        peaks[:, 1] += self._buffer_start
+        peaks = fe.apply_peak_budget(peaks, amplitudes, self.params)
+
+        # keep the columns the next window's first columns are compared against
+        keep_from = max(ready - self.radius, self._buffer_start)
+        self._buffer = self._buffer[:, keep_from - self._buffer_start:]
+        self._buffer_start = keep_from
+        self._done = ready
+        return peaks
+
+
+class FingerprintStream:
+    """Turns blocks of samples into fingerprints as they arrive
+
+    Parameters
+    ----------
+    rate : int, sampling rate of the samples, Hz; resampled to
+           params.sampling_rate on the fly if different
+    params : frontend.AnalysisParams
+    neighborhood : numpy.ndarray, optional; defaults to find_peaks.binary_structure(2, 1)
+    window_frames : int, number of spectrogram columns searched for peaks at a time
+    amp_min : float, optional; fixed threshold to use instead of the percentile
+    """
+
+    def __init__(self, rate, params=fe.DEFAULT_PARAMS, neighborhood=None,
+                 window_frames=256, amp_min=None):
+        if neighborhood is None:
+            neighborhood = fp.binary_structure(2, 1)
+        self.fanout_value = params.fanout_value
+        self.resampler = None
+        if rate != params.sampling_rate:
+            import soxr
+
+            self.resampler = soxr.ResampleStream(rate, params.sampling_rate, 1, dtype="float32")
+        self.spectrogram = SpectrogramStream(params)
+        self.peaks = PeakStream(neighborhood, params, window_frames, amp_min)
+        self._pending = np.zeros((0, 2), dtype=np.int64)
+
+    def push(self, samples, last=False):
+        """Adds samples and returns the fingerprints that are now complete
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+        last : bool, True once no more samples will follow
+
+        Returns
+        -------
+        numpy.ndarray, shape-(M, 4)
+            One (f1, f2, delta t, t_anchor) row per fingerprint, with
+            absolute anchor times
+        """
+        if self.resampler is not None:
+            samples = self.resampler.resample_chunk(np.asarray(samples, dtype=np.float32), last=last)
+        new_peaks = self.peaks.push(self.spectrogram.push(samples), last=last)
+        peaks = np.concatenate([self._pending, new_peaks])
+        # an anchor is complete once its fanout_value partners have been found
+        num_anchors = len(peaks) if last else max(len(peaks) - self.fanout_value, 0)
+        self._pending = peaks[num_anchors:]
+        return fp.fanout_pairs(peaks, self.fanout_value, num_anchors)
+
+    def flush(self):
+        """Returns the remaining fingerprints once the audio has ended"""
+        return self.push(np.zeros(0), last=True)
+
+
+def stream_fingerprints(song, params=fe.DEFAULT_PARAMS, block_seconds=10, **kwargs):
+    """Fingerprints an audio file block by block with bounded memory
+
+    Parameters
+    ----------
+    song : str or pathlib.Path, audio file path
+    params : frontend.AnalysisParams
+    block_seconds : float, length of audio decoded per block
+    **kwargs : passed on to FingerprintStream
+
+    Yields
+    ------
+    numpy.ndarray, shape-(M, 4)
+        fingerprints as they are completed
+    """
+    stream = FingerprintStream(params.sampling_rate, params, **kwargs)
+    for samples in c.stream_samples(song, params.sampling_rate, block_seconds):
+        fingerprints = stream.push(samples)
+        if len(fingerprints):
+            yield fingerprints
+    fingerprints = stream.flush()
+    if len(fingerprints):
+        yield fingerprints